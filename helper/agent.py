@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+from langchain.agents import create_agent
+
+from .config import AGENT_CACHE_SIZE
+from .mcp import mcp_tools_cache
+
+
+class AgentCache:
+    """
+    编译后的智能体缓存，避免每次请求重新编译 LangGraph 图
+    按 (模型实例, 工具列表中的工具对象) 缓存：
+    - 模型实例由模型缓存按配置哈希复用，相同配置得到同一个实例
+    - 工具对象带有用户 token，按对象而不是工具定义区分，不同用户不会共用智能体
+    条目持有模型和工具的引用，保证作为键的对象标识不会被复用
+    工具列表缓存替换或删除某个工具列表时，删除基于它的智能体
+    """
+    def __init__(self, maxsize=AGENT_CACHE_SIZE):
+        """
+        :param maxsize: 最多缓存的智能体数，为 0 时不缓存
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, tools):
+        return id(model), tuple(id(tool) for tool in tools)
+
+    def get_agent(self, model, tools):
+        """获取缓存的智能体，不存在时编译"""
+        if self.maxsize <= 0:
+            return create_agent(model, tools)
+        key = self.make_key(model, tools)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        agent = create_agent(model, tools)
+        with self.lock:
+            entry = self.entries.setdefault(key, (agent, model, list(tools)))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return entry[0]
+
+    def invalidate_tools(self, tools):
+        """删除使用了这些工具的智能体"""
+        tool_ids = {id(tool) for tool in tools}
+        if not tool_ids:
+            return
+        with self.lock:
+            for key in [key for key in self.entries if tool_ids.intersection(key[1])]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """缓存统计"""
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# 进程内共享的智能体缓存，MCP 工具列表变化时自动失效
+agent_cache = AgentCache()
+mcp_tools_cache.listeners.append(agent_cache.invalidate_tools)
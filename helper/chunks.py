@@ -0,0 +1,112 @@
+from langchain_core.messages import AIMessageChunk
+
+# 推理内容的开始和结束标记
+REASONING_START = "::: reasoning\n"
+REASONING_END = "\n:::\n\n"
+
+
+def _text_block(block):
+    return None, block.get("text")
+
+
+def _thinking_block(block):
+    # Claude: {"type": "thinking", "thinking": "..."}
+    return block.get("thinking"), None
+
+
+def _reasoning_block(block):
+    # 标准内容块: {"type": "reasoning", "reasoning": "..."}
+    reasoning = block.get("reasoning")
+    if reasoning:
+        return reasoning, None
+    # OpenAI Responses API: {"type": "reasoning", "summary": [{"type": "summary_text", "text": "..."}]}
+    summary = block.get("summary")
+    if summary:
+        return "".join(item.get("text", "") for item in summary if isinstance(item, dict)), None
+    return None, None
+
+
+# 按内容块类型分发，未列出的类型（tool_use、input_json_delta 等）直接忽略
+_BLOCK_DECODERS = {
+    "text": _text_block,
+    "thinking": _thinking_block,
+    "reasoning": _reasoning_block,
+}
+
+
+def _join_reasoning(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "".join(item if isinstance(item, str) else item.get("text", "") for item in value)
+    return ""
+
+
+def decode_chunk(msg):
+    """
+    解析模型流式输出的一个消息分块
+    :return: (推理内容, 正文内容)，没有时为空字符串
+    """
+    content = msg.content
+    # DeepSeek 等通过 reasoning_content 字段返回推理内容
+    # 直接读取 pydantic 额外字段，避免缺失属性时 getattr 抛出并捕获异常的开销
+    extra = msg.__pydantic_extra__
+    reasoning = (extra and extra.get("reasoning_content")) or msg.additional_kwargs.get("reasoning_content")
+    reasoning = _join_reasoning(reasoning) if reasoning else ""
+
+    # 大部分模型的正文是字符串，直接返回
+    if type(content) is str:
+        return reasoning, content
+
+    # Claude、OpenAI 推理模型等返回内容块列表
+    text = ""
+    for block in content:
+        if type(block) is str:
+            text += block
+            continue
+        decoder = _BLOCK_DECODERS.get(block.get("type"))
+        if decoder is None:
+            continue
+        block_reasoning, block_text = decoder(block)
+        if block_reasoning:
+            reasoning += block_reasoning
+        if block_text:
+            text += block_text
+    return reasoning, text
+
+
+class ChunkDecoder:
+    """
+    把智能体 astream(stream_mode="messages") 的输出转换为文本增量
+    推理内容包裹在 ::: reasoning 块中，正文开始后不再输出推理内容
+    """
+    def __init__(self):
+        self.has_reasoning = False
+        self.is_response = False
+
+    def feed(self, msg, metadata):
+        """
+        处理一个 (消息, 元数据) 分块
+        :return: 需要追加到响应中的文本
+        """
+        if "skip_stream" in metadata.get("tags", []):
+            return ""
+        # For some reason, astream("messages") causes non-LLM nodes to send extra messages.
+        # Drop them.
+        if not isinstance(msg, AIMessageChunk):
+            return ""
+
+        reasoning, content = decode_chunk(msg)
+        text = ""
+        if reasoning and not self.is_response:
+            if not self.has_reasoning:
+                text += REASONING_START
+                self.has_reasoning = True
+            text += reasoning
+        if content:
+            if self.has_reasoning:
+                text += REASONING_END
+                self.has_reasoning = False
+            self.is_response = True
+            text += content
+        return text
@@ -0,0 +1,152 @@
+import json
+import logging
+
+from .config import STORAGE_SERIALIZER, STORAGE_COMPRESSION, STORAGE_COMPRESS_MIN_SIZE, STORAGE_COMPRESS_LEVEL
+
+logger = logging.getLogger("ai")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 编码后的值以 0 字节开头，后面一个字节表示格式；旧版本的 JSON 文本不会以 0 字节开头
+_MAGIC = b"\x00"
+_FORMAT_JSON = b"j"
+_FORMAT_MSGPACK = b"m"
+# zstd 压缩：后面是压缩后的完整编码值（使用字典时字典 id 记录在 zstd 帧头中）
+_FORMAT_ZSTD = b"z"
+
+
+class UnknownDictionaryError(Exception):
+    """压缩值使用的字典尚未加载"""
+    def __init__(self, dict_id):
+        super().__init__(f"Unknown zstd dictionary: {dict_id}")
+        self.dict_id = dict_id
+
+
+class StorageCodec:
+    """
+    Redis 存储编码
+    - 序列化：json（不转义中文）、orjson、msgpack；orjson 未安装时使用 json，
+      msgpack 未安装时直接报错（其他进程写入的 msgpack 值在这个进程中无法读取）
+    - 压缩：超过 compress_min_size 字节时使用 zstd 压缩，可以使用训练的字典提高短文本的压缩率
+    - 读取时根据前缀识别格式，旧版本的 JSON 文本可以直接读取
+    """
+    def __init__(self, serializer=STORAGE_SERIALIZER, compression=STORAGE_COMPRESSION,
+                 compress_min_size=STORAGE_COMPRESS_MIN_SIZE, compress_level=STORAGE_COMPRESS_LEVEL):
+        """
+        :param serializer: 序列化格式 json / orjson / msgpack
+        :param compression: 是否启用 zstd 压缩（需要安装 zstandard）
+        :param compress_min_size: 启用压缩的最小字节数
+        :param compress_level: 压缩级别
+        """
+        if serializer == "msgpack" and msgpack is None:
+            raise RuntimeError("STORAGE_SERIALIZER is msgpack but msgpack is not installed")
+        if serializer == "orjson" and orjson is None:
+            logger.warning("orjson is not installed, falling back to json")
+            serializer = "json"
+        self.serializer = serializer
+        self.compression = compression and zstandard is not None
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        # 字典 id -> 字典，当前用于压缩的字典 id
+        self.dictionaries = {}
+        self.dictionary_id = None
+        self.compressors = {}
+        self.decompressors = {}
+
+    def dumps(self, value, compress=True):
+        """
+        编码为字节串
+        :param compress: 是否允许压缩
+        """
+        if self.serializer == "msgpack":
+            data = _MAGIC + _FORMAT_MSGPACK + msgpack.packb(value, use_bin_type=True)
+        elif self.serializer == "orjson":
+            data = _MAGIC + _FORMAT_JSON + orjson.dumps(value)
+        else:
+            data = _MAGIC + _FORMAT_JSON + json.dumps(value, ensure_ascii=False).encode("utf-8")
+        if compress and self.compression and len(data) >= self.compress_min_size:
+            compressed = self._compressor(self.dictionary_id).compress(data)
+            if len(compressed) + 2 < len(data):
+                return _MAGIC + _FORMAT_ZSTD + compressed
+        return data
+
+    def loads(self, data):
+        """
+        从字节串解码，支持旧版本的 JSON 文本
+        :raises UnknownDictionaryError: 压缩使用的字典尚未加载
+        """
+        if isinstance(data, str):
+            return json.loads(data)
+        if not data.startswith(_MAGIC):
+            return json.loads(data)
+        fmt, body = data[1:2], data[2:]
+        if fmt == _FORMAT_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstandard is not installed")
+            dict_id = zstandard.get_frame_parameters(body).dict_id
+            return self.loads(self._decompressor(dict_id).decompress(body))
+        if fmt == _FORMAT_MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("msgpack is not installed")
+            return msgpack.unpackb(body, raw=False)
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+
+    def add_dictionary(self, data, current=False):
+        """
+        加载压缩字典
+        :param data: 字典内容
+        :param current: 是否用于之后的压缩
+        :return: 字典 id
+        """
+        dictionary = zstandard.ZstdCompressionDict(data)
+        dict_id = dictionary.dict_id()
+        self.dictionaries[dict_id] = dictionary
+        if current:
+            self.dictionary_id = dict_id
+        return dict_id
+
+    def train_dictionary(self, samples, size):
+        """
+        使用样本训练压缩字典
+        :param samples: 编码后（未压缩）的样本
+        :param size: 字典大小（字节）
+        :return: 字典内容
+        """
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    def _compressor(self, dict_id):
+        compressor = self.compressors.get(dict_id)
+        if compressor is None:
+            kwargs = {"level": self.compress_level}
+            if dict_id:
+                kwargs["dict_data"] = self.dictionaries[dict_id]
+            compressor = self.compressors[dict_id] = zstandard.ZstdCompressor(**kwargs)
+        return compressor
+
+    def _decompressor(self, dict_id):
+        decompressor = self.decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id and dict_id not in self.dictionaries:
+                raise UnknownDictionaryError(dict_id)
+            kwargs = {"dict_data": self.dictionaries[dict_id]} if dict_id else {}
+            decompressor = self.decompressors[dict_id] = zstandard.ZstdDecompressor(**kwargs)
+        return decompressor
+
+
+# 进程内共享的存储编码
+storage_codec = StorageCodec()
@@ -48,3 +48,131 @@ END_CONVERSATION_MARK = "<!--::END_CHAT::-->"
 
 # 流式响应超时时间
 STREAM_TIMEOUT = 300
+
+# 流式响应模式：push（Redis 发布订阅推送）或 poll（轮询缓存）
+STREAM_MODE = os.environ.get('STREAM_MODE', 'push').strip().lower()
+
+# 生产者租约有效期（秒），生产者每隔三分之一有效期续约一次，租约过期后其他工作进程可以接管
+PRODUCER_LEASE_TTL = int(os.environ.get('PRODUCER_LEASE_TTL', 6))
+
+# 消费者检查生产者租约的间隔（秒）
+PRODUCER_CHECK_INTERVAL = 2
+
+# 生产者中断后最多重新生成的次数，超过后直接结束并返回错误
+PRODUCER_MAX_RESTARTS = 1
+
+# 预先生成：/chat 收到消息后立即在后台开始生成，不等待第一个客户端连接 /stream
+STREAM_EAGER = os.environ.get('STREAM_EAGER', 'false').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# 服务端内部访问 MCP 的地址（预先生成时没有客户端请求的 Host 可用）
+MCP_SERVER_URL = os.environ.get('MCP_SERVER_URL', 'http://nginx/apps/mcp_server/mcp')
+
+# MCP 工具列表缓存有效期（秒），为 0 时不缓存
+MCP_TOOLS_CACHE_TTL = int(os.environ.get('MCP_TOOLS_CACHE_TTL', 300))
+
+# MCP 工具列表缓存的最大条目数（按 MCP 地址和用户 token 缓存）
+MCP_TOOLS_CACHE_SIZE = int(os.environ.get('MCP_TOOLS_CACHE_SIZE', 256))
+
+# MCP 持久会话池：最多同时保持的会话数（按 MCP 地址和用户 token 各一个会话）
+MCP_SESSION_POOL_SIZE = int(os.environ.get('MCP_SESSION_POOL_SIZE', 64))
+
+# MCP 空闲会话的保持时间（秒）
+MCP_SESSION_IDLE_TIMEOUT = int(os.environ.get('MCP_SESSION_IDLE_TIMEOUT', 120))
+
+# 单个 MCP 工具调用的超时时间（秒），超时后返回错误结果给模型，为 0 时不限制
+MCP_TOOL_TIMEOUT = int(os.environ.get('MCP_TOOL_TIMEOUT', 30))
+
+# 按工具名配置的超时时间，格式：工具名:秒数,工具名:秒数
+MCP_TOOL_TIMEOUTS = {
+    name.strip(): int(seconds)
+    for name, _, seconds in (
+        item.partition(':') for item in os.environ.get('MCP_TOOL_TIMEOUTS', '').split(',') if ':' in item
+    )
+}
+
+# 只读 MCP 工具结果的缓存时间（秒），为 0 时不缓存
+MCP_TOOL_RESULT_TTL = int(os.environ.get('MCP_TOOL_RESULT_TTL', 10))
+
+# 只读 MCP 工具的名称前缀（MCP 标注了 readOnlyHint 的工具也视为只读）
+MCP_READ_TOOL_PREFIXES = tuple(
+    prefix.strip() for prefix in os.environ.get('MCP_READ_TOOL_PREFIXES', 'get_,list_,search_').split(',') if prefix.strip()
+)
+
+# 模型实例缓存的最大实例数（相同配置的请求复用实例和连接），为 0 时不缓存
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 64))
+
+# 空闲模型实例的保持时间（秒）
+MODEL_CACHE_IDLE_TIMEOUT = int(os.environ.get('MODEL_CACHE_IDLE_TIMEOUT', 600))
+
+# 模型服务 HTTP 客户端：安装了 h2 时启用 HTTP/2
+HTTP2_ENABLED = os.environ.get('HTTP2_ENABLED', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# 模型服务 HTTP 连接池：最大连接数、最大保持连接数、空闲连接保持时间（秒）
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 1000))
+HTTP_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_KEEPALIVE_CONNECTIONS', 100))
+HTTP_KEEPALIVE_EXPIRY = int(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 60))
+
+# 编译后的智能体缓存的最大数量，为 0 时不缓存
+AGENT_CACHE_SIZE = int(os.environ.get('AGENT_CACHE_SIZE', 128))
+
+# DooTask 回调连接池：每个 server_url 的最大连接数和最大保持连接数
+CALLBACK_MAX_CONNECTIONS = int(os.environ.get('CALLBACK_MAX_CONNECTIONS', 100))
+CALLBACK_KEEPALIVE_CONNECTIONS = int(os.environ.get('CALLBACK_KEEPALIVE_CONNECTIONS', 20))
+
+# 回调发件箱：每个 server_url 同时发送的回调数
+CALLBACK_SERVER_CONCURRENCY = int(os.environ.get('CALLBACK_SERVER_CONCURRENCY', 8))
+
+# 回调发件箱：最多尝试次数（指数退避重试），超过后放弃
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get('CALLBACK_MAX_ATTEMPTS', 8))
+
+# 回调发件箱：重试的初始间隔和最大间隔（秒）
+CALLBACK_RETRY_BASE = 1
+CALLBACK_RETRY_MAX = 60
+
+# 回调发件箱：领取任务后的租约时间（秒），领取方在此时间内未结束时任务会被重新领取
+CALLBACK_LEASE = 60
+
+# 后台任务（生成等）同时运行的最大数量，超过时排队
+BACKGROUND_TASK_LIMIT = int(os.environ.get('BACKGROUND_TASK_LIMIT', 256))
+
+# 服务关闭时等待后台任务结束的时间（秒），超时后取消
+BACKGROUND_TASK_DRAIN_TIMEOUT = int(os.environ.get('BACKGROUND_TASK_DRAIN_TIMEOUT', 10))
+
+# token数量缓存的最大数量（按文本内容哈希），为 0 时不缓存
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get('TOKEN_COUNT_CACHE_SIZE', 4096))
+
+# 每个对话上下文最多保留的消息数量（写入时在 Redis 中截断），为 0 时不限制
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', 1000))
+
+# 读取上下文时每次从 Redis 读取的消息数量
+CONTEXT_PAGE_SIZE = int(os.environ.get('CONTEXT_PAGE_SIZE', 50))
+
+# 保存上下文时保留的token数量为模型上下文限制的倍数（超出时删除最早的消息），为 0 时不按token截断
+CONTEXT_TOKEN_HEADROOM = float(os.environ.get('CONTEXT_TOKEN_HEADROOM', 2))
+
+# 是否启用上下文滚动摘要：超出预算的早期消息在后台合并为摘要，请求时作为系统消息放在上下文前面
+CONTEXT_SUMMARY_ENABLED = os.environ.get('CONTEXT_SUMMARY_ENABLED', 'false').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# 启用摘要时保存的最新消息的token数量为模型上下文限制的比例，更早的消息合并到摘要中
+CONTEXT_SUMMARY_RATIO = float(os.environ.get('CONTEXT_SUMMARY_RATIO', 0.5))
+
+# 摘要的最大token数量
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_MAX_TOKENS', 1000))
+
+# 输入和上下文的存储序列化格式：json / orjson / msgpack（orjson 未安装时使用 json，msgpack 未安装时启动报错）
+STORAGE_SERIALIZER = os.environ.get('STORAGE_SERIALIZER', 'orjson').strip().lower()
+
+# 是否使用 zstd 压缩存储的输入和上下文（需要安装 zstandard）
+STORAGE_COMPRESSION = os.environ.get('STORAGE_COMPRESSION', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# 启用压缩的最小字节数
+STORAGE_COMPRESS_MIN_SIZE = int(os.environ.get('STORAGE_COMPRESS_MIN_SIZE', 256))
+
+# zstd 压缩级别
+STORAGE_COMPRESS_LEVEL = int(os.environ.get('STORAGE_COMPRESS_LEVEL', 3))
+
+# token计算线程数
+TOKENIZER_WORKERS = int(os.environ.get('TOKENIZER_WORKERS', 2))
+
+# 未缓存的文本超过该字符数时在线程池中计算token数量，避免阻塞事件循环
+TOKENIZER_OFFLOAD_CHARS = int(os.environ.get('TOKENIZER_OFFLOAD_CHARS', 20000))
@@ -0,0 +1,457 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.sessions import create_session
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, CallToolResult, TextContent
+
+from .config import (
+    MCP_TOOLS_CACHE_SIZE,
+    MCP_TOOLS_CACHE_TTL,
+    MCP_SESSION_POOL_SIZE,
+    MCP_SESSION_IDLE_TIMEOUT,
+    MCP_TOOL_TIMEOUT,
+    MCP_TOOL_TIMEOUTS,
+    MCP_TOOL_RESULT_TTL,
+    MCP_READ_TOOL_PREFIXES,
+)
+
+logger = logging.getLogger("ai")
+
+# MCP 服务在客户端配置中的名称
+MCP_SERVER_NAME = "dootask-task"
+
+# 服务端不认识会话时 MCP 客户端返回的错误码
+_SESSION_TERMINATED = 32600
+# 会话或连接本身失效的错误码（会话已终止、连接已关闭、请求超时），其他错误（如参数错误）不影响会话
+_SESSION_ERRORS = {_SESSION_TERMINATED, CONNECTION_CLOSED, 408}
+
+
+def mcp_connection(url, token):
+    """
+    MCP 服务连接配置
+    :param url: MCP 服务地址
+    :param token: 用户 token，通过请求头传给 MCP 服务
+    """
+    return {
+        "url": url,
+        "transport": "streamable_http",
+        "headers": {
+            "token": token or "unknown"
+        },
+    }
+
+
+async def load_mcp_tools(url, token):
+    """
+    从 MCP 服务获取工具列表（每次调用都会请求 MCP 服务）
+    工具调用依次经过：只读工具结果缓存 -> 单个工具超时 -> 会话池
+    同一轮的多个工具调用由智能体并发执行
+    """
+    read_tools = set()
+    client = MultiServerMCPClient(
+        {MCP_SERVER_NAME: mcp_connection(url, token)},
+        tool_interceptors=[
+            tool_result_cache.interceptor(url, token, read_tools),
+            tool_timeout_interceptor,
+            mcp_session_pool.interceptor(url, token),
+        ],
+    )
+    tools = await client.get_tools()
+    read_tools.update(tool.name for tool in tools if is_read_tool(tool))
+    return tools
+
+
+def is_read_tool(tool):
+    """是否为只读工具：MCP 标注了 readOnlyHint，或名称以只读前缀开头（如 get_、list_）"""
+    return bool((tool.metadata or {}).get("readOnlyHint")) or tool.name.startswith(MCP_READ_TOOL_PREFIXES)
+
+
+def tool_error_result(text):
+    """工具执行失败的结果，返回给模型而不是中断整个对话"""
+    return CallToolResult(content=[TextContent(type="text", text=text)], isError=True)
+
+
+async def tool_timeout_interceptor(request, handler):
+    """
+    单个工具调用超时，超时后返回错误结果，不再阻塞整个流
+    超时时间按工具名配置（MCP_TOOL_TIMEOUTS），未配置时使用 MCP_TOOL_TIMEOUT
+    """
+    timeout = MCP_TOOL_TIMEOUTS.get(request.name, MCP_TOOL_TIMEOUT)
+    if timeout <= 0:
+        return await handler(request)
+    try:
+        return await asyncio.wait_for(handler(request), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"MCP tool timeout: {request.name} ({timeout}s)")
+        return tool_error_result(f"Tool {request.name} timed out after {timeout}s")
+
+
+class ToolResultCache:
+    """
+    只读工具的短期结果缓存，按 (MCP 地址, 用户 token, 工具名, 参数) 缓存
+    同一用户调用了非只读工具（可能修改了数据）时清除该用户的缓存，
+    清除前已开始的只读调用的结果不再写入缓存（可能是修改前的数据）
+    """
+    def __init__(self, ttl=MCP_TOOL_RESULT_TTL, maxsize=1024):
+        """
+        :param ttl: 缓存有效期（秒），为 0 时不缓存
+        :param maxsize: 最多缓存的结果数
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # 清除序号：每次清除递增，记录每个用户最后一次清除时的序号
+        self.sequence = 0
+        self.invalidated = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def interceptor(self, url, token, read_tools):
+        """
+        工具调用拦截器
+        :param read_tools: 只读工具名集合（工具列表加载后填充）
+        """
+        async def intercept(request, handler):
+            if self.ttl <= 0:
+                return await handler(request)
+            if request.name not in read_tools:
+                # 执行前后都清除，执行期间开始的只读调用也不会写入缓存
+                self.invalidate(url, token)
+                try:
+                    return await handler(request)
+                finally:
+                    self.invalidate(url, token)
+            key = (url, token, request.name, json.dumps(request.args, sort_keys=True, ensure_ascii=False, default=str))
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+            sequence = self.sequence
+            result = await handler(request)
+            if not result.isError and self.invalidated.get((url, token), 0) <= sequence:
+                self.entries[key] = (time.monotonic() + self.ttl, result)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return result
+        return intercept
+
+    def invalidate(self, url, token):
+        """清除某个用户的缓存结果"""
+        self.sequence += 1
+        self.invalidated[(url, token)] = self.sequence
+        self.invalidated.move_to_end((url, token))
+        while len(self.invalidated) > self.maxsize:
+            self.invalidated.popitem(last=False)
+        for key in [key for key in self.entries if key[0] == url and key[1] == token]:
+            del self.entries[key]
+
+    def stats(self):
+        """缓存统计"""
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class _PooledSession:
+    """
+    会话池中的一个持久会话
+    MCP 会话必须在同一个任务中进入和退出，由守护任务持有，关闭时通知守护任务退出
+    """
+    def __init__(self, key, connect):
+        self.key = key
+        self.session = None
+        self.error = None
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.ready = asyncio.Event()
+        self.closing = asyncio.Event()
+        self.task = asyncio.create_task(self._run(connect))
+
+    @property
+    def closed(self):
+        return self.closing.is_set() or self.task.done()
+
+    async def _run(self, connect):
+        try:
+            async with connect(mcp_connection(*self.key)) as session:
+                await session.initialize()
+                self.session = session
+                self.ready.set()
+                await self.closing.wait()
+        except Exception as e:
+            self.error = e
+            logger.error(f"MCP session error ({self.key[0]}): {str(e)}")
+        finally:
+            self.session = None
+            self.ready.set()
+
+    def close(self):
+        self.closing.set()
+
+
+class McpSessionPool:
+    """
+    MCP 持久会话池，按 (MCP 地址, 用户 token) 保持会话，工具调用之间复用
+    - 同一个键共用一个会话，并发的调用在会话内复用
+    - 会话总数超过上限时淘汰最久未使用的空闲会话，没有空闲会话时等待
+    - 空闲超过 idle_timeout 的会话自动关闭
+    - 会话或连接出错时丢弃，下次调用重新建立；工具返回的普通错误不影响会话
+    """
+    def __init__(self, max_sessions=MCP_SESSION_POOL_SIZE, idle_timeout=MCP_SESSION_IDLE_TIMEOUT, connect=create_session):
+        """
+        :param max_sessions: 最多同时保持的会话数
+        :param idle_timeout: 空闲会话的保持时间（秒）
+        :param connect: 建立会话的异步上下文管理器，参数为连接配置
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.connect = connect
+        self.sessions = OrderedDict()
+        self.released = None
+        self.waiting = 0
+        self.reaper = None
+        self.notify_task = None
+        self.created = 0
+        self.reused = 0
+
+    def interceptor(self, url, token):
+        """
+        工具调用拦截器：通过会话池执行工具调用，代替每次调用新建会话
+        拦截器修改了请求头时按原方式处理
+        """
+        async def intercept(request, handler):
+            if request.headers:
+                return await handler(request)
+            return await self.call_tool(url, token, request.name, request.args)
+        return intercept
+
+    async def call_tool(self, url, token, name, arguments):
+        """
+        使用池中的会话调用工具
+        服务端已不认识会话（如 MCP 服务重启）时请求没有被执行，换新会话重试一次
+        """
+        for attempt in range(2):
+            pooled = await self._acquire((url, token))
+            try:
+                return await pooled.session.call_tool(name, arguments)
+            except McpError as e:
+                if e.error.code not in _SESSION_ERRORS:
+                    raise
+                self._discard(pooled)
+                if attempt or e.error.code != _SESSION_TERMINATED:
+                    raise
+            except Exception:
+                # 连接断开等会话异常时丢弃会话
+                self._discard(pooled)
+                raise
+            finally:
+                self._release(pooled)
+
+    async def close(self):
+        """关闭全部会话（服务关闭时调用）"""
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for pooled in sessions:
+            pooled.close()
+        if sessions:
+            await asyncio.wait([pooled.task for pooled in sessions], timeout=5)
+
+    def stats(self):
+        """会话池统计"""
+        return {
+            "sessions": len(self.sessions),
+            "in_use": sum(1 for pooled in self.sessions.values() if pooled.in_use),
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+    async def _acquire(self, key):
+        if self.released is None:
+            self.released = asyncio.Condition()
+        self._start_reaper()
+        while True:
+            pooled = self.sessions.get(key)
+            if pooled and not pooled.closed:
+                self.sessions.move_to_end(key)
+                self.reused += 1
+                break
+            if pooled:
+                self._discard(pooled)
+            if len(self.sessions) < self.max_sessions or self._evict_idle():
+                pooled = _PooledSession(key, self.connect)
+                self.sessions[key] = pooled
+                self.created += 1
+                break
+            # 会话数已满且都在使用中，等待释放
+            self.waiting += 1
+            try:
+                async with self.released:
+                    await self.released.wait()
+            finally:
+                self.waiting -= 1
+        pooled.in_use += 1
+        try:
+            await pooled.ready.wait()
+        except BaseException:
+            self._release(pooled)
+            raise
+        if pooled.session is None:
+            self._discard(pooled)
+            self._release(pooled)
+            raise pooled.error or ConnectionError("MCP session closed")
+        return pooled
+
+    def _release(self, pooled):
+        pooled.in_use -= 1
+        pooled.last_used = time.monotonic()
+        if self.waiting and (self.notify_task is None or self.notify_task.done()):
+            self.notify_task = asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self.released:
+            self.released.notify_all()
+
+    def _discard(self, pooled):
+        if self.sessions.get(pooled.key) is pooled:
+            del self.sessions[pooled.key]
+        pooled.close()
+
+    def _evict_idle(self):
+        """淘汰最久未使用的空闲会话，没有空闲会话时返回 False"""
+        for pooled in self.sessions.values():
+            if not pooled.in_use:
+                self._discard(pooled)
+                return True
+        return False
+
+    def _start_reaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        """定时关闭空闲超时的会话"""
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            deadline = time.monotonic() - self.idle_timeout
+            for pooled in list(self.sessions.values()):
+                if not pooled.in_use and pooled.last_used < deadline:
+                    self._discard(pooled)
+
+
+class _CatalogEntry:
+    __slots__ = ("tools", "loaded_at")
+
+    def __init__(self, tools, loaded_at):
+        self.tools = tools
+        self.loaded_at = loaded_at
+
+
+class ToolCatalogCache:
+    """
+    MCP 工具列表缓存，按 (MCP 地址, 用户 token) 缓存
+    工具对象不持有会话，可以在请求之间复用
+    - 超过有效期一半时先返回缓存，同时在后台刷新
+    - 超过有效期后等待重新获取
+    - 同一个键同时只有一个获取请求，并发的请求共享结果
+    - 超过容量时淘汰最久未使用的条目
+    - 条目被替换或删除时通知监听者（如智能体缓存），参数为旧的工具列表
+    """
+    def __init__(self, loader=load_mcp_tools, maxsize=MCP_TOOLS_CACHE_SIZE, ttl=MCP_TOOLS_CACHE_TTL):
+        """
+        :param loader: 获取工具列表的协程函数，参数为 (url, token)
+        :param maxsize: 最多缓存的条目数
+        :param ttl: 缓存有效期（秒），为 0 时不缓存
+        """
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    async def get_tools(self, url, token):
+        """获取工具列表，优先使用缓存"""
+        if self.ttl <= 0:
+            return await self.loader(url, token)
+        key = (url, token)
+        entry = self.entries.get(key)
+        if entry:
+            age = time.monotonic() - entry.loaded_at
+            if age < self.ttl:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                if age >= self.ttl / 2 and key not in self.pending:
+                    self.refreshes += 1
+                    self._load(key)
+                return entry.tools
+        self.misses += 1
+        return await asyncio.shield(self.pending.get(key) or self._load(key))
+
+    def invalidate(self, url=None, token=None):
+        """删除缓存，不传参数时清空全部"""
+        if url is None and token is None:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        else:
+            entries = [self.entries.pop((url, token), None)]
+        for entry in entries:
+            self._notify(entry)
+
+    def stats(self):
+        """缓存统计"""
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+    def _load(self, key):
+        """启动一次获取，结果写入缓存"""
+        task = asyncio.ensure_future(self._fetch(key))
+        self.pending[key] = task
+        # 后台刷新失败时没有等待方，这里读取异常避免未处理异常的警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _fetch(self, key):
+        try:
+            tools = await self.loader(*key)
+        except Exception as e:
+            logger.error(f"Load MCP tools error ({key[0]}): {str(e)}")
+            raise
+        finally:
+            self.pending.pop(key, None)
+        self._notify(self.entries.get(key))
+        self.entries[key] = _CatalogEntry(tools, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self._notify(self.entries.popitem(last=False)[1])
+        return tools
+
+    def _notify(self, entry):
+        if entry is None:
+            return
+        for listener in self.listeners:
+            try:
+                listener(entry.tools)
+            except Exception as e:
+                logger.error(f"MCP tools listener error: {str(e)}")
+
+
+# 进程内共享的 MCP 会话池、工具结果缓存和工具列表缓存
+mcp_session_pool = McpSessionPool()
+tool_result_cache = ToolResultCache()
+mcp_tools_cache = ToolCatalogCache()
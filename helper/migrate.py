@@ -0,0 +1,43 @@
+"""
+存储编码迁移：将 Redis 中已保存的输入和上下文改写为当前的存储编码
+用法：python -m helper.migrate [--train] [--dict-size 65536] [--samples 2000]
+"""
+import argparse
+import asyncio
+import logging
+
+from .redis import RedisManager
+
+logger = logging.getLogger("ai")
+
+
+async def migrate(train=False, dict_size=65536, samples=2000):
+    """
+    迁移存储编码
+    :param train: 是否先使用已保存的数据训练压缩字典
+    :param dict_size: 字典大小（字节）
+    :param samples: 训练使用的最多样本数量
+    """
+    redis_manager = RedisManager()
+    await redis_manager.load_codec_dictionaries()
+    if train:
+        dict_id = await redis_manager.train_codec_dictionary(dict_size, samples)
+        if dict_id:
+            logger.info(f"✅ 压缩字典已保存: {dict_id}")
+    stats = await redis_manager.migrate_storage()
+    logger.info(f"✅ 迁移完成: {stats}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将 Redis 中的输入和上下文改写为当前的存储编码")
+    parser.add_argument("--train", action="store_true", help="先使用已保存的数据训练 zstd 压缩字典")
+    parser.add_argument("--dict-size", type=int, default=65536, help="字典大小（字节）")
+    parser.add_argument("--samples", type=int, default=2000, help="训练使用的最多样本数量")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate(args.train, args.dict_size, args.samples))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+
+from .config import (
+    CALLBACK_SERVER_CONCURRENCY,
+    CALLBACK_MAX_ATTEMPTS,
+    CALLBACK_RETRY_BASE,
+    CALLBACK_RETRY_MAX,
+    CALLBACK_LEASE,
+)
+from .redis import RedisManager
+from .request import CallbackError, RequestClient
+from .tasks import task_supervisor
+
+logger = logging.getLogger("ai")
+
+
+class CallbackOutbox:
+    """
+    DooTask 回调发件箱
+    回调先写入 Redis，由每个工作进程的后台分发器领取发送：
+    - 失败时按指数退避重试，不可重试的错误（如 4xx）直接放弃
+    - 每个 server_url 限制同时发送的数量
+    - 同一 update_id 的更新消息合并，只发送最新内容
+    - 发送方崩溃时，租约到期后任务由其他工作进程重新领取
+    """
+    def __init__(self, concurrency=CALLBACK_SERVER_CONCURRENCY, max_attempts=CALLBACK_MAX_ATTEMPTS,
+                 batch_size=50, poll_interval=1):
+        """
+        :param concurrency: 每个 server_url 同时发送的数量
+        :param max_attempts: 最多尝试次数
+        :param batch_size: 单个工作进程同时处理的最大任务数
+        :param poll_interval: 没有本地入队通知时检查到期任务的间隔（秒）
+        """
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.semaphores = {}
+        self.tasks = set()
+        self.wakeup = None
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    @staticmethod
+    def job_id(server_url, data):
+        """更新消息按 (server_url, update_id) 合并，其他回调各自独立"""
+        if data.get("update_id"):
+            return f"update:{server_url}:{data['update_id']}"
+        return uuid.uuid4().hex
+
+    async def enqueue(self, request_client, data, action=None):
+        """
+        回调入队
+        :param request_client: 请求客户端（提供 server_url、version、token、dialog_id）
+        :param data: 请求数据
+        :param action: 请求动作，默认使用 request_client 的动作
+        """
+        job = {
+            "server_url": request_client.server_url,
+            "version": request_client.version,
+            "token": request_client.token,
+            "dialog_id": request_client.dialog_id,
+            "action": action or request_client.action,
+            "data": data,
+        }
+        payload = json.dumps(job, sort_keys=True, ensure_ascii=False)
+        try:
+            await RedisManager().enqueue_callback(self.job_id(job["server_url"], data), payload, time.time())
+        except Exception as e:
+            # Redis 不可用时直接发送
+            logger.error(f"Enqueue callback error: {str(e)}")
+            task_supervisor.spawn(request_client.call(data, action=job["action"]), name="callback")
+            return
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self):
+        """后台分发器，在服务启动时运行"""
+        self.wakeup = asyncio.Event()
+        redis_manager = RedisManager()
+        while True:
+            try:
+                # 先清除通知再领取，领取期间入队的任务会在下一轮立即领取
+                self.wakeup.clear()
+                capacity = self.batch_size - len(self.tasks)
+                if capacity > 0:
+                    now = time.time()
+                    jobs = await redis_manager.claim_callbacks(now, capacity, now + CALLBACK_LEASE)
+                    for job_id, payload, attempts in jobs:
+                        self._spawn(self._dispatch(redis_manager, job_id, payload, attempts))
+                # 等待入队、发送结束或下一次检查
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Callback dispatcher error: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def close(self, timeout=5):
+        """等待发送中的回调结束（服务关闭时调用），未完成的任务留在 Redis 中由其他进程继续发送"""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    def stats(self):
+        """发件箱统计"""
+        return {
+            "sending": len(self.tasks),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        # 有任务结束时唤醒分发器领取更多任务
+        if self.wakeup:
+            self.wakeup.set()
+
+    def _semaphore(self, server_url):
+        semaphore = self.semaphores.get(server_url)
+        if semaphore is None:
+            semaphore = self.semaphores[server_url] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def _dispatch(self, redis_manager, job_id, payload, attempts):
+        job = json.loads(payload)
+        request_client = RequestClient(job["server_url"], job["version"], job["token"], job["dialog_id"], job["action"])
+        try:
+            async with self._semaphore(job["server_url"]):
+                await request_client.send(job["data"])
+        except Exception as e:
+            attempts += 1
+            retryable = e.retryable if isinstance(e, CallbackError) else True
+            if retryable and attempts < self.max_attempts:
+                delay = min(CALLBACK_RETRY_MAX, CALLBACK_RETRY_BASE * 2 ** (attempts - 1))
+                delay *= random.uniform(0.8, 1.2)
+                logger.warning(f"Callback failed, retry in {delay:.1f}s ({job_id}): {str(e)}")
+                self.retried += 1
+                await redis_manager.finish_callback(job_id, payload, time.time(), time.time() + delay, attempts)
+                return
+            logger.error(f"Callback dropped after {attempts} attempts ({job_id}): {str(e)}")
+            self.dropped += 1
+        else:
+            self.sent += 1
+        await redis_manager.finish_callback(job_id, payload, time.time())
+
+
+# 进程内共享的回调发件箱
+callback_outbox = CallbackOutbox()
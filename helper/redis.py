@@ -1,10 +1,29 @@
 import redis.asyncio as redis
+import bisect
+import functools
+import hashlib
+import itertools
 import json
+import logging
 import os
 import re
+import threading
 import tiktoken
+from collections import OrderedDict
 from typing import List, Tuple
 
+from .codec import storage_codec, UnknownDictionaryError
+from .config import (
+    TOKEN_COUNT_CACHE_SIZE,
+    CONTEXT_MAX_MESSAGES,
+    CONTEXT_PAGE_SIZE,
+    CONTEXT_TOKEN_HEADROOM,
+    CONTEXT_SUMMARY_ENABLED,
+    CONTEXT_SUMMARY_RATIO,
+)
+
+logger = logging.getLogger("ai")
+
 # 提前加载所需的编码
 tiktoken.get_encoding("o200k_base")
 tiktoken.get_encoding("cl100k_base")
@@ -54,28 +73,127 @@ CONTEXT_LIMITS = {
     }
 }
 
-def count_tokens(text: str, model_type: str, model_name: str) -> int:
-    """计算文本的token数量"""
-    if not text:
-        return 0
-
-    # 默认使用cl100k_base编码
-    encoding_name = "cl100k_base"
-    
+@functools.lru_cache(maxsize=256)
+def get_encoding(model_type: str, model_name: str):
+    """获取模型使用的 tiktoken 编码（按模型缓存，只解析一次）"""
     # 根据模型类型选择合适的编码
     if model_type == "openai":
         try:
             # 对OpenAI模型尝试获取特定的编码
-            encoding = tiktoken.encoding_for_model(model_name)
-            return len(encoding.encode(text))
+            return tiktoken.encoding_for_model(model_name)
         except KeyError:
             # 如果失败，使用默认编码
             pass
-    
+
     # 对于deepseek模型和所有其他情况（包括OpenAI模型编码获取失败）
     # 使用默认的cl100k_base编码
-    encoding = tiktoken.get_encoding(encoding_name)
-    return len(encoding.encode(text))
+    return tiktoken.get_encoding("cl100k_base")
+
+class TokenCountCache:
+    """
+    token数量缓存，按 (编码, 文本内容哈希) 缓存计算结果，超过容量时淘汰最久未使用的
+    重复出现的文本（如每次请求相同的系统消息）不必重新编码
+    """
+    def __init__(self, maxsize=TOKEN_COUNT_CACHE_SIZE):
+        """
+        :param maxsize: 最大缓存数量，为 0 时不缓存
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, encoding, text):
+        """
+        获取文本的token数量
+        :param encoding: tiktoken 编码
+        :param text: 文本
+        """
+        if self.maxsize <= 0:
+            return len(encoding.encode(text))
+        key = self.make_key(encoding, text)
+        tokens = self.get(key)
+        if tokens is None:
+            tokens = len(encoding.encode(text))
+            self.put(key, tokens)
+        return tokens
+
+    @staticmethod
+    def make_key(encoding, text):
+        """缓存键：(编码名称, 文本内容哈希)"""
+        return encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key):
+        """获取缓存的token数量，未缓存时返回 None"""
+        with self.lock:
+            tokens = self.entries.get(key)
+            if tokens is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+            return None
+
+    def put(self, key, tokens):
+        """缓存token数量"""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = tokens
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """缓存统计"""
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+# 进程内共享的token数量缓存
+token_count_cache = TokenCountCache()
+
+def count_tokens(text: str, model_type: str, model_name: str) -> int:
+    """计算文本的token数量"""
+    if not text:
+        return 0
+    return token_count_cache.count(get_encoding(model_type, model_name), text)
+
+def message_tokens(message: dict, model_type: str, model_name: str) -> int:
+    """
+    获取上下文消息的token数量，优先使用保存时记录的数量（按编码区分）
+    :param message: 上下文消息字典
+    """
+    encoding_name = get_encoding(model_type, model_name).name
+    tokens = (message.get("tokens") or {}).get(encoding_name)
+    if isinstance(tokens, int):
+        return tokens
+    return count_tokens(message.get("content"), model_type, model_name)
+
+def context_message_tokens(message: dict, model_type: str, model_name: str) -> int:
+    """上下文消息的token数量，用于写入时截断（没有模型信息时为 0，不按token截断）"""
+    if not model_type:
+        return 0
+    return message_tokens(message, model_type, model_name)
+
+def with_token_counts(messages: list, model_type: str, model_name: str) -> list:
+    """
+    为上下文消息字典记录token数量，读取时不必重新计算
+    :param messages: 上下文消息字典列表
+    """
+    if not model_type:
+        return messages
+    encoding_name = get_encoding(model_type, model_name).name
+    for message in messages:
+        tokens = message.setdefault("tokens", {})
+        if encoding_name not in tokens:
+            tokens[encoding_name] = count_tokens(message.get("content"), model_type, model_name)
+    return messages
 
 def model_limit(model_type: str, model_name: str) -> int:
     """获取模型token限制"""
@@ -84,53 +202,266 @@ def model_limit(model_type: str, model_name: str) -> int:
         return model_limits.get(model_name, model_limits.get('default', 4096))
     return 4096
 
-def handle_context_limits(pre_context: list, middle_context: list, end_context: list, model_type: str = None, model_name: str = None, custom_limit: int = None) -> List[Tuple[str, str]]:
-    """处理上下文，确保不超过模型token限制"""
-    all_context = pre_context + middle_context + end_context
-    if not all_context:
-        return []
-    # 获取token限制
+def context_token_limit(model_type: str, model_name: str, custom_limit: int = None) -> int:
+    """获取上下文token限制，优先使用自定义限制"""
     if custom_limit and custom_limit > 0:
-        token_limit = custom_limit
-    else:
-        token_limit = model_limit(model_type, model_name)
-    # 按优先级处理上下文
-    result = []
-    current_tokens = 0
-
-    # 1. 首先添加 end_context（最高优先级）
-    for msg in end_context:
-        msg_tokens = count_tokens(msg.content, model_type, model_name)
-        if current_tokens + msg_tokens <= token_limit:
-            result.append(msg)
-            current_tokens += msg_tokens
-        else:
-            # 如果连 end_context 都放不下，直接返回能放下的部分
-            return result
-    # 2. 其次添加 pre_context（第二优先级）
-    for msg in pre_context:
-        msg_tokens = count_tokens(msg.content, model_type, model_name)
-        if current_tokens + msg_tokens <= token_limit:
-            result.insert(len(result) - len(end_context), msg)
-            current_tokens += msg_tokens
-        else:
-            break
+        return custom_limit
+    return model_limit(model_type, model_name)
+
+def context_token_budget(model_type: str, model_name: str, custom_limit: int = None) -> int:
+    """
+    保存上下文时保留的最大token数量：上下文token限制乘以 CONTEXT_TOKEN_HEADROOM（启用摘要时为 CONTEXT_SUMMARY_RATIO）
+    为 0 时不按token截断（没有模型信息或未启用）
+    """
+    if not model_type:
+        return 0
+    if CONTEXT_SUMMARY_ENABLED:
+        # 启用摘要时，更早的消息合并到摘要中
+        return int(context_token_limit(model_type, model_name, custom_limit) * CONTEXT_SUMMARY_RATIO)
+    if CONTEXT_TOKEN_HEADROOM <= 0:
+        return 0
+    return int(context_token_limit(model_type, model_name, custom_limit) * CONTEXT_TOKEN_HEADROOM)
+
+def select_context(pre_tokens: list, middle_sums: list, end_tokens: list, token_limit: int) -> Tuple[int, int, int]:
+    """
+    按优先级选择上下文：end_context > pre_context > middle_context（从最新的消息开始）
+    middle_context 使用累计token数量二分查找截断位置，不必逐条累加
+    :param pre_tokens: pre_context 每条消息的token数量
+    :param middle_sums: middle_context 的累计token数量（第 i 项为前 i+1 条消息的总数）
+    :param end_tokens: end_context 每条消息的token数量
+    :param token_limit: token限制
+    :return: (保留的 pre_context 前缀数量, 保留的 middle_context 起始位置, 保留的 end_context 前缀数量)
+    """
+    # 1. 首先添加 end_context（最高优先级），放不下时只保留能放下的部分
+    remaining = token_limit
+    for end_count, msg_tokens in enumerate(end_tokens):
+        if msg_tokens > remaining:
+            return 0, len(middle_sums), end_count
+        remaining -= msg_tokens
 
-    # 3. 最后添加 middle_context（最低优先级）
-    # 从最新的消息开始添加，保存到临时列表中
-    temp_middle = []
-    for msg in reversed(middle_context):
-        msg_tokens = count_tokens(msg.content, model_type, model_name)
-        if current_tokens + msg_tokens <= token_limit:
-            temp_middle.append(msg)
-            current_tokens += msg_tokens
-        else:
+    # 2. 其次添加 pre_context（第二优先级），按顺序添加直到放不下
+    pre_count = 0
+    for msg_tokens in pre_tokens:
+        if msg_tokens > remaining:
             break
-    
-    # 将收集到的 middle_context 按原始顺序插入
-    for msg in reversed(temp_middle):
-        result.insert(len(result) - len(end_context), msg)
-    return result
+        remaining -= msg_tokens
+        pre_count += 1
+
+    # 3. 最后添加 middle_context（最低优先级），保留总数不超过剩余数量的最新消息
+    # 起始位置 start 满足 total - middle_sums[start - 1] <= remaining
+    total = middle_sums[-1] if middle_sums else 0
+    if total <= remaining:
+        return pre_count, 0, len(end_tokens)
+    return pre_count, bisect.bisect_left(middle_sums, total - remaining) + 1, len(end_tokens)
+
+def handle_context_limits(pre_context: list, middle_context: list, end_context: list, model_type: str = None, model_name: str = None, custom_limit: int = None, middle_tokens: list = None) -> List[Tuple[str, str]]:
+    """
+    处理上下文，确保不超过模型token限制
+    :param middle_tokens: middle_context 每条消息的token数量（保存时记录的），为空时重新计算
+    """
+    if not (pre_context or middle_context or end_context):
+        return []
+    token_limit = context_token_limit(model_type, model_name, custom_limit)
+    if middle_tokens is None:
+        middle_tokens = [count_tokens(msg.content, model_type, model_name) for msg in middle_context]
+    return select_messages(
+        pre_context, middle_context, end_context,
+        [count_tokens(msg.content, model_type, model_name) for msg in pre_context],
+        middle_tokens,
+        [count_tokens(msg.content, model_type, model_name) for msg in end_context],
+        token_limit,
+    )
+
+def select_messages(pre_context: list, middle_context: list, end_context: list, pre_tokens: list, middle_tokens: list, end_tokens: list, token_limit: int) -> list:
+    """根据每条消息的token数量选择上下文消息（优先级见 select_context）"""
+    pre_count, middle_start, end_count = select_context(
+        pre_tokens, list(itertools.accumulate(middle_tokens)), end_tokens, token_limit
+    )
+    if end_count < len(end_context):
+        return end_context[:end_count]
+    return pre_context[:pre_count] + middle_context[middle_start:] + end_context
+
+# 上下文列表：KEYS 依次为消息列表、旧版本上下文、token数量列表、token总数、待摘要消息列表、待摘要消息的起始序号
+# 旧版本的上下文（整个 JSON 字符串）存在时返回 -1，token数量列表与消息不一致时返回 -2，由调用方处理后重试
+# 否则追加消息，再从最早的消息开始删除，直到不超过最大消息数 ARGV[1] 和最大token数 ARGV[2]（为 0 时不限制）
+# ARGV[3] 为 1 时删除的消息放入待摘要消息列表（超过最大消息数时丢弃最早的，起始序号随之增加）
+# ARGV[4] 之后依次为 n 条消息和 n 个token数量，返回列表长度
+_CONTEXT_APPEND_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    return -1
+end
+local length = redis.call('llen', KEYS[1])
+if redis.call('llen', KEYS[3]) ~= length then
+    return -2
+end
+local total = tonumber(redis.call('get', KEYS[4]) or '0')
+local n = (#ARGV - 3) / 2
+for i = 1, n do
+    redis.call('rpush', KEYS[1], ARGV[3 + i])
+    redis.call('rpush', KEYS[3], ARGV[3 + n + i])
+    total = total + tonumber(ARGV[3 + n + i])
+end
+length = length + n
+local max_messages = tonumber(ARGV[1])
+local max_tokens = tonumber(ARGV[2])
+while length > 0 and ((max_messages > 0 and length > max_messages) or (max_tokens > 0 and total > max_tokens)) do
+    local item = redis.call('lpop', KEYS[1])
+    if ARGV[3] == '1' then
+        redis.call('rpush', KEYS[5], item)
+    end
+    total = total - tonumber(redis.call('lpop', KEYS[3]))
+    length = length - 1
+end
+if ARGV[3] == '1' and max_messages > 0 then
+    local dropped = redis.call('llen', KEYS[5]) - max_messages
+    if dropped > 0 then
+        redis.call('ltrim', KEYS[5], dropped, -1)
+        redis.call('incrby', KEYS[6], dropped)
+    end
+end
+redis.call('set', KEYS[4], total)
+return length
+"""
+# 重建token数量列表（消息在重建期间被修改时放弃，由调用方重试）
+_CONTEXT_TOKENS_SCRIPT = """
+if redis.call('llen', KEYS[1]) ~= #ARGV then
+    return 0
+end
+redis.call('del', KEYS[3])
+local total = 0
+for i = 1, #ARGV do
+    redis.call('rpush', KEYS[3], ARGV[i])
+    total = total + tonumber(ARGV[i])
+end
+redis.call('set', KEYS[4], total)
+return 1
+"""
+# 保存摘要并删除已合并的待摘要消息：KEYS 依次为待摘要消息列表、起始序号、摘要
+# ARGV 依次为摘要、读取时的起始序号、合并的消息数量；读取后已被丢弃的消息不再重复删除
+_CONTEXT_SUMMARY_SCRIPT = """
+local removed = tonumber(redis.call('get', KEYS[2]) or '0') - tonumber(ARGV[2])
+local count = tonumber(ARGV[3]) - removed
+redis.call('set', KEYS[3], ARGV[1])
+if count > 0 then
+    redis.call('ltrim', KEYS[1], count, -1)
+    redis.call('incrby', KEYS[2], count)
+end
+return 1
+"""
+# 将旧版本的上下文迁移到列表（旧值在迁移期间被修改时放弃，由调用方重新读取）
+_CONTEXT_MIGRATE_SCRIPT = """
+if redis.call('get', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[2])
+for i = #ARGV, 2, -1 do
+    redis.call('lpush', KEYS[1], ARGV[i])
+end
+return 1
+"""
+
+# 存储编码迁移：仅当值未被修改时改写（保留过期时间）
+_REPLACE_VALUE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    local ttl = redis.call('pttl', KEYS[1])
+    if ttl > 0 then
+        redis.call('set', KEYS[1], ARGV[2], 'PX', ttl)
+    else
+        redis.call('set', KEYS[1], ARGV[2])
+    end
+    return 1
+end
+return 0
+"""
+_REPLACE_ITEM_SCRIPT = """
+if redis.call('lindex', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('lset', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# 重写流日志：KEYS 依次为流日志、日志版本、发布频道，ARGV 依次为内容、事件 JSON、过期时间（秒，0 表示不过期）
+# 递增日志版本并把新版本写入发布的事件，订阅者可以据此为续传 id 记录正确的版本
+_STREAM_RESET_SCRIPT = """
+local epoch = redis.call('incr', KEYS[2])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    redis.call('expire', KEYS[2], ARGV[3])
+else
+    redis.call('set', KEYS[1], ARGV[1])
+end
+redis.call('publish', KEYS[3], '{"epoch": ' .. epoch .. ', ' .. string.sub(ARGV[2], 2))
+return epoch
+"""
+# 读取流日志版本、长度和偏移量之后的内容
+_STREAM_READ_SCRIPT = """
+return {tonumber(redis.call('get', KEYS[2]) or '0'), redis.call('strlen', KEYS[1]), redis.call('getrange', KEYS[1], ARGV[1], -1)}
+"""
+
+# 仅当租约仍属于自己时续约 / 释放
+_RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# 回调发件箱：jobs 哈希保存任务内容，queue 有序集合按到期时间排序，
+# inflight 集合记录发送中的任务，attempts 哈希记录失败次数
+# 入队：同一任务 id 覆盖内容（合并被替代的更新），发送中的任务等发送结束后再处理新内容
+_OUTBOX_ENQUEUE_SCRIPT = """
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('hdel', KEYS[4], ARGV[1])
+if redis.call('sismember', KEYS[3], ARGV[1]) == 0 then
+    redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+end
+return 1
+"""
+# 领取到期的任务，领取后延后到租约到期时间，领取方崩溃时任务会被重新领取
+_OUTBOX_CLAIM_SCRIPT = """
+local ids = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, id in ipairs(ids) do
+    local payload = redis.call('hget', KEYS[1], id)
+    if payload then
+        redis.call('zadd', KEYS[2], ARGV[3], id)
+        redis.call('sadd', KEYS[3], id)
+        table.insert(result, id)
+        table.insert(result, payload)
+        table.insert(result, redis.call('hget', KEYS[4], id) or '0')
+    else
+        redis.call('zrem', KEYS[2], id)
+    end
+end
+return result
+"""
+# 结束一次发送：内容在发送期间被更新时立即发送新内容，
+# 否则成功（ARGV[3] 为空）时删除任务，失败时记录次数并按退避时间重新排队
+_OUTBOX_FINISH_SCRIPT = """
+redis.call('srem', KEYS[3], ARGV[1])
+if redis.call('hget', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    if redis.call('hexists', KEYS[1], ARGV[1]) == 1 then
+        redis.call('zadd', KEYS[2], ARGV[5], ARGV[1])
+    end
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('hdel', KEYS[4], ARGV[1])
+    redis.call('zrem', KEYS[2], ARGV[1])
+else
+    redis.call('hset', KEYS[4], ARGV[1], ARGV[4])
+    redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+end
+return 1
+"""
 
 class RedisManager:
     _instance = None
@@ -145,55 +476,270 @@ class RedisManager:
                 db=int(os.environ.get('REDIS_DB', 0)),  # 添加数据库配置
                 decode_responses=True
             )
+            # 输入和上下文使用二进制编码存储，读写时不解码为字符串
+            cls._instance.binary_client = redis.Redis(
+                host=os.environ.get('REDIS_HOST', 'localhost'),
+                port=int(os.environ.get('REDIS_PORT', 6379)),
+                db=int(os.environ.get('REDIS_DB', 0)),
+                decode_responses=False
+            )
         return cls._instance
 
     def _make_key(self, type_prefix, key):
         """生成带有应用前缀的完整键名"""
         return f"{self._prefix}{type_prefix}:{key}"
 
+    # 存储编码部分
+    async def load_codec_dictionaries(self):
+        """从 Redis 加载压缩字典（服务启动时调用，读取到未加载的字典时也会重新加载）"""
+        dictionaries = await self.binary_client.hgetall(self._make_key("codec", "dictionaries"))
+        current = await self.client.get(self._make_key("codec", "dictionary"))
+        for dict_id, data in dictionaries.items():
+            storage_codec.add_dictionary(data, current=dict_id.decode() == current)
+
+    async def save_codec_dictionary(self, data):
+        """
+        保存压缩字典并设为当前字典（其他进程重启后使用新字典压缩）
+        :return: 字典 id
+        """
+        dict_id = storage_codec.add_dictionary(data, current=True)
+        await self.binary_client.hset(self._make_key("codec", "dictionaries"), str(dict_id), data)
+        await self.client.set(self._make_key("codec", "dictionary"), str(dict_id))
+        return dict_id
+
+    async def _loads(self, data):
+        """解码存储的值，支持旧版本的 JSON 文本"""
+        try:
+            return storage_codec.loads(data)
+        except UnknownDictionaryError:
+            await self.load_codec_dictionaries()
+            return storage_codec.loads(data)
+
+    async def _loads_all(self, items):
+        return [await self._loads(item) for item in items]
+
+    async def train_codec_dictionary(self, size, max_samples):
+        """
+        使用已保存的输入和上下文训练压缩字典
+        :param size: 字典大小（字节）
+        :param max_samples: 最多使用的样本数量
+        :return: 字典 id，样本不足时返回 None
+        """
+        samples = []
+        async for key in self.binary_client.scan_iter(f"{self._prefix}input:*"):
+            data = await self.binary_client.get(key)
+            if data:
+                samples.append(storage_codec.dumps(await self._loads(data), compress=False))
+            if len(samples) >= max_samples // 2:
+                break
+        async for key in self.binary_client.scan_iter(f"{self._prefix}contexts:*"):
+            for item in await self.binary_client.lrange(key, -50, -1):
+                samples.append(storage_codec.dumps(await self._loads(item), compress=False))
+            if len(samples) >= max_samples:
+                break
+        try:
+            data = storage_codec.train_dictionary(samples, size)
+        except Exception as e:
+            logger.error(f"Train codec dictionary error ({len(samples)} samples): {str(e)}")
+            return None
+        return await self.save_codec_dictionary(data)
+
+    async def migrate_storage(self):
+        """
+        将已保存的输入和上下文改写为当前的存储编码（值在改写期间被修改时跳过）
+        :return: 改写的数量统计
+        """
+        stats = {"inputs": 0, "contexts": 0, "messages": 0}
+        async for key in self.binary_client.scan_iter(f"{self._prefix}input:*"):
+            data = await self.binary_client.get(key)
+            if not data:
+                continue
+            encoded = storage_codec.dumps(await self._loads(data))
+            if encoded != data and await self.binary_client.eval(_REPLACE_VALUE_SCRIPT, 1, key, data, encoded):
+                stats["inputs"] += 1
+        legacy_prefix = f"{self._prefix}context:"
+        async for key in self.client.scan_iter(f"{legacy_prefix}*"):
+            await self._migrate_context(key[len(legacy_prefix):])
+            stats["contexts"] += 1
+        for type_prefix in ("contexts", "context_pending"):
+            async for key in self.binary_client.scan_iter(f"{self._prefix}{type_prefix}:*"):
+                for index, item in enumerate(await self.binary_client.lrange(key, 0, -1)):
+                    encoded = storage_codec.dumps(await self._loads(item))
+                    if encoded != item and await self.binary_client.eval(_REPLACE_ITEM_SCRIPT, 1, key, index, item, encoded):
+                        stats["messages"] += 1
+        return stats
+
     # 上下文部分
+    # 每条消息是列表中的一个编码元素，追加只写入新消息，读取可以只读取需要的范围
+    # 另外记录每条消息的token数量和总数，写入时按token预算删除最早的消息
+    def _context_keys(self, key):
+        return (
+            self._make_key("contexts", key),
+            self._make_key("context", key),
+            self._make_key("context_tokens", key),
+            self._make_key("context_total", key),
+            self._make_key("context_pending", key),
+            self._make_key("context_pending_offset", key),
+            self._make_key("context_summary", key),
+        )
+
+    async def _migrate_context(self, key):
+        """将旧版本保存为整个 JSON 字符串的上下文迁移到列表"""
+        list_key, legacy_key = self._context_keys(key)[:2]
+        data = await self.binary_client.get(legacy_key)
+        if data is None:
+            return
+        try:
+            context = json.loads(data)
+        except ValueError:
+            context = []
+        if not isinstance(context, list):
+            context = []
+        await self.binary_client.eval(_CONTEXT_MIGRATE_SCRIPT, 2, list_key, legacy_key, data,
+                                      *[storage_codec.dumps(item) for item in context])
+
+    async def _rebuild_context_tokens(self, key, model_type, model_name):
+        """重新计算上下文的token数量列表（迁移的上下文没有记录token数量）"""
+        context = await self.get_context(key)
+        tokens = [context_message_tokens(item, model_type, model_name) for item in context]
+        await self.client.eval(_CONTEXT_TOKENS_SCRIPT, 4, *self._context_keys(key)[:4], *tokens)
+
+    async def get_context_range(self, key, start=0, stop=-1):
+        """
+        从 Redis 获取指定范围的上下文消息（与 LRANGE 相同，支持负数下标）
+        :param start: 起始下标
+        :param stop: 结束下标（包含）
+        """
+        list_key, legacy_key = self._context_keys(key)[:2]
+        async with self.binary_client.pipeline(transaction=False) as pipe:
+            pipe.lrange(list_key, start, stop)
+            pipe.exists(legacy_key)
+            items, legacy = await pipe.execute()
+        if legacy:
+            await self._migrate_context(key)
+            items = await self.binary_client.lrange(list_key, start, stop)
+        return await self._loads_all(items)
+
     async def get_context(self, key):
         """从 Redis 获取上下文"""
-        data = await self.client.get(self._make_key("context", key))
-        if data:
-            context = json.loads(data)
-            return context if isinstance(context, list) else []
-        return []
+        return await self.get_context_range(key)
+
+    async def get_context_tail(self, key, max_tokens, count_page, page_size=CONTEXT_PAGE_SIZE):
+        """
+        从最新的消息开始分页读取上下文，读到超出token数量的消息为止（更早的消息不可能放入上下文）
+        :param max_tokens: 可用的token数量
+        :param count_page: 计算一页消息token数量的协程函数，返回与消息对应的token数量列表
+        :param page_size: 每次读取的消息数量
+        :return: 按原始顺序排列的上下文消息
+        """
+        pages = []
+        total = 0
+        offset = 0
+        while total <= max_tokens:
+            page = await self.get_context_range(key, -(offset + page_size), -(offset + 1))
+            pages.append(page)
+            for tokens in reversed(await count_page(page)):
+                total += tokens
+                if total > max_tokens:
+                    break
+            if len(page) < page_size:
+                break
+            offset += page_size
+        return [message for page in reversed(pages) for message in page]
 
     async def set_context(self, key, value, model_type=None, model_name=None, context_limit=None):
         """设置上下文到 Redis，根据模型限制截断内容"""
         # 确保 value 是列表格式
         if not isinstance(value, list):
             raise ValueError("Context must be a list of tuples")
+        # 只保留不超过最大消息数和token预算的最新消息
+        if CONTEXT_MAX_MESSAGES > 0:
+            value = value[-CONTEXT_MAX_MESSAGES:]
+        value = with_token_counts(value, model_type, model_name)
+        tokens = [context_message_tokens(item, model_type, model_name) for item in value]
+        max_tokens = context_token_budget(model_type, model_name, context_limit)
+        if max_tokens > 0:
+            sums = list(itertools.accumulate(tokens))
+            if sums and sums[-1] > max_tokens:
+                start = bisect.bisect_left(sums, sums[-1] - max_tokens) + 1
+                value, tokens = value[start:], tokens[start:]
         # 保存到 Redis
-        await self.client.set(self._make_key("context", key), json.dumps(value))
+        list_key, legacy_key, tokens_key, total_key = self._context_keys(key)[:4]
+        async with self.binary_client.pipeline(transaction=True) as pipe:
+            pipe.delete(list_key, legacy_key, tokens_key)
+            if value:
+                pipe.rpush(list_key, *[storage_codec.dumps(item) for item in value])
+                pipe.rpush(tokens_key, *tokens)
+            pipe.set(total_key, sum(tokens))
+            await pipe.execute()
 
     async def append_context(self, key, role, content, model_type=None, model_name=None, context_limit=None):
         """添加新的上下文消息"""
-        context = await self.get_context(key)
-        context.append((role, content))
-        await self.set_context(key, context, model_type, model_name, context_limit)
+        await self.extend_contexts(key, [{"type": role, "content": content}], model_type, model_name, context_limit)
 
     async def extend_contexts(self, key, contents, model_type=None, model_name=None, context_limit=None):
-        """添加新的上下文消息"""
-        context = await self.get_context(key)
-        context.extend(contents)
-        await self.set_context(key, context, model_type, model_name, context_limit)
+        """
+        添加新的上下文消息，同时记录每条消息的token数量（原子追加，并发写入不会丢失消息）
+        写入时删除最早的消息，只保留可能放入上下文的部分（模型token限制乘以 CONTEXT_TOKEN_HEADROOM）
+        启用摘要时只保留 CONTEXT_SUMMARY_RATIO 比例的最新消息，删除的消息放入待摘要列表
+        """
+        if not contents:
+            return
+        contents = with_token_counts(contents, model_type, model_name)
+        items = [storage_codec.dumps(item) for item in contents]
+        tokens = [context_message_tokens(item, model_type, model_name) for item in contents]
+        max_tokens = context_token_budget(model_type, model_name, context_limit)
+        for _ in range(4):
+            length = await self.binary_client.eval(_CONTEXT_APPEND_SCRIPT, 6, *self._context_keys(key)[:6],
+                                            CONTEXT_MAX_MESSAGES, max_tokens, int(CONTEXT_SUMMARY_ENABLED),
+                                            *items, *tokens)
+            if length >= 0:
+                return
+            if length == -1:
+                await self._migrate_context(key)
+            else:
+                await self._rebuild_context_tokens(key, model_type, model_name)
+        raise RuntimeError(f"Context append failed: {key}")
+
+    async def get_context_summary(self, key):
+        """获取上下文摘要"""
+        return await self.client.get(self._context_keys(key)[6]) or ""
+
+    async def get_context_pending(self, key, count=-1):
+        """
+        获取待摘要的消息（从最早的开始）
+        :param count: 最多获取的数量，为 -1 时获取全部
+        :return: (第一条消息的序号, 消息列表)，序号在保存摘要时用于确定已合并的消息
+        """
+        pending_key, offset_key = self._context_keys(key)[4:6]
+        async with self.binary_client.pipeline(transaction=True) as pipe:
+            pipe.lrange(pending_key, 0, count - 1 if count > 0 else -1)
+            pipe.get(offset_key)
+            items, offset = await pipe.execute()
+        return int(offset or 0), await self._loads_all(items)
+
+    async def set_context_summary(self, key, summary, offset, folded):
+        """
+        保存新的上下文摘要，同时删除已合并的待摘要消息（与追加上下文的脚本原子执行，并发追加不会删错消息）
+        :param offset: 读取待摘要消息时第一条消息的序号
+        :param folded: 已合并到摘要中的待摘要消息数量
+        """
+        await self.client.eval(_CONTEXT_SUMMARY_SCRIPT, 3, *self._context_keys(key)[4:], summary, offset, folded)
 
     async def delete_context(self, key):
         """删除上下文"""
-        await self.client.delete(self._make_key("context", key))
+        await self.client.delete(*self._context_keys(key))
 
 
     # 输入部分
     async def get_input(self, key):
         """从 Redis 获取输入"""
-        data = await self.client.get(self._make_key("input", key))
-        return json.loads(data) if data else None
+        data = await self.binary_client.get(self._make_key("input", key))
+        return await self._loads(data) if data else None
 
     async def set_input(self, key, value, expire=86400):
         """设置输入到 Redis"""
-        await self.client.set(self._make_key("input", key), json.dumps(value), ex=expire)
+        await self.binary_client.set(self._make_key("input", key), storage_codec.dumps(value), ex=expire)
 
     async def delete_input(self, key):
         """删除输入"""
@@ -223,3 +769,113 @@ class RedisManager:
         """删除临时缓存"""
         cache_key = self._make_key("cache", key)
         return await self.client.delete(cache_key)
+
+    # 流式推送部分
+    async def append_stream(self, key, content, event, expire=None):
+        """追加增量到流日志并发布流式事件（先写日志再发布，保证订阅者补齐时不会缺失内容）"""
+        cache_key = self._make_key("cache", key)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.append(cache_key, content)
+            if expire:
+                pipe.expire(cache_key, expire)
+                # 日志版本与日志同时过期，版本不会在日志仍存在时回到 0
+                pipe.expire(self._make_key("epoch", key), expire)
+            pipe.publish(self._make_key("channel", key), json.dumps(event))
+            await pipe.execute()
+
+    async def reset_stream(self, key, content, event, expire=None):
+        """
+        重写流日志并发布流式事件，同时递增日志版本供轮询方发现重写，发布的事件携带新版本
+        :return: 新的日志版本
+        """
+        keys = [self._make_key(type_prefix, key) for type_prefix in ("cache", "epoch", "channel")]
+        return await self.client.eval(_STREAM_RESET_SCRIPT, 3, *keys, content, json.dumps(event), expire or 0)
+
+    async def publish_stream(self, key, event):
+        """发布流式事件"""
+        return await self.client.publish(self._make_key("channel", key), json.dumps(event))
+
+    async def read_stream(self, key, offset=0):
+        """从指定字节偏移量读取流日志（偏移量总是落在增量边界上）"""
+        return await self.client.getrange(self._make_key("cache", key), offset, -1) or ""
+
+    async def poll_stream(self, key, offset=0):
+        """
+        轮询读取流日志
+        :return: (日志版本, 偏移量之后的内容)
+        """
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.get(self._make_key("epoch", key))
+            pipe.getrange(self._make_key("cache", key), offset, -1)
+            epoch, content = await pipe.execute()
+        return int(epoch or 0), content or ""
+
+    async def read_stream_state(self, key, offset=0):
+        """
+        原子读取流日志版本、字节长度和偏移量之后的内容（原始字节，偏移量可能不在字符边界上）
+        :return: (日志版本, 日志字节长度, 内容字节串)
+        """
+        epoch, length, data = await self.binary_client.eval(
+            _STREAM_READ_SCRIPT, 2, self._make_key("cache", key), self._make_key("epoch", key), offset)
+        return int(epoch), int(length), data or b""
+
+    async def stream_epoch(self, key):
+        """流日志版本（未重写或已过期时为 0）"""
+        return int(await self.client.get(self._make_key("epoch", key)) or 0)
+
+    async def stream_length(self, key):
+        """流日志的字节长度"""
+        return await self.client.strlen(self._make_key("cache", key))
+
+    async def subscribe_stream(self, key):
+        """订阅流式事件，返回 PubSub 对象（调用方负责关闭）"""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self._make_key("channel", key))
+        return pubsub
+
+    # 回调发件箱部分
+    def _outbox_keys(self):
+        return [self._make_key("outbox", name) for name in ("jobs", "queue", "inflight", "attempts")]
+
+    async def enqueue_callback(self, job_id, payload, due):
+        """
+        回调任务入队，相同 job_id 的未发送内容会被新内容替代
+        :param due: 到期时间（时间戳）
+        """
+        return await self.client.eval(_OUTBOX_ENQUEUE_SCRIPT, 4, *self._outbox_keys(), job_id, payload, due)
+
+    async def claim_callbacks(self, now, limit, lease_until):
+        """
+        领取到期的回调任务
+        :return: [(job_id, payload, 失败次数)]
+        """
+        result = await self.client.eval(_OUTBOX_CLAIM_SCRIPT, 4, *self._outbox_keys(), now, limit, lease_until)
+        return [(result[i], result[i + 1], int(result[i + 2])) for i in range(0, len(result), 3)]
+
+    async def finish_callback(self, job_id, payload, now, retry_at=None, attempts=0):
+        """
+        结束一次回调发送
+        :param retry_at: 重试时间（时间戳），为 None 时表示完成并删除任务
+        :return: 内容在发送期间被更新时返回 False
+        """
+        return bool(await self.client.eval(
+            _OUTBOX_FINISH_SCRIPT, 4, *self._outbox_keys(),
+            job_id, payload, "" if retry_at is None else retry_at, attempts, now
+        ))
+
+    # 生产者租约部分
+    async def acquire_lease(self, key, token, ttl):
+        """获取租约，已被其他生产者持有时返回 False"""
+        return bool(await self.client.set(self._make_key("lease", key), token, nx=True, px=int(ttl * 1000)))
+
+    async def renew_lease(self, key, token, ttl):
+        """续约，租约已过期或被其他生产者接管时返回 False"""
+        return bool(await self.client.eval(_RENEW_LEASE_SCRIPT, 1, self._make_key("lease", key), token, int(ttl * 1000)))
+
+    async def release_lease(self, key, token):
+        """释放自己持有的租约"""
+        return bool(await self.client.eval(_RELEASE_LEASE_SCRIPT, 1, self._make_key("lease", key), token))
+
+    async def lease_exists(self, key):
+        """租约是否仍然有效"""
+        return bool(await self.client.exists(self._make_key("lease", key)))
@@ -1,4 +1,16 @@
 import httpx
+from .transport import callback_transport
+
+
+class CallbackError(Exception):
+    """
+    回调请求失败
+    :param retryable: 是否可以重试（网络错误、服务端 5xx、429 可以重试，其他 4xx 不重试）
+    """
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
 
 class RequestClient:
     """
@@ -40,7 +52,7 @@ class RequestClient:
 
     async def call(self, data, **kwargs):
         """
-        发送请求到服务器
+        发送请求到服务器，失败时返回 None
         :param data: 请求数据
         :param kwargs: 可选参数，可覆盖初始化时的参数
             - server_url: 覆盖服务器地址
@@ -50,10 +62,23 @@ class RequestClient:
             - timeout: 请求超时时间
         :return: 响应数据中的 id
         """
+        try:
+            result = await self.send(data, **kwargs)
+            return result.get('data', {}).get('id')
+        except Exception as e:
+            return None
+
+    async def send(self, data, **kwargs):
+        """
+        发送请求到服务器，失败时抛出 CallbackError
+        :param data: 请求数据
+        :param kwargs: 同 call
+        :return: 响应数据
+        """
         # 检查服务器地址
         server_url = kwargs.get('server_url', self.server_url)
         if not server_url or not server_url.startswith(('http://', 'https://')):
-            return None
+            raise CallbackError(f"Invalid server url: {server_url}", retryable=False)
 
         # 更新headers
         headers = self.headers.copy()
@@ -71,14 +96,24 @@ class RequestClient:
         if 'dialog_id' not in request_data:
             request_data['dialog_id'] = self.dialog_id
 
+        # 同一服务器共用保持连接的客户端，避免每次回调重新握手
+        client = callback_transport.get_async_client(base_url=server_url)
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    call_url,
-                    headers=headers,
-                    json=request_data,
-                    timeout=kwargs.get('timeout', 15)
-                )
-                return response.json().get('data', {}).get('id')
-        except Exception as e:
-            return None
+            response = await client.post(
+                call_url,
+                headers=headers,
+                json=request_data,
+                timeout=kwargs.get('timeout', 15)
+            )
+        except httpx.HTTPError as e:
+            raise CallbackError(f"{type(e).__name__}: {str(e)}") from e
+        if response.status_code >= 500 or response.status_code == 429:
+            raise CallbackError(f"HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise CallbackError(f"HTTP {response.status_code}", retryable=False)
+        try:
+            result = response.json()
+        except ValueError as e:
+            # 网关错误页等非 JSON 响应，稍后重试
+            raise CallbackError("Invalid response") from e
+        return result if isinstance(result, dict) else {}
@@ -0,0 +1,499 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from .config import STREAM_TIMEOUT, STREAM_MODE, PRODUCER_LEASE_TTL, PRODUCER_CHECK_INTERVAL
+from .utils import json_content, json_empty, json_error
+
+logger = logging.getLogger("ai")
+
+
+def sse_event(event_id, event, data):
+    """格式化一条 SSE 事件"""
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+
+
+def byte_length(text):
+    """文本按 UTF-8 编码后的字节长度，与 Redis 流日志的偏移量一致"""
+    return len(text.encode("utf-8"))
+
+
+def event_id(epoch, offset):
+    """事件 id：流日志版本和已发送内容的字节偏移量"""
+    return f"{epoch}-{offset}"
+
+
+def parse_event_id(last_event_id):
+    """
+    解析客户端重连时携带的 Last-Event-ID（只有偏移量的旧格式按版本 0 处理）
+    :return: (日志版本, 字节偏移量)，无效时返回 None
+    """
+    epoch, _, offset = (last_event_id or "").rpartition("-")
+    try:
+        epoch, offset = int(epoch or 0), int(offset)
+    except ValueError:
+        return None
+    return (epoch, offset) if epoch >= 0 and offset >= 0 else None
+
+
+def finished_events(response, resume=None, error=None, epoch=0):
+    """
+    已结束响应的事件，携带同一日志版本的有效偏移量时只补发剩余部分
+    :param resume: 续传位置 (日志版本, 字节偏移量)
+    :param epoch: 当前的流日志版本
+    """
+    data = response.encode("utf-8")
+    done_data = json_error(error) if error else json_empty()
+    current_id = event_id(epoch, len(data))
+    if resume and resume[0] == epoch and resume[1] and resume[1] <= len(data):
+        try:
+            append_response = data[resume[1]:].decode("utf-8")
+        except UnicodeDecodeError:
+            append_response = None
+        if append_response is not None:
+            if append_response:
+                yield sse_event(current_id, "append", json_content(append_response))
+            yield sse_event(current_id, "done", done_data)
+            return
+    yield sse_event(current_id, "replace", json_content(response))
+    yield sse_event(current_id, "done", done_data)
+
+
+async def _resume_read(redis_manager, msg_key, resume):
+    """
+    按续传位置读取流日志
+    日志版本不同（接管后重新生成）、偏移量超出日志长度或不在字符边界上时从头读取
+    :param resume: 续传位置 (日志版本, 字节偏移量)
+    :return: (日志版本, 读取起点, 读取到的内容)
+    """
+    if resume and resume[1]:
+        epoch, length, data = await redis_manager.read_stream_state(msg_key, resume[1])
+        if epoch == resume[0] and resume[1] <= length:
+            try:
+                return epoch, resume[1], data.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+    epoch, _, data = await redis_manager.read_stream_state(msg_key)
+    return epoch, 0, data.decode("utf-8")
+
+
+class StreamPublisher:
+    """
+    流式发布者，由生成响应的一方使用
+    每次有新内容时只把增量追加到流日志，并通过 Redis 发布订阅推送给所有消费者
+    """
+    def __init__(self, redis_manager, msg_key, interval=0):
+        """
+        初始化发布者
+        :param redis_manager: RedisManager 实例
+        :param msg_key: 消息缓存键
+        :param interval: 最小发布间隔（秒），0 表示每次有新内容立即发布
+        """
+        self.redis_manager = redis_manager
+        self.msg_key = msg_key
+        self.interval = interval
+        self.offset = 0
+        self.last_publish_time = 0
+        self._published = []
+        self._pending = []
+
+    @property
+    def text(self):
+        """已提交的完整响应（包括尚未发布的部分）"""
+        return "".join(self._published + self._pending)
+
+    async def append(self, content, force=False):
+        """
+        追加新内容，按发布间隔把积累的增量写入流日志
+        """
+        if content:
+            self._pending.append(content)
+        if not self._pending:
+            return
+        current_time = time.time()
+        if not force and current_time - self.last_publish_time < self.interval:
+            return
+        self.last_publish_time = current_time
+        content = "".join(self._pending)
+        self._pending = []
+        event = {"event": "append", "offset": self.offset, "content": content}
+        await self.redis_manager.append_stream(self.msg_key, content, event, expire=STREAM_TIMEOUT)
+        self._published.append(content)
+        self.offset += byte_length(content)
+
+    async def publish(self, response, force=False):
+        """
+        发布当前完整响应，只追加与上次发布相比新增的部分
+        """
+        published = self.text
+        if response.startswith(published):
+            await self.append(response[len(published):], force)
+            return
+        # 已发布内容被改写，重写整个流日志
+        self._pending = []
+        self.last_publish_time = time.time()
+        event = {"event": "replace", "content": response}
+        await self.redis_manager.reset_stream(self.msg_key, response, event, expire=STREAM_TIMEOUT)
+        self._published = [response]
+        self.offset = byte_length(response)
+
+    async def reset(self):
+        """清空流日志，用于接管后重新生成"""
+        self._pending = []
+        self._published = []
+        self.offset = 0
+        event = {"event": "replace", "content": ""}
+        await self.redis_manager.reset_stream(self.msg_key, "", event, expire=STREAM_TIMEOUT)
+
+    async def finish(self, response, error=None):
+        """
+        发布最终响应和结束事件
+        :param error: 错误信息，存在时结束事件携带错误
+        """
+        await self.publish(response, force=True)
+        event = {"event": "done"}
+        if error:
+            event["error"] = error
+        await self.redis_manager.publish_stream(self.msg_key, event)
+
+
+class ProducerLease:
+    """
+    生产者租约，保证同一消息只有一个生产者
+    租约有效期很短，由心跳续约；生产者所在进程崩溃或重启后租约很快过期，其他工作进程可以接管
+    """
+    def __init__(self, redis_manager, msg_key, ttl=PRODUCER_LEASE_TTL):
+        self.redis_manager = redis_manager
+        self.msg_key = msg_key
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.lost = False
+
+    async def acquire(self):
+        """获取租约"""
+        return await self.redis_manager.acquire_lease(self.msg_key, self.token, self.ttl)
+
+    async def release(self):
+        """释放租约"""
+        try:
+            await self.redis_manager.release_lease(self.msg_key, self.token)
+        except Exception as e:
+            logger.error(f"Release producer lease error ({self.msg_key}): {str(e)}")
+
+    async def run(self, coro):
+        """
+        持有租约运行生产者，运行期间定时续约，续约失败（租约已被接管）时取消生产者
+        """
+        heartbeat = asyncio.create_task(self._heartbeat(asyncio.current_task()))
+        try:
+            return await coro
+        finally:
+            heartbeat.cancel()
+            if not self.lost:
+                await self.release()
+
+    async def _heartbeat(self, task):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await self.redis_manager.renew_lease(self.msg_key, self.token, self.ttl)
+            except Exception as e:
+                # Redis 短暂不可用时继续尝试，租约仍在有效期内
+                logger.error(f"Renew producer lease error ({self.msg_key}): {str(e)}")
+                continue
+            if not renewed:
+                logger.warning(f"Producer lease lost ({self.msg_key})")
+                self.lost = True
+                task.cancel()
+                return
+
+
+# 订阅者队列溢出或上游重连后，提示消费者从流日志补齐
+RESYNC = {"event": "resync"}
+
+
+class HubSubscriber:
+    """
+    流中心的本地订阅者，持有一个有界队列
+    """
+    def __init__(self, channel, maxsize):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        """放入事件，队列已满时丢弃积压并提示消费者从流日志补齐，保证单个流的内存有界"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            if event is not RESYNC:
+                self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        """获取下一个事件，超时返回 None"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        """取消订阅"""
+        self.channel.hub._unsubscribe(self)
+
+
+class _HubChannel:
+    """
+    单个流的上游连接，同一进程内所有查看者共享
+    """
+    def __init__(self, hub, redis_manager, input_key, msg_key, takeover=None):
+        self.hub = hub
+        self.redis_manager = redis_manager
+        self.input_key = input_key
+        self.msg_key = msg_key
+        self.takeover = takeover
+        self.subscribers = set()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.producer_task = None
+        self.last_producer_check = time.time()
+
+    async def check_producer(self):
+        """
+        空闲时检查生产者租约，生产者中断（租约过期且未结束）时尝试接管
+        """
+        if not self.takeover:
+            return
+        current_time = time.time()
+        if current_time - self.last_producer_check < PRODUCER_CHECK_INTERVAL:
+            return
+        self.last_producer_check = current_time
+        if await self.redis_manager.lease_exists(self.msg_key):
+            return
+        current_data = await self.redis_manager.get_input(self.input_key)
+        if not current_data or current_data["status"] == "finished":
+            return
+        logger.warning(f"Producer lease expired, taking over ({self.msg_key})")
+        self.producer_task = await self.takeover()
+
+    def broadcast(self, event):
+        for subscriber in self.subscribers:
+            subscriber.put(event)
+
+    def mark_ready(self):
+        """上游就绪，重连时提示订阅者补齐重连期间可能缺失的内容"""
+        if self.ready.is_set():
+            self.broadcast(RESYNC)
+        self.ready.set()
+
+    async def run(self):
+        """上游循环，流结束或没有订阅者时退出"""
+        try:
+            while True:
+                try:
+                    if STREAM_MODE == "push":
+                        await self._subscribe()
+                    else:
+                        await self._poll()
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # 上游异常时稍后重连
+                    logger.error(f"Stream hub upstream error ({self.msg_key}): {str(e)}")
+                    self.ready.set()
+                    await asyncio.sleep(1)
+        finally:
+            self.hub._close_channel(self)
+
+    async def _subscribe(self):
+        """推送模式：一个发布订阅连接"""
+        pubsub = await self.redis_manager.subscribe_stream(self.msg_key)
+        try:
+            self.mark_ready()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not message:
+                    await self.check_producer()
+                    continue
+                event = json.loads(message["data"])
+                self.broadcast(event)
+                if event["event"] == "done":
+                    return
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    async def _poll(self):
+        """轮询模式：一个轮询器定时读取流日志增量和输入状态"""
+        offset = await self.redis_manager.stream_length(self.msg_key)
+        epoch = None
+        self.mark_ready()
+        sleep_interval = 0.1  # 睡眠间隔
+        check_status_interval = 0.2  # 检查完成状态间隔
+        last_status_check = time.time()
+        while True:
+            current_time = time.time()
+            current_epoch, content = await self.redis_manager.poll_stream(self.msg_key, offset)
+            if epoch is not None and current_epoch != epoch:
+                # 日志被重写（如接管后重新生成），从头读取并替换
+                current_epoch, content = await self.redis_manager.poll_stream(self.msg_key)
+                self.broadcast({"event": "replace", "content": content, "epoch": current_epoch})
+                offset = byte_length(content)
+            elif content:
+                self.broadcast({"event": "append", "offset": offset, "content": content})
+                offset += byte_length(content)
+            else:
+                await self.check_producer()
+            epoch = current_epoch
+
+            # 只在已有响应时才检查状态
+            if offset and current_time - last_status_check >= check_status_interval:
+                current_data = await self.redis_manager.get_input(self.input_key)
+                if current_data and current_data["status"] == "finished":
+                    response = current_data.get("response") or ""
+                    content = await self.redis_manager.read_stream(self.msg_key, offset)
+                    if offset + byte_length(content) != byte_length(response):
+                        # 流日志被改写（如生成异常）时以最终结果为准
+                        self.broadcast({"event": "replace", "content": response, "epoch": current_epoch})
+                    elif content:
+                        self.broadcast({"event": "append", "offset": offset, "content": content})
+                    self.broadcast({"event": "done", "error": current_data.get("error")})
+                    return
+                last_status_check = current_time
+
+            # 睡眠等待
+            await asyncio.sleep(sleep_interval)
+
+
+class StreamHub:
+    """
+    进程内流中心
+    同一工作进程中观看同一消息的多个客户端共享一个上游订阅（或轮询器），
+    事件通过本地有界队列分发，Redis 负载不再随本地查看者数量增长
+    """
+    def __init__(self, queue_size=256):
+        """
+        :param queue_size: 每个订阅者的队列长度上限
+        """
+        self.queue_size = queue_size
+        self._channels = {}
+
+    async def subscribe(self, redis_manager, input_key, msg_key, takeover=None):
+        """
+        订阅指定流，返回时上游已就绪，之后发布的事件都会送达
+        :param takeover: 生产者中断时的接管回调
+        """
+        channel = self._channels.get(msg_key)
+        if channel is None:
+            channel = _HubChannel(self, redis_manager, input_key, msg_key, takeover)
+            self._channels[msg_key] = channel
+            channel.task = asyncio.create_task(channel.run())
+        subscriber = HubSubscriber(channel, self.queue_size)
+        channel.subscribers.add(subscriber)
+        try:
+            await channel.ready.wait()
+        except BaseException:
+            # 等待上游就绪时被取消（如客户端断开），调用方拿不到订阅者，在这里取消订阅
+            subscriber.close()
+            raise
+        return subscriber
+
+    def _unsubscribe(self, subscriber):
+        channel = subscriber.channel
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers and channel.task:
+            self._close_channel(channel)
+            channel.task.cancel()
+
+    def _close_channel(self, channel):
+        if self._channels.get(channel.msg_key) is channel:
+            del self._channels[channel.msg_key]
+
+    def stats(self):
+        """当前的流数量和本地订阅者数量"""
+        return {
+            "streams": len(self._channels),
+            "subscribers": sum(len(channel.subscribers) for channel in self._channels.values()),
+        }
+
+
+stream_hub = StreamHub()
+
+
+async def stream_consumer(redis_manager, input_key, msg_key, resume=None, takeover=None):
+    """
+    流式消费者：通过进程内流中心接收事件，推送模式下空闲时不产生 Redis 请求
+    事件 id 为流日志版本和已发送内容的字节偏移量，客户端重连时可据此续传
+    :param input_key: 输入数据键，用于检查是否已结束
+    :param msg_key: 消息缓存键
+    :param resume: 续传位置 (日志版本, 字节偏移量)（来自 Last-Event-ID）
+    :param takeover: 生产者中断（租约过期）时的接管回调
+    """
+    subscriber = await stream_hub.subscribe(redis_manager, input_key, msg_key, takeover)
+    try:
+        # 先订阅再读取流日志，订阅之前发布的内容都已包含在日志中
+        epoch, offset, append_response = await _resume_read(redis_manager, msg_key, resume)
+        if append_response:
+            event_type = "append" if offset else "replace"
+            offset += byte_length(append_response)
+            yield sse_event(event_id(epoch, offset), event_type, json_content(append_response))
+
+        # 订阅之前已经结束
+        current_data = await redis_manager.get_input(input_key)
+        if current_data and current_data["status"] == "finished":
+            response = current_data.get("response") or ""
+            error = current_data.get("error")
+            if byte_length(response) == offset:
+                yield sse_event(event_id(epoch, offset), "done", json_error(error) if error else json_empty())
+            else:
+                for event in finished_events(response, (epoch, offset), error, epoch):
+                    yield event
+            return
+
+        deadline = time.time() + STREAM_TIMEOUT
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                yield sse_event(event_id(epoch, offset), "replace", json_content('Request timeout'))
+                yield sse_event(event_id(epoch, offset), "done", json_error('Timeout'))
+                return
+
+            event = await subscriber.get(min(remaining, 1.0))
+            if not event:
+                continue
+
+            if event["event"] == "done":
+                yield sse_event(event_id(epoch, offset), "done", json_error(event["error"]) if event.get("error") else json_empty())
+                return
+
+            if event["event"] == "replace":
+                epoch = event.get("epoch", epoch)
+                offset = byte_length(event["content"])
+                yield sse_event(event_id(epoch, offset), "replace", json_content(event["content"]))
+                continue
+
+            if event["event"] == "resync":
+                current_epoch, start, content = await _resume_read(redis_manager, msg_key, (epoch, offset))
+                if content or start != offset or current_epoch != epoch:
+                    epoch = current_epoch
+                    offset = start + byte_length(content)
+                    yield sse_event(event_id(epoch, offset), "append" if start else "replace", json_content(content))
+                continue
+
+            # append 事件：已包含在日志读取中的增量直接跳过，有缺失时从日志补齐
+            if event["offset"] < offset:
+                continue
+            if event["offset"] > offset:
+                content = await redis_manager.read_stream(msg_key, offset)
+            else:
+                content = event["content"]
+            if content:
+                # 第一段内容替换占位符（与读取日志时一致）
+                event_type = "append" if offset else "replace"
+                offset += byte_length(content)
+                yield sse_event(event_id(epoch, offset), event_type, json_content(content))
+    finally:
+        subscriber.close()
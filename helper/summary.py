@@ -0,0 +1,106 @@
+import logging
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from .config import CONTEXT_SUMMARY_MAX_TOKENS
+from .redis import context_token_limit, message_tokens
+from .stream import ProducerLease
+from .utils import convert_message_content_to_string, remove_reasoning_content, replace_think_content
+
+logger = logging.getLogger("ai")
+
+# 生成摘要的提示词
+SUMMARY_PROMPT = """你负责维护一段对话的摘要。请将之前的摘要与新的对话内容合并为一份新的摘要：
+- 保留用户的身份、偏好、目标、约定和尚未完成的事项
+- 保留重要的事实、数据、结论和决定
+- 省略寒暄和重复的内容
+- 使用对话所用的语言，不超过 {max_tokens} 个token
+只输出摘要内容。"""
+
+# 消息类型对应的角色名称
+_ROLE_NAMES = {"human": "用户", "ai": "助手", "system": "系统"}
+
+
+class ContextSummarizer:
+    """
+    上下文滚动摘要
+    保存上下文时超出预算被删除的消息放入待摘要列表，后台将它们与之前的摘要合并为新的摘要，
+    请求时摘要作为一条系统消息放在上下文前面，长对话不会丢失早期的信息
+    """
+    def __init__(self, max_tokens=CONTEXT_SUMMARY_MAX_TOKENS):
+        """
+        :param max_tokens: 摘要的最大token数量
+        """
+        self.max_tokens = max_tokens
+        self.folded = 0
+        self.failed = 0
+
+    @staticmethod
+    def summary_message(summary):
+        """摘要对应的系统消息"""
+        return SystemMessage(content=f"以下是之前对话的摘要：\n{summary}")
+
+    async def fold(self, redis_manager, key, model, model_type, model_name, context_limit=None):
+        """
+        将待摘要的消息合并到摘要中，同一上下文同时只有一个合并任务
+        :param key: 上下文键
+        :param model: 用于生成摘要的模型
+        :param context_limit: 自定义上下文限制，每次合并的消息不超过上下文限制的一半
+        """
+        _, pending = await redis_manager.get_context_pending(key, 1)
+        if not pending:
+            return
+        lease = ProducerLease(redis_manager, f"summary:{key}")
+        if not await lease.acquire():
+            return
+        try:
+            await lease.run(self._fold(redis_manager, key, model, model_type, model_name, context_limit))
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Context summary error ({key}): {str(e)}")
+
+    async def _fold(self, redis_manager, key, model, model_type, model_name, context_limit):
+        batch_tokens = context_token_limit(model_type, model_name, context_limit) // 2
+        while True:
+            offset, pending = await redis_manager.get_context_pending(key, 100)
+            batch = []
+            total = 0
+            for message in pending:
+                total += message_tokens(message, model_type, model_name)
+                if batch and total > batch_tokens:
+                    break
+                batch.append(message)
+            if not batch:
+                return
+            summary = await redis_manager.get_context_summary(key)
+            summary = await self.summarize(model, summary, batch)
+            await redis_manager.set_context_summary(key, summary, offset, len(batch))
+            self.folded += len(batch)
+
+    async def summarize(self, model, summary, messages):
+        """
+        将之前的摘要与新的消息合并为新的摘要
+        :param model: 用于生成摘要的模型
+        :param summary: 之前的摘要
+        :param messages: 新的上下文消息字典
+        """
+        lines = []
+        for message in messages:
+            role = _ROLE_NAMES.get(message.get("type"), message.get("type"))
+            lines.append(f"{role}: {convert_message_content_to_string(message.get('content') or '')}")
+        result = await model.ainvoke([
+            SystemMessage(content=SUMMARY_PROMPT.format(max_tokens=self.max_tokens)),
+            HumanMessage(content=f"之前的摘要：\n{summary or '（无）'}\n\n新的对话：\n" + "\n".join(lines)),
+        ])
+        text = remove_reasoning_content(replace_think_content(convert_message_content_to_string(result.content)))
+        if not text.strip():
+            raise ValueError("Empty summary")
+        return text.strip()
+
+    def stats(self):
+        """摘要统计"""
+        return {"folded": self.folded, "failed": self.failed}
+
+
+# 进程内共享的上下文摘要
+context_summarizer = ContextSummarizer()
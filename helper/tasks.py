@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+from .config import BACKGROUND_TASK_LIMIT
+
+logger = logging.getLogger("ai")
+
+
+class TaskSupervisor:
+    """
+    后台任务管理器
+    - 持有任务引用，避免运行中的任务被回收
+    - 限制同时运行的任务数，超过时排队等待
+    - 持有租约的生产者先占用运行名额再获取租约，租约不会在排队期间过期
+    - 统计排队、运行、完成、失败和取消的任务数
+    - 服务关闭时等待任务结束，超时后取消
+    """
+    def __init__(self, max_concurrency=BACKGROUND_TASK_LIMIT):
+        """
+        :param max_concurrency: 同时运行的最大任务数
+        """
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.tasks = set()
+        # 已占用运行名额但还没有开始运行的任务
+        self.reserved = {}
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        # 服务关闭时开始取消剩余任务，被取消的任务可以据此跳过收尾
+        self.closing = False
+
+    async def try_acquire(self):
+        """
+        立即占用一个运行名额，没有空闲名额时返回 False（不排队）
+        占用后必须调用 spawn(..., acquired=True) 或 release() 归还
+        """
+        semaphore = self._semaphore()
+        if semaphore.locked():
+            return False
+        await semaphore.acquire()
+        return True
+
+    async def acquire(self):
+        """占用一个运行名额，没有空闲名额时排队等待，占用后的处理同 try_acquire"""
+        semaphore = self._semaphore()
+        self.queued += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+    def release(self):
+        """归还占用后没有使用的运行名额"""
+        self._semaphore().release()
+
+    def spawn(self, coro, name=None, acquired=False):
+        """
+        启动后台任务
+        :param coro: 协程
+        :param name: 任务名称（用于日志）
+        :param acquired: 是否已通过 try_acquire / acquire 占用运行名额，为 True 时立即运行
+        :return: asyncio.Task，取消它会取消排队或运行中的协程
+        """
+        task = asyncio.create_task(self._run(coro, acquired), name=name)
+        self.tasks.add(task)
+        if acquired:
+            self.reserved[task] = coro
+        task.add_done_callback(self._task_done)
+        return task
+
+    async def drain(self, timeout):
+        """
+        等待全部任务结束（服务关闭时调用），超时后取消剩余任务
+        :param timeout: 等待时间（秒）
+        """
+        if not self.tasks:
+            return
+        logger.info(f"Waiting for {len(self.tasks)} background tasks")
+        _, pending = await asyncio.wait(list(self.tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"Cancelling {len(pending)} background tasks")
+            self.closing = True
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending, timeout=1)
+
+    def stats(self):
+        """任务统计"""
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    def _semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphore
+
+    async def _run(self, coro, acquired):
+        if acquired:
+            self.reserved.pop(asyncio.current_task(), None)
+        else:
+            try:
+                await self.acquire()
+            except BaseException:
+                # 排队时被取消，协程没有开始运行
+                coro.close()
+                raise
+        self.running += 1
+        try:
+            return await coro
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        coro = self.reserved.pop(task, None)
+        if coro is not None:
+            # 开始运行前被取消，协程没有运行，归还占用的名额
+            coro.close()
+            self.semaphore.release()
+        if task.cancelled():
+            self.cancelled += 1
+        elif task.exception() is not None:
+            self.failed += 1
+            logger.error(f"Background task failed ({task.get_name()})", exc_info=task.exception())
+        else:
+            self.completed += 1
+
+
+# 进程内共享的后台任务管理器
+task_supervisor = TaskSupervisor()
@@ -0,0 +1,122 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import TOKENIZER_WORKERS, TOKENIZER_OFFLOAD_CHARS
+from .redis import context_token_limit, get_encoding, select_messages, token_count_cache
+
+
+class TokenizerService:
+    """
+    批量计算token数量
+    - 先查询token数量缓存，只编码未缓存的文本
+    - 未缓存的文本总长度超过 offload_chars 时在线程池中编码（tiktoken 编码时释放 GIL），不阻塞事件循环
+    """
+    def __init__(self, workers=TOKENIZER_WORKERS, offload_chars=TOKENIZER_OFFLOAD_CHARS):
+        """
+        :param workers: 编码线程数
+        :param offload_chars: 在线程池中编码的最小字符数，为 0 时总是在线程池中编码
+        """
+        self.workers = workers
+        self.offload_chars = offload_chars
+        self.executor = None
+        self.inline = 0
+        self.offloaded = 0
+
+    async def count_many(self, texts, model_type, model_name):
+        """
+        计算多条文本的token数量
+        :param texts: 文本列表
+        :return: 与 texts 对应的token数量列表
+        """
+        encoding = get_encoding(model_type, model_name)
+        counts = [0] * len(texts)
+        missing = []
+        for index, text in enumerate(texts):
+            if not text:
+                continue
+            key = token_count_cache.make_key(encoding, text)
+            tokens = token_count_cache.get(key)
+            if tokens is None:
+                missing.append((index, key, text))
+            else:
+                counts[index] = tokens
+        if not missing:
+            return counts
+        batch = [text for _, _, text in missing]
+        if sum(map(len, batch)) >= self.offload_chars:
+            self.offloaded += 1
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tokenizer")
+            encoded = await asyncio.get_running_loop().run_in_executor(self.executor, self._encode_batch, encoding, batch)
+        else:
+            self.inline += 1
+            encoded = [len(encoding.encode(text)) for text in batch]
+        for (index, key, _), tokens in zip(missing, encoded):
+            counts[index] = tokens
+            token_count_cache.put(key, tokens)
+        return counts
+
+    async def with_token_counts(self, messages, model_type, model_name):
+        """
+        为上下文消息字典记录token数量（with_token_counts 的异步版本）
+        :param messages: 上下文消息字典列表
+        """
+        if not model_type:
+            return messages
+        encoding_name = get_encoding(model_type, model_name).name
+        pending = [message for message in messages if encoding_name not in (message.get("tokens") or {})]
+        counts = await self.count_many([message.get("content") for message in pending], model_type, model_name)
+        for message, tokens in zip(pending, counts):
+            message.setdefault("tokens", {})[encoding_name] = tokens
+        return messages
+
+    async def message_token_counts(self, messages, model_type, model_name):
+        """
+        上下文消息字典的token数量，优先使用保存时记录的数量，没有记录的（如旧版本的消息）批量计算并记录到消息中
+        :param messages: 上下文消息字典列表
+        :return: 与 messages 对应的token数量列表
+        """
+        encoding_name = get_encoding(model_type, model_name).name
+        counts = [(message.get("tokens") or {}).get(encoding_name) for message in messages]
+        pending = [index for index, tokens in enumerate(counts) if not isinstance(tokens, int)]
+        if pending:
+            computed = await self.count_many([messages[index].get("content") for index in pending], model_type, model_name)
+            for index, tokens in zip(pending, computed):
+                counts[index] = tokens
+                messages[index].setdefault("tokens", {})[encoding_name] = tokens
+        return counts
+
+    def close(self):
+        """关闭线程池（服务关闭时调用）"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self):
+        """编码统计"""
+        return {"inline": self.inline, "offloaded": self.offloaded}
+
+    def _encode_batch(self, encoding, texts):
+        # 已经在线程池中运行，逐条编码，不再为每次调用创建 encode_batch 的内部线程池
+        return [len(encoding.encode(text)) for text in texts]
+
+
+# 进程内共享的token计算服务
+tokenizer_service = TokenizerService()
+
+
+async def ahandle_context_limits(pre_context: list, middle_context: list, end_context: list, model_type: str = None, model_name: str = None, custom_limit: int = None, middle_tokens: list = None) -> list:
+    """
+    处理上下文，确保不超过模型token限制（handle_context_limits 的异步版本，较长的文本在线程池中编码）
+    :param middle_tokens: middle_context 每条消息的token数量（保存时记录的），为空时重新计算
+    """
+    if not (pre_context or middle_context or end_context):
+        return []
+    token_limit = context_token_limit(model_type, model_name, custom_limit)
+    messages = pre_context + end_context + (middle_context if middle_tokens is None else [])
+    counts = await tokenizer_service.count_many([msg.content for msg in messages], model_type, model_name)
+    pre_tokens = counts[:len(pre_context)]
+    end_tokens = counts[len(pre_context):len(pre_context) + len(end_context)]
+    if middle_tokens is None:
+        middle_tokens = counts[len(pre_context) + len(end_context):]
+    return select_messages(pre_context, middle_context, end_context, pre_tokens, middle_tokens, end_tokens, token_limit)
@@ -0,0 +1,110 @@
+import logging
+import threading
+
+import httpx
+
+from .config import (
+    HTTP2_ENABLED,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    CALLBACK_MAX_CONNECTIONS,
+    CALLBACK_KEEPALIVE_CONNECTIONS,
+)
+
+logger = logging.getLogger("ai")
+
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+class TransportRegistry:
+    """
+    HTTP 客户端注册表，每个 (代理, base_url) 共用一个保持连接的连接池
+    代理通过客户端参数传入，不再修改进程环境变量，走代理和直连的请求可以同时进行
+    安装了 h2 时启用 HTTP/2
+    """
+    def __init__(self, http2=HTTP2_ENABLED, max_connections=HTTP_MAX_CONNECTIONS,
+                 max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                 follow_redirects=True):
+        """
+        :param http2: 是否启用 HTTP/2（需要安装 h2）
+        :param max_connections: 每个连接池的最大连接数
+        :param max_keepalive_connections: 每个连接池的最大保持连接数
+        :param keepalive_expiry: 空闲连接的保持时间（秒）
+        :param follow_redirects: 是否跟随重定向
+        """
+        if http2 and not _HTTP2_AVAILABLE:
+            logger.warning("h2 is not installed, HTTP/2 is disabled (install httpx[http2])")
+        self.http2 = http2 and _HTTP2_AVAILABLE
+        self.follow_redirects = follow_redirects
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.async_clients = {}
+        self.sync_clients = {}
+        self.lock = threading.Lock()
+
+    def _client_kwargs(self, proxy):
+        return {
+            "proxy": proxy or None,
+            "http2": self.http2,
+            "follow_redirects": self.follow_redirects,
+            "timeout": httpx.Timeout(600, connect=10),
+            "limits": self.limits,
+        }
+
+    def get_async_client(self, proxy=None, base_url=None):
+        """
+        获取共享的异步客户端
+        :param proxy: 代理地址，为空时直连
+        :param base_url: 模型服务地址，不同服务使用不同的连接池
+        """
+        key = (proxy or None, base_url or None)
+        with self.lock:
+            client = self.async_clients.get(key)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(**self._client_kwargs(proxy))
+                self.async_clients[key] = client
+            return client
+
+    def get_client(self, proxy=None, base_url=None):
+        """获取共享的同步客户端，参数同 get_async_client"""
+        key = (proxy or None, base_url or None)
+        with self.lock:
+            client = self.sync_clients.get(key)
+            if client is None or client.is_closed:
+                client = httpx.Client(**self._client_kwargs(proxy))
+                self.sync_clients[key] = client
+            return client
+
+    async def aclose(self):
+        """关闭全部客户端（服务关闭时调用）"""
+        with self.lock:
+            async_clients = list(self.async_clients.values())
+            sync_clients = list(self.sync_clients.values())
+            self.async_clients.clear()
+            self.sync_clients.clear()
+        for client in async_clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Close http client error: {str(e)}")
+        for client in sync_clients:
+            client.close()
+
+
+# 进程内共享的模型服务客户端
+transport_registry = TransportRegistry()
+
+# 进程内共享的 DooTask 回调客户端，按 server_url 区分连接池
+callback_transport = TransportRegistry(
+    max_connections=CALLBACK_MAX_CONNECTIONS,
+    max_keepalive_connections=CALLBACK_KEEPALIVE_CONNECTIONS,
+    follow_redirects=False,
+)
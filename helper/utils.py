@@ -12,19 +12,107 @@ from langchain_community.chat_models import (
 from .deepseek import DeepseekChatOpenAI
 from .request import RequestClient
 from .redis import RedisManager
-import os
+from .config import MODEL_CACHE_SIZE, MODEL_CACHE_IDLE_TIMEOUT
+from .transport import transport_registry
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
 import time
 import json
 import re
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
+logger = logging.getLogger("ai")
+
 # 预编译正则表达式
 _THINK_START_PATTERN = re.compile(r'<think>\s*')
 _THINK_END_PATTERN = re.compile(r'\s*</think>')
 _REASONING_PATTERN = re.compile(r'::: reasoning\n.*?:::', re.DOTALL)
 
+class ModelInstanceCache:
+    """
+    模型实例缓存，按模型配置的哈希缓存（线程安全）
+    同一配置的请求复用模型实例及其 SDK 客户端的长连接，避免每次请求重新建立 TLS 连接
+    超过容量时淘汰最久未使用的实例，空闲超过 idle_timeout 的实例自动淘汰
+    """
+    def __init__(self, maxsize=MODEL_CACHE_SIZE, idle_timeout=MODEL_CACHE_IDLE_TIMEOUT):
+        """
+        :param maxsize: 最多缓存的实例数，为 0 时不缓存
+        :param idle_timeout: 空闲实例的保持时间（秒）
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**config):
+        """模型配置的哈希"""
+        raw = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key, factory):
+        """获取缓存的实例，不存在时调用 factory 创建"""
+        if self.maxsize <= 0:
+            return factory()
+        now = time.monotonic()
+        with self.lock:
+            self._evict_idle(now)
+            entry = self.entries.get(key)
+            if entry:
+                entry[1] = now
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # 创建实例不持有锁，并发创建同一配置时保留先完成的实例
+        instance = factory()
+        with self.lock:
+            entry = self.entries.setdefault(key, [instance, now])
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """缓存统计"""
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _evict_idle(self, now):
+        # 按最近使用排序，从最久未使用的开始检查
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[1] < self.idle_timeout:
+                break
+            del self.entries[key]
+
+
+# 进程内共享的模型实例缓存
+model_cache = ModelInstanceCache()
+
 def get_model_instance(model_type, model_name, api_key, **kwargs):
-    """根据模型类型返回对应的模型实例"""
+    """根据模型类型返回对应的模型实例（相同配置复用缓存的实例）"""
+    config = {
+        "base_url": kwargs.get("base_url", None),
+        "agency": kwargs.get("agency", None),
+        "temperature": kwargs.get("temperature", 0.7),
+        "max_tokens": kwargs.get("max_tokens", 0),
+        "thinking": kwargs.get("thinking", 0),
+        "streaming": kwargs.get("streaming", True),
+    }
+    key = ModelInstanceCache.make_key(model_type=model_type, model_name=model_name, api_key=api_key, **config)
+    return model_cache.get(key, lambda: create_model_instance(model_type, model_name, api_key, **config))
+
+def create_model_instance(model_type, model_name, api_key, **kwargs):
+    """根据模型类型创建新的模型实例"""
 
     base_url = kwargs.get("base_url", None)
     agency = kwargs.get("agency", None)
@@ -55,10 +143,6 @@ def get_model_instance(model_type, model_name, api_key, **kwargs):
         "grok": (ChatXAI, None),
     }
 
-    if agency:
-        os.environ["https_proxy"] = agency
-        os.environ["http_proxy"] = agency
-
     try:
         model_class, config = model_configs.get(model_type, (None, None))
         if model_class is None:
@@ -75,6 +159,24 @@ def get_model_instance(model_type, model_name, api_key, **kwargs):
         if base_url:
             config.update({"base_url": base_url})
 
+        # 代理和连接池通过客户端参数注入，不修改进程环境变量
+        if model_type in ("openai", "deepseek", "grok"):
+            config.update({
+                "http_async_client": transport_registry.get_async_client(agency, base_url),
+                "http_client": transport_registry.get_client(agency, base_url),
+            })
+        elif agency:
+            if model_type == "claude":
+                config.update({"anthropic_proxy": agency})
+            elif model_type == "gemini":
+                config.update({"client_args": {"proxy": agency}})
+            elif model_type == "ollama":
+                config.update({"client_kwargs": {"proxy": agency}})
+            else:
+                # 这些 SDK 在请求时自行创建连接，无法按实例指定代理，不能静默直连
+                raise ValueError(f"Proxy (agency) is not supported for model type: {model_type}, "
+                                 f"set HTTPS_PROXY for the service process instead")
+
         if max_tokens > 0:
             config.update({"max_tokens": max_tokens})
 
@@ -96,10 +198,6 @@ def get_model_instance(model_type, model_name, api_key, **kwargs):
         return model_class(**config)
     except Exception as e:
         raise RuntimeError(f"Failed to create model instance: {str(e)}")
-    finally:
-        if agency:
-            os.environ.pop("https_proxy", None)
-            os.environ.pop("http_proxy", None)
 
 def check_timeouts():
     redis_manager = RedisManager()
@@ -208,6 +306,150 @@ def remove_reasoning_content(text):
         text = _REASONING_PATTERN.sub('', text)
     return text
 
+def _partial_suffix_length(text, token):
+    """text 结尾与 token 前缀重合的最大长度（不含完整 token）"""
+    for length in range(min(len(token) - 1, len(text)), 0, -1):
+        if text.endswith(token[:length]):
+            return length
+    return 0
+
+
+class TagReplacer:
+    """
+    流式标签替换，与对完整文本执行一次正则替换的结果一致
+    结尾可能是标签一部分的内容会暂存，等待下一个分块再决定
+    """
+    def __init__(self, tag, replacement, strip_before=False, strip_after=False):
+        """
+        :param tag: 要替换的标签
+        :param replacement: 替换内容
+        :param strip_before: 是否同时去除标签前的空白（相当于 \\s*tag）
+        :param strip_after: 是否同时去除标签后的空白（相当于 tag\\s*）
+        """
+        self.tag = tag
+        self.replacement = replacement
+        self.strip_before = strip_before
+        self.strip_after = strip_after
+        self._pending = ""
+        self._skip_space = False
+
+    def feed(self, text):
+        if self._skip_space:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._skip_space = False
+        buffer = self._pending + text
+        output = []
+        index = buffer.find(self.tag)
+        while index >= 0:
+            before = buffer[:index]
+            output.append(before.rstrip() if self.strip_before else before)
+            output.append(self.replacement)
+            buffer = buffer[index + len(self.tag):]
+            if self.strip_after:
+                buffer = buffer.lstrip()
+                if not buffer:
+                    self._skip_space = True
+            index = buffer.find(self.tag)
+        # 暂存可能是标签开头的结尾部分，以及可能被去除的结尾空白
+        keep = _partial_suffix_length(buffer, self.tag)
+        emit = buffer[:len(buffer) - keep]
+        if self.strip_before:
+            keep += len(emit) - len(emit.rstrip())
+        self._pending = buffer[len(buffer) - keep:] if keep else ""
+        output.append(buffer[:len(buffer) - keep])
+        return "".join(output)
+
+    def flush(self):
+        pending, self._pending = self._pending, ""
+        return pending
+
+
+class BlockRemover:
+    """
+    流式去除 start ... end 块（非贪婪），与 remove_reasoning_content 的结果一致
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self._pending = ""
+        self._inside = False
+        self._block = []
+
+    def feed(self, text):
+        buffer = self._pending + text
+        output = []
+        while True:
+            if self._inside:
+                index = buffer.find(self.end)
+                if index < 0:
+                    break
+                # 块已闭合，丢弃块内内容
+                self._block = []
+                buffer = buffer[index + len(self.end):]
+            else:
+                index = buffer.find(self.start)
+                if index < 0:
+                    break
+                output.append(buffer[:index])
+                buffer = buffer[index + len(self.start):]
+            self._inside = not self._inside
+        keep = _partial_suffix_length(buffer, self.end if self._inside else self.start)
+        self._pending = buffer[len(buffer) - keep:] if keep else ""
+        if self._inside:
+            self._block.append(buffer[:len(buffer) - keep])
+        else:
+            output.append(buffer[:len(buffer) - keep])
+        return "".join(output)
+
+    def flush(self):
+        # 未闭合的块按原样保留，与正则不匹配时的行为一致
+        if self._inside:
+            pending = self.start + "".join(self._block) + self._pending
+        else:
+            pending = self._pending
+        self._pending = ""
+        self._inside = False
+        self._block = []
+        return pending
+
+
+class StreamTransformer:
+    """
+    流式输出转换管道，按顺序把分块交给各阶段处理，每个分块的处理时间只与分块大小有关
+    """
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def feed(self, text):
+        for stage in self.stages:
+            if not text:
+                break
+            text = stage.feed(text)
+        return text
+
+    def flush(self):
+        text = ""
+        for stage in self.stages:
+            text = stage.feed(text) if text else ""
+            text += stage.flush()
+        return text
+
+
+def think_transformer():
+    """流式版本的 replace_think_content"""
+    return StreamTransformer(
+        TagReplacer('<think>', '::: reasoning\n', strip_after=True),
+        TagReplacer('</think>', '\n:::', strip_before=True),
+    )
+
+
+def reasoning_remover():
+    """流式版本的 remove_reasoning_content"""
+    return StreamTransformer(BlockRemover('::: reasoning\n', ':::'))
+
+
 def process_html_content(text):
     """
     处理HTML内容，替换图片标签
@@ -1,25 +1,32 @@
-from types import SimpleNamespace
 from pathlib import Path
 from fastapi import FastAPI, Request, Header
 from fastapi.concurrency import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
-from helper.utils import convert_message_content_to_string, dict_to_message, get_model_instance, get_swagger_ui, json_empty, json_error, json_content, message_to_dict, remove_tool_calls, replace_think_content, remove_reasoning_content, process_html_content
+from helper.utils import dict_to_message, get_model_instance, get_swagger_ui, json_error, message_to_dict, replace_think_content, remove_reasoning_content, process_html_content, think_transformer, reasoning_remover
 from helper.request import RequestClient
 from helper.invoke import parse_context, build_invoke_stream_key
-from helper.redis import handle_context_limits, RedisManager
-from helper.config import SERVER_PORT, CLEAR_COMMANDS, STREAM_TIMEOUT, END_CONVERSATION_MARK
+from helper.redis import context_token_limit, token_count_cache, RedisManager
+from helper.tokenizer import ahandle_context_limits, tokenizer_service
+from helper.config import SERVER_PORT, CLEAR_COMMANDS, END_CONVERSATION_MARK, STREAM_MODE, PRODUCER_MAX_RESTARTS, STREAM_EAGER, MCP_SERVER_URL, BACKGROUND_TASK_DRAIN_TIMEOUT, CONTEXT_SUMMARY_ENABLED
+from helper.chunks import ChunkDecoder
+from helper.agent import agent_cache
+from helper.mcp import mcp_session_pool, mcp_tools_cache
+from helper.outbox import callback_outbox
+from helper.tasks import task_supervisor
+from helper.summary import context_summarizer
+from helper.transport import callback_transport, transport_registry
+from helper.stream import ProducerLease, StreamPublisher, finished_events, parse_event_id, stream_consumer
 import json
 import time
 import random
 import string
 import httpx
-from langchain_mcp_adapters.client import MultiServerMCPClient
 import asyncio
+from functools import partial
 from exceptiongroup import ExceptionGroup
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, AIMessageChunk
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
-from langchain.agents import create_agent 
 from helper.models import ModelListError, get_models_list
 import logging
 logging.basicConfig(
@@ -52,6 +59,11 @@ async def check_website_async(app: FastAPI):
         app.state.mcp = False
         logger.error(f"❌ 检测MCP失败: {url} - 错误: {e}")
 
+def log_task_error(task):
+    """常驻后台任务异常退出时记录错误"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed ({task.get_name()})", exc_info=task.exception())
+
 async def periodic_check(app: FastAPI):
     """定时检测任务"""
     while True:
@@ -63,9 +75,12 @@ async def lifespan(app: FastAPI):
     # 启动时初始化
     try:
         task = asyncio.create_task(periodic_check(app))
+        outbox_task = asyncio.create_task(callback_outbox.run(), name="callback_outbox")
+        outbox_task.add_done_callback(log_task_error)
         redis_manager = RedisManager()
-        logger.info("✅ 初始化成功")
         app.state.redis_manager = redis_manager
+        await redis_manager.load_codec_dictionaries()
+        logger.info("✅ 初始化成功")
     except Exception as e:
         logger.info(f"❌ 初始化失败: {str(e)}")
     yield
@@ -76,6 +91,14 @@ async def lifespan(app: FastAPI):
     except asyncio.CancelledError:
         pass
     logger.info("✅ 定时任务已停止")
+    await task_supervisor.drain(BACKGROUND_TASK_DRAIN_TIMEOUT)
+    outbox_task.cancel()
+    await asyncio.gather(outbox_task, return_exceptions=True)
+    await callback_outbox.close()
+    await mcp_session_pool.close()
+    await transport_registry.aclose()
+    await callback_transport.aclose()
+    tokenizer_service.close()
     # 关闭时清理
     logger.info("🛑 AI服务正在关闭...")
 
@@ -95,6 +118,215 @@ app.add_middleware(
 )
 
 
+async def stream_generate(msg_id, msg_key, data, redis_manager, lease, mcp_url):
+    """
+    流式生成响应
+    :param mcp_url: MCP 服务地址
+    """
+
+    response = ""
+    interrupted = False
+    # 推送模式下每次有新内容立即发布，轮询模式下按间隔写入缓存
+    publisher = StreamPublisher(redis_manager, msg_key, interval=0 if STREAM_MODE == "push" else 0.1)
+    try:
+        # 接管中断的生成：清空已输出的内容，超过重试次数直接结束
+        if data.get("restarts"):
+            await publisher.reset()
+            if data["restarts"] > PRODUCER_MAX_RESTARTS:
+                raise Exception("Generation interrupted, please try again")
+        # 更新数据状态
+        data["status"] = "processing"
+        await redis_manager.set_input(msg_id, data)
+        # 获取对应的模型实例
+        model = get_model_instance(
+            model_type=data["model_type"],
+            model_name=data["model_name"],
+            api_key=data["api_key"],
+            base_url=data["base_url"],
+            agency=data["agency"],
+            temperature=data["temperature"],
+            max_tokens=data["max_tokens"],
+            thinking=data["thinking"],
+            streaming=True,
+        )
+
+        # 获取 MCP 工具
+        tools = []
+        if app.state.mcp:
+            tools = await mcp_tools_cache.get_tools(mcp_url, data.get("msg_user_token"))
+
+        # 前置上下文处理
+        pre_context = []
+
+        # 添加系统消息到上下文开始
+        if data["system_message"]:
+            pre_context.append(SystemMessage(content=data["system_message"]))
+
+        # 添加之前对话的摘要
+        if CONTEXT_SUMMARY_ENABLED:
+            summary = await redis_manager.get_context_summary(data["context_key"])
+            if summary:
+                pre_context.append(context_summarizer.summary_message(summary))
+
+        # 添加 before_text 到上下文
+        if data["before_text"]:
+            # 这些模型不支持连续的消息，需要在每条消息之间插入确认消息
+            models_need_confirmation = ["deepseek-reasoner", "deepseek-coder"]
+            if data["model_name"] in models_need_confirmation:
+                for msg in data["before_text"]:
+                    pre_context.append(msg)
+                    pre_context.append(AIMessage(content="好的，明白了。"))
+            else:
+                pre_context.extend(data["before_text"])
+
+        # 添加用户的新消息
+        end_context = [HumanMessage(content=data["text"])]
+
+        # 获取现有上下文，只读取可能放入上下文的最新消息
+        token_limit = context_token_limit(data["model_type"], data["model_name"], data["context_limit"])
+        # 较长的文本在线程池中计算token数量，不阻塞事件循环
+        prompt_tokens = await tokenizer_service.count_many([msg.content for msg in pre_context + end_context], data["model_type"], data["model_name"])
+        available_tokens = token_limit - sum(prompt_tokens)
+        # 没有记录token数量的旧消息同样批量计算，不阻塞事件循环
+        count_page = partial(tokenizer_service.message_token_counts, model_type=data["model_type"], model_name=data["model_name"])
+        middle_context = await redis_manager.get_context_tail(data["context_key"], available_tokens, count_page)
+
+        middle_messages = [dict_to_message(msg_dict) for msg_dict in middle_context]
+        # 使用保存时记录的token数量，只有新消息需要计算
+        middle_tokens = await count_page(middle_context)
+        # 处理模型限制
+        final_context = await ahandle_context_limits(
+            pre_context=pre_context,
+            middle_context=middle_messages,
+            end_context=end_context,
+            model_type=data["model_type"], 
+            model_name=data["model_name"], 
+            custom_limit=data["context_limit"],
+            middle_tokens=middle_tokens,
+        )
+        # 检查上下文是否超限
+        if not final_context:
+            raise Exception("Context limit exceeded")
+        # 分块解析
+        decoder = ChunkDecoder()
+        # 输出转换：think 标签替换，以及保存上下文时去除推理内容
+        transformer = think_transformer()
+        answer = reasoning_remover()
+        answer_parts = []
+        
+        agent = agent_cache.get_agent(model, tools)
+        
+        # 开始请求流式响应
+        async for msg, metadata in agent.astream({"messages": final_context}, stream_mode="messages"):
+            # 增量转换，只处理本次分块
+            text = transformer.feed(decoder.feed(msg, metadata))
+            if text:
+                answer_parts.append(answer.feed(text))
+                await publisher.append(text)
+
+        text = transformer.flush()
+        answer_parts.append(answer.feed(text) + answer.flush())
+        await publisher.append(text, force=True)
+        response = publisher.text
+
+        # 更新上下文
+        if response:    
+            contents = await tokenizer_service.with_token_counts([
+                message_to_dict(HumanMessage(content=data["text"])),
+                message_to_dict(AIMessage(content="".join(answer_parts)))
+            ], data["model_type"], data["model_name"])
+            await redis_manager.extend_contexts(data["context_key"], contents, data["model_type"], data["model_name"], data["context_limit"])
+            # 后台将超出预算的早期消息合并到摘要中
+            if CONTEXT_SUMMARY_ENABLED:
+                task_supervisor.spawn(
+                    context_summarizer.fold(redis_manager, data["context_key"], model, data["model_type"], data["model_name"], data["context_limit"]),
+                    name=f"context_summary:{data['context_key']}",
+                )
+
+    except asyncio.CancelledError:
+        interrupted = True
+        raise
+    except Exception as e:
+        # 处理异常
+        logger.exception(e)
+        response = str(e)
+    finally:
+        # 确保状态总是被更新（租约已被其他生产者接管，或服务关闭时被中断的生成除外，后者释放租约后由其他进程接管）
+        try:
+            if not (lease.lost or (interrupted and task_supervisor.closing)):
+                # 更新完整缓存
+                await publisher.publish(response, force=True)
+
+                # 更新数据状态
+                data["status"] = "finished"
+                data["response"] = response
+                await redis_manager.set_input(msg_id, data)
+
+                # 创建请求客户端
+                request_client = RequestClient(
+                    server_url=data["server_url"], 
+                    version=data["version"], 
+                    token=data["token"], 
+                    dialog_id=data["dialog_id"]
+                )
+
+                # 更新完整消息（通过发件箱发送，失败时重试）
+                await callback_outbox.enqueue(request_client, {
+                    "update_id": msg_id,
+                    "update_mark": "no",
+                    "text": response,
+                    "text_type": "md",
+                    "silence": "yes"
+                })
+
+                # 回调入队后再通知消费者结束，结束事件发出时回调已经持久化
+                await publisher.finish(response)
+        except Exception as e:
+            # 记录最终阶段的错误，但不影响主流程
+            logger.error(f"Error in cleanup: {str(e)}")
+
+async def cancel_unfinished_producer(redis_manager, input_key, producer_task):
+    """
+    消费结束后取消未完成的生产者（如消费超时）
+    已结束的生产者可能还在收尾（如释放租约），不再取消
+    """
+    if not producer_task or producer_task.done():
+        return
+    current_data = await redis_manager.get_input(input_key)
+    if not current_data or current_data["status"] != "finished":
+        producer_task.cancel()
+
+async def start_stream_producer(redis_manager, msg_id, mcp_url):
+    """
+    占用后台任务名额、获取生产者租约并启动生成，没有空闲名额、已有生产者或已结束时返回 None
+    先占用名额再获取租约，租约不会在排队期间过期；没有空闲名额时由查看者的流中心稍后重试
+    也用于接管租约过期的中断生成
+    """
+    if not await task_supervisor.try_acquire():
+        return None
+    producer_task = None
+    try:
+        msg_key = f"stream_msg_{msg_id}"
+        lease = ProducerLease(redis_manager, msg_key)
+        if not await lease.acquire():
+            return None
+        current_data = await redis_manager.get_input(msg_id)
+        if not current_data or current_data["status"] == "finished":
+            await lease.release()
+            return None
+        if current_data["status"] == "processing":
+            current_data["restarts"] = current_data.get("restarts", 0) + 1
+        producer_task = task_supervisor.spawn(
+            lease.run(stream_generate(msg_id, msg_key, current_data, redis_manager, lease, mcp_url)),
+            name=f"stream_generate:{msg_id}",
+            acquired=True,
+        )
+        return producer_task
+    finally:
+        if producer_task is None:
+            task_supervisor.release()
+
+
 @app.api_route("/chat", methods=["GET", "POST"])
 async def chat(request: Request):
     # 智能参数提取
@@ -179,11 +411,11 @@ async def chat(request: Request):
     if text in CLEAR_COMMANDS:
         await app.state.redis_manager.delete_context(context_key)
         # 调用回调
-        asyncio.ensure_future(request_client.call({
+        await callback_outbox.enqueue(request_client, {
             "notice": "上下文已清空",
             "silence": "yes",
             "source": "ai",
-        }, action='notice'))
+        }, action='notice')
         return JSONResponse(content={"code": 200, "data": {"desc": "Context cleared"}}, status_code=200)
 
     # 如果需要在请求前清空上下文
@@ -235,19 +467,23 @@ async def chat(request: Request):
         "response": "",
     })
 
+    # 预先生成：立即开始生成，客户端连接 /stream 后直接接收已生成的内容
+    if STREAM_EAGER:
+        await start_stream_producer(app.state.redis_manager, send_id, MCP_SERVER_URL)
+
     # 通知 stream 地址
-    asyncio.create_task(request_client.call({
+    await callback_outbox.enqueue(request_client, {
         "userid": msg_uid,
         "stream_url": f"/stream/{send_id}/{stream_key}",
         "source": "ai",
-    }, action='stream'))
+    }, action='stream')
 
     # 返回成功响应
     return JSONResponse(content={"code": 200, "data": {"id": send_id, "key": stream_key}}, status_code=200)
 
 # 处理流式响应
 @app.get('/stream/{msg_id}/{stream_key}')
-async def stream(msg_id: str, stream_key: str, host: str = Header("", alias="Host"), scheme: str = Header("http", alias="scheme")):
+async def stream(msg_id: str, stream_key: str, host: str = Header("", alias="Host"), scheme: str = Header("http", alias="scheme"), last_event_id: str = Header("", alias="Last-Event-ID")):
     if not stream_key:
         async def error_stream():
             yield f"id: {msg_id}\nevent: done\ndata: {json_error('No key')}\n\n"
@@ -276,192 +512,19 @@ async def stream(msg_id: str, stream_key: str, host: str = Header("", alias="Hos
             media_type='text/event-stream'
         )
 
+    # 客户端重连时从上次收到的位置（日志版本和偏移量）续传
+    resume = parse_event_id(last_event_id)
+
     # 如果 status 为 finished，直接返回
     if data["status"] == "finished":
         async def finished_stream():
-            yield f"id: {msg_id}\nevent: replace\ndata: {json_content(data['response'])}\n\n"
-            yield f"id: {msg_id}\nevent: done\ndata: {json_empty()}\n\n"
+            epoch = await app.state.redis_manager.stream_epoch(f"stream_msg_{msg_id}")
+            for event in finished_events(data['response'], resume, epoch=epoch):
+                yield event
         return StreamingResponse(
             finished_stream(),
             media_type='text/event-stream'
         )
-    tools = []
-    if app.state.mcp:
-        client = MultiServerMCPClient(
-            {
-                "dootask-task": {
-                    "url": f"{scheme}://{host}/apps/mcp_server/mcp",
-                    "transport": "streamable_http",
-                    "headers": {
-                        "token": data.get("msg_user_token","unknown")
-                    },
-                }
-            }
-        )
-        tools = await client.get_tools()
-    async def stream_generate(msg_id, msg_key, data, redis_manager):
-        """
-        流式生成响应
-        """
-
-        response = ""
-        try:
-            # 更新数据状态
-            data["status"] = "processing"
-            await redis_manager.set_input(msg_id, data)
-            # 获取对应的模型实例
-            model = get_model_instance(
-                model_type=data["model_type"],
-                model_name=data["model_name"],
-                api_key=data["api_key"],
-                base_url=data["base_url"],
-                agency=data["agency"],
-                temperature=data["temperature"],
-                max_tokens=data["max_tokens"],
-                thinking=data["thinking"],
-                streaming=True,
-            )
-
-            # 前置上下文处理
-            pre_context = []
-
-            # 添加系统消息到上下文开始
-            if data["system_message"]:
-                pre_context.append(SystemMessage(content=data["system_message"]))
-
-            # 添加 before_text 到上下文
-            if data["before_text"]:
-                # 这些模型不支持连续的消息，需要在每条消息之间插入确认消息
-                models_need_confirmation = ["deepseek-reasoner", "deepseek-coder"]
-                if data["model_name"] in models_need_confirmation:
-                    for msg in data["before_text"]:
-                        pre_context.append(msg)
-                        pre_context.append(AIMessage(content="好的，明白了。"))
-                else:
-                    pre_context.extend(data["before_text"])
-
-            # 获取现有上下文
-            middle_context = await redis_manager.get_context(data["context_key"])
-
-            middle_messages = []
-            if middle_context:
-                middle_messages = [dict_to_message(msg_dict) for msg_dict in middle_context]
-            # 添加用户的新消息
-            end_context = [HumanMessage(content=data["text"])]
-            # 处理模型限制
-            final_context = handle_context_limits(
-                pre_context=pre_context,
-                middle_context=middle_messages,
-                end_context=end_context,
-                model_type=data["model_type"], 
-                model_name=data["model_name"], 
-                custom_limit=data["context_limit"]
-            )
-            # 检查上下文是否超限
-            if not final_context:
-                raise Exception("Context limit exceeded")
-            # 缓存配置
-            cache_interval = 0.1  # 缓存间隔
-            last_cache_time = time.time()
-            # 状态变量
-            has_reasoning = False
-            is_response = False
-            
-            agent = create_agent(model, tools)
-            
-            # 开始请求流式响应
-            async for chunk in agent.astream({"messages": final_context}, stream_mode="messages"):
-                # logger.info(chunk)
-                msg, metadata = chunk
-                if "skip_stream" in metadata.get("tags", []):
-                    continue
-                # For some reason, astream("messages") causes non-LLM nodes to send extra messages.
-                # Drop them.
-                if not isinstance(msg, AIMessageChunk):
-                    continue
-
-                if hasattr(msg, 'content') and isinstance(msg.content, list):
-                    isContinue = True
-                    if msg.content:
-                        chunk = SimpleNamespace(**msg.content[0])
-                        if hasattr(chunk, 'type'):
-                            if chunk.type == 'thinking' and hasattr(chunk, 'thinking'):    
-                                chunk = SimpleNamespace(reasoning_content=chunk.thinking)
-                                isContinue = False
-                            elif chunk.type == 'reasoning' and hasattr(chunk, 'reasoning'):    
-                                chunk = SimpleNamespace(reasoning_content=chunk.reasoning)
-                                isContinue = False
-                            elif chunk.type == 'text' and hasattr(chunk, 'text'):
-                                chunk = SimpleNamespace(content=chunk.text)
-                                isContinue = False
-                    if isContinue:
-                        continue
-
-                if hasattr(msg, 'reasoning_content') and msg.reasoning_content and not is_response:
-                    if not has_reasoning:
-                        response += "::: reasoning\n"
-                        has_reasoning = True
-                    response += convert_message_content_to_string(msg.reasoning_content)
-                    response = replace_think_content(response)
-                    current_time = time.time()
-                    if current_time - last_cache_time >= cache_interval:
-                        await redis_manager.set_cache(msg_key, response, ex=STREAM_TIMEOUT)
-                        last_cache_time = current_time  
-                        
-                if hasattr(msg, 'content') and msg.content:
-                    if has_reasoning:
-                        response += "\n:::\n\n"
-                        has_reasoning = False
-                    is_response = True
-                    response += convert_message_content_to_string(remove_tool_calls(msg.content))
-                    response = replace_think_content(response)
-                    current_time = time.time()
-                    if current_time - last_cache_time >= cache_interval:
-                        await redis_manager.set_cache(msg_key, response, ex=STREAM_TIMEOUT)
-                        last_cache_time = current_time                    
-
-            # 更新上下文
-            if response:    
-                await redis_manager.extend_contexts(data["context_key"], [
-                    message_to_dict(HumanMessage(content=data["text"])),
-                    message_to_dict(AIMessage(content=remove_reasoning_content(response)))
-                ], data["model_type"], data["model_name"], data["context_limit"])
-
-        except Exception as e:
-            # 处理异常
-            logger.exception(e)
-            response = str(e)
-        finally:
-            # 确保状态总是被更新
-            try:
-                # 更新完整缓存
-                await redis_manager.set_cache(msg_key, response, ex=STREAM_TIMEOUT)
-
-                # 更新数据状态
-                data["status"] = "finished"
-                data["response"] = response
-                await redis_manager.set_input(msg_id, data)
-
-                # 创建请求客户端
-                request_client = RequestClient(
-                    server_url=data["server_url"], 
-                    version=data["version"], 
-                    token=data["token"], 
-                    dialog_id=data["dialog_id"]
-                )
-
-                # 更新完整消息
-                asyncio.ensure_future(request_client.call({
-                    "update_id": msg_id,
-                    "update_mark": "no",
-                    "text": response,
-                    "text_type": "md",
-                    "silence": "yes"
-                }))
-            except Exception as e:
-                # 记录最终阶段的错误，但不影响主流程
-                logger.error(f"Error in cleanup: {str(e)}")
-
     async def stream_producer():
         """
         流式生产者
@@ -469,56 +532,17 @@ async def stream(msg_id: str, stream_key: str, host: str = Header("", alias="Hos
 
         # 生成消息 key
         msg_key = f"stream_msg_{msg_id}"
-        producer_task = None
-        
-        # 如果是第一个请求，启动异步生产者
-        if await app.state.redis_manager.set_cache(msg_key, "", ex=STREAM_TIMEOUT, nx=True):
-            producer_task = asyncio.create_task(stream_generate(msg_id, msg_key, data, app.state.redis_manager))
+
+        # 如果是第一个请求（未开启预先生成），启动异步生产者
+        takeover = partial(start_stream_producer, app.state.redis_manager, msg_id, f"{scheme}://{host}/apps/mcp_server/mcp")
+        producer_task = await takeover()
 
         # 所有请求都作为消费者处理
-        wait_start = time.time()
-        last_response = ""
-        sleep_interval = 0.1  # 睡眠间隔
-        timeout_check_interval = 1.0  # 检查超时间隔
-        last_timeout_check = time.time()
-        check_status_interval = 0.2  # 检查完成状态间隔
-        last_status_check = time.time()
-        
-        while True:
-            current_time = time.time()
-            
-            # 检查超时
-            if current_time - last_timeout_check >= timeout_check_interval:
-                if current_time - wait_start > STREAM_TIMEOUT:
-                    yield f"id: {msg_id}\nevent: replace\ndata: {json_content('Request timeout')}\n\n"
-                    yield f"id: {msg_id}\nevent: done\ndata: {json_error('Timeout')}\n\n"
-                    if producer_task:
-                        producer_task.cancel()
-                    return
-                last_timeout_check = current_time
-
-            response = await app.state.redis_manager.get_cache(msg_key)
-            if response:
-                if not last_response:
-                    yield f"id: {msg_id}\nevent: replace\ndata: {json_content(response)}\n\n"
-                else:
-                    append_response = response[len(last_response):]
-                    if append_response:
-                        yield f"id: {msg_id}\nevent: append\ndata: {json_content(append_response)}\n\n"
-                last_response = response
-
-                # 只在有新响应时才检查状态
-                if current_time - last_status_check >= check_status_interval:
-                    current_data = await app.state.redis_manager.get_input(msg_id)
-                    if current_data and current_data["status"] == "finished":
-                        yield f"id: {msg_id}\nevent: done\ndata: {json_empty()}\n\n"
-                        if producer_task:
-                            producer_task.cancel()
-                        return
-                    last_status_check = current_time
-
-            # 睡眠等待
-            await asyncio.sleep(sleep_interval)
+        async for event in stream_consumer(app.state.redis_manager, msg_id, msg_key, resume, takeover=takeover):
+            yield event
+
+        # 消费完成（结束或超时）后取消未完成的生产者
+        await cancel_unfinished_producer(app.state.redis_manager, msg_id, producer_task)
 
     # 返回流式响应
     return StreamingResponse(
@@ -602,7 +626,7 @@ async def invoke_auth(request: Request, token: str = Header(..., alias="Authoriz
 # 处理直接请求
 @app.post('/invoke/stream/{stream_key}')
 @app.get('/invoke/stream/{stream_key}')
-async def invoke(request: Request, stream_key: str):
+async def invoke(request: Request, stream_key: str, last_event_id: str = Header("", alias="Last-Event-ID")):
     if not stream_key:
         async def error_stream():
             yield f"id: {stream}\nevent: done\ndata: {json_error('No key')}\n\n"
@@ -622,16 +646,51 @@ async def invoke(request: Request, stream_key: str):
         )
 
 
+    # 客户端重连时从上次收到的位置（日志版本和偏移量）续传
+    resume = parse_event_id(last_event_id)
+    msg_key = f"stream_msg_{storage_key}"
+
     # 如果 status 为 finished，直接返回
     if data["status"] == "finished" and data.get("response"):
         async def finished_stream():
-            yield f"id: {stream_key}\nevent: replace\ndata: {json_content(data['response'])}\n\n"
-            yield f"id: {stream_key}\nevent: done\ndata: {json_empty()}\n\n"
+            epoch = await app.state.redis_manager.stream_epoch(msg_key)
+            for event in finished_events(data['response'], resume, data.get("error"), epoch):
+                yield event
         return StreamingResponse(
             finished_stream(),
             media_type='text/event-stream'
         )    
-    
+
+    async def interrupt_stream():
+        """
+        生产者租约过期（所在进程退出）时结束流并返回错误，直连请求的上下文不支持重新生成
+        """
+        redis_manager = app.state.redis_manager
+        lease = ProducerLease(redis_manager, msg_key)
+        if not await lease.acquire():
+            return None
+        try:
+            current_data = await redis_manager.get_input(storage_key)
+            if not current_data or current_data["status"] == "finished":
+                return None
+            error = "Generation interrupted, please try again"
+            publisher = StreamPublisher(redis_manager, msg_key)
+            current_data["status"] = "finished"
+            current_data["response"] = (await redis_manager.read_stream(msg_key)) or error
+            current_data["error"] = error
+            await redis_manager.set_input(storage_key, current_data)
+            await publisher.finish(current_data["response"], error)
+        finally:
+            await lease.release()
+        return None
+
+    # 生成中的流只允许携带 Last-Event-ID 的重连续传
+    if data.get("status") == "processing" and resume is not None:
+        return StreamingResponse(
+            stream_consumer(app.state.redis_manager, storage_key, msg_key, resume, takeover=interrupt_stream),
+            media_type='text/event-stream'
+        )
+
     if data.get("status") == "processing":
         async def processing_stream():
             yield f"id: {stream_key}\nevent: done\ndata: {json_error('Stream is processing')}\n\n"
@@ -666,19 +725,8 @@ async def invoke(request: Request, stream_key: str):
         host = request.headers.get("Host")
         tools = []
         if app.state.mcp:
-            client = MultiServerMCPClient(
-                {
-                    "dootask-task": {
-                        "url": f"https://{host}/apps/mcp_server/mcp",
-                        "transport": "streamable_http",
-                        "headers": {
-                            "token": data.get("user_token","unknown")
-                        },
-                    }
-                }
-            )
-            tools = await client.get_tools()
-        agent = create_agent(model, tools)
+            tools = await mcp_tools_cache.get_tools(f"https://{host}/apps/mcp_server/mcp", data.get("user_token"))
+        agent = agent_cache.get_agent(model, tools)
 
     except Exception as exc:
         async def model_error_stream():
@@ -688,75 +736,69 @@ async def invoke(request: Request, stream_key: str):
             media_type='text/event-stream'
         )
 
-    async def stream_invoke_response():
+    async def invoke_generate(redis_manager, lease):
+        """
+        直连流式生成响应，写入流日志供当前连接和重连的客户端读取
+        """
         response_text = ""
-        last_sent = ""
-        has_reasoning = False
-        is_response = False
-        data["status"] = "processing"
-        await app.state.redis_manager.set_input(storage_key, data)
+        error = None
+        interrupted = False
+        decoder = ChunkDecoder()
+        transformer = think_transformer()
+        publisher = StreamPublisher(redis_manager, msg_key, interval=0 if STREAM_MODE == "push" else 0.1)
         try:
-            async for chunk in agent.astream({"messages": final_context}, stream_mode="messages"):
-                # logger.info(chunk)
-                msg, metadata = chunk
-                if "skip_stream" in metadata.get("tags", []):
-                    continue
-                # For some reason, astream("messages") causes non-LLM nodes to send extra messages.
-                # Drop them.
-                if not isinstance(msg, AIMessageChunk):
-                    continue
-                if hasattr(chunk, "content") and isinstance(msg.content, list):
-                    should_continue = True
-                    if msg.content:
-                        chunk = SimpleNamespace(**msg.content[0])
-                        if hasattr(chunk, "type"):
-                            if chunk.type == "thinking" and hasattr(chunk, "thinking"):
-                                chunk = SimpleNamespace(reasoning_content=chunk.thinking)
-                                should_continue = False
-                            elif chunk.type == "reasoning" and hasattr(chunk, "reasoning"):
-                                chunk = SimpleNamespace(reasoning_content=chunk.reasoning)
-                                should_continue = False
-                            elif chunk.type == "text" and hasattr(chunk, "text"):
-                                chunk = SimpleNamespace(content=chunk.text)
-                                should_continue = False
-                    if should_continue:
-                        continue
-
-                if hasattr(msg, "reasoning_content") and msg.reasoning_content and not is_response:
-                    if not has_reasoning:
-                        response_text += "::: reasoning\n"
-                        has_reasoning = True
-                    response_text += msg.reasoning_content
-                    response_text = replace_think_content(response_text)
-                if hasattr(msg, "content") and msg.content:
-                    if has_reasoning:
-                        response_text += "\n:::\n\n"
-                        has_reasoning = False
-                    is_response = True
-                    response_text += msg.content
-                    response_text = replace_think_content(response_text)
-
-                if response_text != last_sent:
-                    if last_sent and response_text.startswith(last_sent):
-                        delta = response_text[len(last_sent):]
-                        event_type = "append"
-                    else:
-                        delta = response_text
-                        event_type = "replace"
-                    if delta:
-                        yield f"id: {stream_key}\nevent: {event_type}\ndata: {json_content(delta)}\n\n"
-                    last_sent = response_text
-
-            data["status"] = "finished"
-            data["response"] = response_text
-            app.state.redis_manager.set_input(storage_key, data)
-            yield f"id: {stream_key}\nevent: done\ndata: {json_empty()}\n\n"
+            async for msg, metadata in agent.astream({"messages": final_context}, stream_mode="messages"):
+                # 增量转换，只处理本次分块
+                await publisher.append(transformer.feed(decoder.feed(msg, metadata)))
+            await publisher.append(transformer.flush(), force=True)
+            response_text = publisher.text
+        except asyncio.CancelledError:
+            interrupted = True
+            raise
         except Exception as exc:
-            data["status"] = "finished"
-            data["response"] = response_text or str(exc)
-            data["error"] = str(exc)
-            app.state.redis_manager.set_input(storage_key, data)
-            yield f"id: {stream_key}\nevent: done\ndata: {json_error(str(exc))}\n\n"
+            logger.exception(exc)
+            error = str(exc)
+            response_text = publisher.text or error
+        finally:
+            try:
+                # 服务关闭时被中断的生成不写入结果，由重连的客户端按中断处理
+                if not (lease.lost or (interrupted and task_supervisor.closing)):
+                    await publisher.publish(response_text, force=True)
+                    data["status"] = "finished"
+                    data["response"] = response_text
+                    if error:
+                        data["error"] = error
+                    await redis_manager.set_input(storage_key, data)
+                    await publisher.finish(response_text, error)
+            except Exception as e:
+                logger.error(f"Error in cleanup: {str(e)}")
+
+    async def stream_invoke_response():
+        # 先占用后台任务名额（名额已满时排队），再获取租约，租约不会在排队期间过期
+        await task_supervisor.acquire()
+        producer_task = None
+        try:
+            # 同一请求只允许一个生产者，并发的重复请求按生成中处理
+            lease = ProducerLease(app.state.redis_manager, msg_key)
+            if not await lease.acquire():
+                yield f"id: {stream_key}\nevent: done\ndata: {json_error('Stream is processing')}\n\n"
+                return
+            data["status"] = "processing"
+            await app.state.redis_manager.set_input(storage_key, data)
+            # 生成在后台执行，客户端断开后仍会完成，重连时可续传
+            producer_task = task_supervisor.spawn(
+                lease.run(invoke_generate(app.state.redis_manager, lease)),
+                name=f"invoke_generate:{storage_key}",
+                acquired=True,
+            )
+        finally:
+            if producer_task is None:
+                task_supervisor.release()
+        async for event in stream_consumer(app.state.redis_manager, storage_key, msg_key, resume, takeover=interrupt_stream):
+            yield event
+        # 消费完成（结束或超时）后取消未完成的生产者
+        await cancel_unfinished_producer(app.state.redis_manager, storage_key, producer_task)
+
     return StreamingResponse(
         stream_invoke_response(),
         media_type='text/event-stream'
@@ -821,19 +863,8 @@ async def invoke_synch(request: Request, token: str = Header(..., alias="Authori
         host = request.headers.get("Host")
         tools = []
         if app.state.mcp:
-            client = MultiServerMCPClient(
-                {
-                    "dootask-task": {
-                        "url": f"https://{host}/apps/mcp_server/mcp",
-                        "transport": "streamable_http",
-                        "headers": {
-                            "token": token or "unknown"
-                        },
-                    }
-                }
-            )
-            tools = await client.get_tools()
-        agent = create_agent(model, tools)
+            tools = await mcp_tools_cache.get_tools(f"https://{host}/apps/mcp_server/mcp", token)
+        agent = agent_cache.get_agent(model, tools)
     except Exception as exc:
         return JSONResponse(content={"code": 400, "error": str(exc)}, status_code=400)
 
@@ -905,7 +936,7 @@ async def health():
     try:
 
         await app.state.redis_manager.client.ping()
-        return JSONResponse(content={"status": "healthy", "redis": "connected"}, status_code=200)
+        return JSONResponse(content={"status": "healthy", "redis": "connected", "tasks": task_supervisor.stats(), "token_cache": token_count_cache.stats(), "tokenizer": tokenizer_service.stats(), "summary": context_summarizer.stats()}, status_code=200)
     except Exception as e:
         return JSONResponse(content={"status": "unhealthy", "error": str(e)}, status_code=500)
 
@@ -0,0 +1,50 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import timeit
+from types import SimpleNamespace
+from langchain_core.messages import AIMessageChunk
+from helper.chunks import decode_chunk
+
+# 各模型典型的流式分块
+CHUNK_SHAPES = {
+    "claude": AIMessageChunk(content=[{"type": "text", "text": "Hello, world", "index": 1}]),
+    "claude-thinking": AIMessageChunk(content=[{"type": "thinking", "thinking": "Let me think", "index": 0}]),
+    "openai-reasoning": AIMessageChunk(content=[{
+        "type": "reasoning",
+        "summary": [{"index": 0, "type": "summary_text", "text": "Reasoning about it"}],
+        "index": 0,
+    }]),
+    "deepseek": AIMessageChunk(content="", reasoning_content="思考中"),
+    "plain": AIMessageChunk(content="Hello, world"),
+}
+
+
+def legacy_decode(msg):
+    """原实现：每个分块构造 SimpleNamespace 并逐个 hasattr 检查"""
+    if hasattr(msg, 'content') and isinstance(msg.content, list):
+        if msg.content:
+            chunk = SimpleNamespace(**msg.content[0])
+            if hasattr(chunk, 'type'):
+                if chunk.type == 'thinking' and hasattr(chunk, 'thinking'):
+                    chunk = SimpleNamespace(reasoning_content=chunk.thinking)
+                elif chunk.type == 'reasoning' and hasattr(chunk, 'reasoning'):
+                    chunk = SimpleNamespace(reasoning_content=chunk.reasoning)
+                elif chunk.type == 'text' and hasattr(chunk, 'text'):
+                    chunk = SimpleNamespace(content=chunk.text)
+    reasoning = msg.reasoning_content if hasattr(msg, 'reasoning_content') else None
+    return reasoning, msg.content
+
+
+def bench(number=200000):
+    """测试每个分块的解析耗时"""
+    print(f"{'shape':<18}{'legacy (ns)':>14}{'decode_chunk (ns)':>20}")
+    for name, msg in CHUNK_SHAPES.items():
+        legacy = timeit.timeit(lambda: legacy_decode(msg), number=number) / number * 1e9
+        current = timeit.timeit(lambda: decode_chunk(msg), number=number) / number * 1e9
+        print(f"{name:<18}{legacy:>14.0f}{current:>20.0f}")
+
+
+if __name__ == "__main__":
+    bench()
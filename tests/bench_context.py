@@ -0,0 +1,68 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import itertools
+import random
+import timeit
+from helper.redis import select_context
+
+
+def legacy_select(pre_tokens, middle_tokens, end_tokens, token_limit):
+    """原实现：逐条累加，middle_context 逐条插入到 end_context 之前"""
+    result = []
+    current_tokens = 0
+    for index, msg_tokens in enumerate(end_tokens):
+        if current_tokens + msg_tokens <= token_limit:
+            result.append(("end", index))
+            current_tokens += msg_tokens
+        else:
+            return result
+    for index, msg_tokens in enumerate(pre_tokens):
+        if current_tokens + msg_tokens <= token_limit:
+            result.insert(len(result) - len(end_tokens), ("pre", index))
+            current_tokens += msg_tokens
+        else:
+            break
+    temp_middle = []
+    for index in range(len(middle_tokens) - 1, -1, -1):
+        if current_tokens + middle_tokens[index] <= token_limit:
+            temp_middle.append(("middle", index))
+            current_tokens += middle_tokens[index]
+        else:
+            break
+    for item in reversed(temp_middle):
+        result.insert(len(result) - len(end_tokens), item)
+    return result
+
+
+def current_select(pre_tokens, middle_tokens, end_tokens, token_limit):
+    middle_sums = list(itertools.accumulate(middle_tokens))
+    pre_count, middle_start, end_count = select_context(pre_tokens, middle_sums, end_tokens, token_limit)
+    if end_count < len(end_tokens):
+        return [("end", index) for index in range(end_count)]
+    return ([("pre", index) for index in range(pre_count)]
+            + [("middle", index) for index in range(middle_start, len(middle_tokens))]
+            + [("end", index) for index in range(len(end_tokens))])
+
+
+def bench(size=10000, number=20):
+    """测试 10k 条历史消息的上下文选择耗时"""
+    rng = random.Random(0)
+    pre_tokens = [rng.randint(50, 500) for _ in range(3)]
+    middle_tokens = [rng.randint(10, 400) for _ in range(size)]
+    end_tokens = [rng.randint(10, 200)]
+    middle_sums = list(itertools.accumulate(middle_tokens))
+    build = timeit.timeit(lambda: list(itertools.accumulate(middle_tokens)), number=number) / number * 1e3
+    print(f"累计token数量构建耗时: {build:.3f} ms")
+    print(f"{'limit':>10}{'legacy (ms)':>14}{'select_context (ms)':>22}")
+    for token_limit in (4096, 128000, 1000000, sum(middle_tokens) * 2):
+        args = (pre_tokens, middle_tokens, end_tokens, token_limit)
+        assert legacy_select(*args) == current_select(*args)
+        legacy = timeit.timeit(lambda: legacy_select(*args), number=number) / number * 1e3
+        current = timeit.timeit(lambda: select_context(pre_tokens, middle_sums, end_tokens, token_limit), number=number) / number * 1e3
+        print(f"{token_limit:>10}{legacy:>14.2f}{current:>22.3f}")
+
+
+if __name__ == "__main__":
+    bench()
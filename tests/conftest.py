@@ -0,0 +1,20 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def redis_manager():
+    """使用 fakeredis 的 RedisManager（需要安装 fakeredis 和 lupa），测试结束后恢复原客户端"""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    from helper.redis import RedisManager
+    manager = RedisManager()
+    clients = manager.client, manager.binary_client
+    server = fakeredis.FakeServer()
+    manager.client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    manager.binary_client = fakeredis.FakeAsyncRedis(server=server)
+    yield manager
+    manager.client, manager.binary_client = clients
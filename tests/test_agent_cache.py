@@ -0,0 +1,45 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from langchain_core.tools import tool
+from helper.agent import AgentCache, agent_cache
+from helper.mcp import mcp_tools_cache
+from helper.utils import get_model_instance
+
+def make_tool(name):
+    @tool(name)
+    def lookup(query: str) -> str:
+        """查询"""
+        return query
+    return lookup
+
+def test_agent_reused_for_same_model_and_tools():
+    """相同模型和工具复用智能体，工具对象不同（如不同用户）时重新编译"""
+    cache = AgentCache(maxsize=4)
+    model = get_model_instance("openai", "gpt-4o", "sk-test")
+    tools = [make_tool("get_task")]
+    agent = cache.get_agent(model, tools)
+    assert cache.get_agent(model, list(tools)) is agent
+    assert cache.get_agent(model, []) is not agent
+    assert cache.get_agent(model, [make_tool("get_task")]) is not agent
+    cache.invalidate_tools(tools)
+    assert cache.get_agent(model, tools) is not agent
+
+def test_catalog_refresh_invalidates_agents():
+    """工具列表缓存刷新后，基于旧工具列表的智能体失效"""
+    async def run():
+        async def loader(url, token):
+            return [make_tool("get_task")]
+        original_loader, mcp_tools_cache.loader = mcp_tools_cache.loader, loader
+        try:
+            model = get_model_instance("openai", "gpt-4o", "sk-test")
+            tools = await mcp_tools_cache.get_tools("u", "t")
+            agent_cache.get_agent(model, tools)
+            assert agent_cache.make_key(model, tools) in agent_cache.entries
+            mcp_tools_cache.invalidate("u", "t")
+            assert agent_cache.make_key(model, tools) not in agent_cache.entries
+        finally:
+            mcp_tools_cache.loader = original_loader
+    asyncio.run(run())
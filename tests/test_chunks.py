@@ -0,0 +1,49 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessageChunk, ToolMessage
+from helper.chunks import ChunkDecoder, decode_chunk
+
+def test_decode_string_content():
+    """字符串正文直接返回"""
+    assert decode_chunk(AIMessageChunk(content="你好")) == ("", "你好")
+
+def test_decode_claude_blocks():
+    """Claude 的 thinking/text 内容块，忽略工具调用块"""
+    thinking = AIMessageChunk(content=[{"type": "thinking", "thinking": "想一想", "index": 0}])
+    text = AIMessageChunk(content=[{"type": "text", "text": "答案", "index": 1}])
+    tool = AIMessageChunk(content=[{"type": "tool_use", "id": "t1", "name": "search", "input": {}, "index": 2}])
+    assert decode_chunk(thinking) == ("想一想", "")
+    assert decode_chunk(text) == ("", "答案")
+    assert decode_chunk(tool) == ("", "")
+
+def test_decode_openai_reasoning_blocks():
+    """OpenAI 推理模型的 reasoning 内容块"""
+    summary = AIMessageChunk(content=[{"type": "reasoning", "summary": [{"type": "summary_text", "text": "分析"}]}])
+    standard = AIMessageChunk(content=[{"type": "reasoning", "reasoning": "分析"}])
+    assert decode_chunk(summary) == ("分析", "")
+    assert decode_chunk(standard) == ("分析", "")
+
+def test_decode_deepseek_reasoning():
+    """DeepSeek 的 reasoning_content 字段"""
+    custom = AIMessageChunk(content="", reasoning_content="推理")
+    kwargs = AIMessageChunk(content="", additional_kwargs={"reasoning_content": "推理"})
+    assert decode_chunk(custom) == ("推理", "")
+    assert decode_chunk(kwargs) == ("推理", "")
+
+def test_chunk_decoder_wraps_reasoning():
+    """推理内容包裹在 ::: reasoning 块中，正文开始后忽略推理内容"""
+    decoder = ChunkDecoder()
+    chunks = [
+        AIMessageChunk(content="", reasoning_content="先"),
+        AIMessageChunk(content="", reasoning_content="想"),
+        AIMessageChunk(content="答"),
+        AIMessageChunk(content="", reasoning_content="晚了"),
+        AIMessageChunk(content="案"),
+        AIMessageChunk(content="不输出"),
+    ]
+    metadata = [{}] * 5 + [{"tags": ["skip_stream"]}]
+    text = "".join(decoder.feed(msg, meta) for msg, meta in zip(chunks, metadata))
+    assert text == "::: reasoning\n先想\n:::\n\n答案"
+    assert decoder.feed(ToolMessage(content="tool", tool_call_id="t1"), {}) == ""
@@ -0,0 +1,45 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import pytest
+from helper.codec import StorageCodec, UnknownDictionaryError
+
+VALUE = {"text": "你好，今天的任务进度如何？" * 20, "status": "finished", "tokens": {"cl100k_base": 12}}
+
+@pytest.mark.parametrize("serializer, fmt", [("json", b"j"), ("orjson", b"j"), ("msgpack", b"m")])
+def test_round_trip_and_legacy_json(serializer, fmt):
+    """各序列化格式编码后可以解码，旧版本的 JSON 文本可以直接读取，中文不再转义"""
+    if serializer != "json":
+        pytest.importorskip(serializer)
+    codec = StorageCodec(serializer=serializer, compression=False)
+    data = codec.dumps(VALUE)
+    assert data[:2] == b"\x00" + fmt
+    assert codec.loads(data) == VALUE
+    assert len(data) < len(json.dumps(VALUE))
+    assert codec.loads(json.dumps(VALUE).encode()) == VALUE
+    assert codec.loads(json.dumps(VALUE)) == VALUE
+
+def test_msgpack_missing(monkeypatch):
+    """配置了 msgpack 但未安装时直接报错，不再静默改用 json"""
+    from helper import codec
+    monkeypatch.setattr(codec, "msgpack", None)
+    with pytest.raises(RuntimeError):
+        StorageCodec(serializer="msgpack")
+
+def test_compression_with_dictionary():
+    """使用字典压缩的值需要加载同一字典才能解码"""
+    pytest.importorskip("zstandard")
+    codec = StorageCodec(serializer="json", compression=True, compress_min_size=64)
+    samples = [codec.dumps({"text": f"第{i}条消息：会议讨论了项目进度和测试问题", "status": "finished"}, compress=False) for i in range(500)]
+    dictionary = codec.train_dictionary(samples, 4096)
+    codec.add_dictionary(dictionary, current=True)
+    data = codec.dumps(VALUE)
+    assert len(data) < len(codec.dumps(VALUE, compress=False))
+    assert codec.loads(data) == VALUE
+    reader = StorageCodec(serializer="json", compression=True)
+    with pytest.raises(UnknownDictionaryError):
+        reader.loads(data)
+    reader.add_dictionary(dictionary)
+    assert reader.loads(data) == VALUE
@@ -0,0 +1,186 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import json
+import random
+from functools import partial
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.language_models import FakeListChatModel
+from helper.redis import TokenCountCache, context_token_budget, count_tokens, handle_context_limits, message_tokens, with_token_counts, get_encoding
+from helper.summary import ContextSummarizer
+from helper.tokenizer import TokenizerService, ahandle_context_limits
+from tests.bench_context import current_select, legacy_select
+
+def test_stored_token_counts_are_trusted():
+    """保存时记录token数量，读取时不再重新计算；编码不同时重新计算"""
+    messages = with_token_counts([{"type": "human", "content": "你好"}], "openai", "gpt-4")
+    encoding_name = get_encoding("openai", "gpt-4").name
+    assert encoding_name in messages[0]["tokens"]
+    messages[0]["tokens"][encoding_name] = 7
+    with patch("helper.redis.count_tokens") as count:
+        assert message_tokens(messages[0], "openai", "gpt-4") == 7
+        count.assert_not_called()
+    assert message_tokens({"type": "human", "content": "你好", "tokens": {"other": 7}}, "openai", "gpt-4") != 7
+
+def test_context_limits_use_middle_tokens():
+    """middle_context 使用传入的token数量，优先保留最新的消息"""
+    pre = [SystemMessage(content="s")]
+    middle = [HumanMessage(content="a"), AIMessage(content="b"), HumanMessage(content="c")]
+    end = [HumanMessage(content="d")]
+    result = handle_context_limits(pre, middle, end, "openai", "gpt-4", custom_limit=12, middle_tokens=[5, 5, 5])
+    assert [m.content for m in result] == ["s", "b", "c", "d"]
+
+def test_token_count_cache():
+    """相同文本只编码一次，超过容量时淘汰最久未使用的"""
+    cache = TokenCountCache(maxsize=2)
+    encoding = get_encoding("openai", "gpt-4")
+    assert get_encoding("openai", "gpt-4") is encoding
+    first = cache.count(encoding, "系统消息")
+    assert cache.count(encoding, "系统消息") == first
+    cache.count(encoding, "b")
+    cache.count(encoding, "c")
+    cache.count(encoding, "系统消息")
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 4}
+
+def test_select_context_matches_legacy():
+    """二分查找的选择结果与原来逐条累加的结果一致（包括0个token的消息和 end_context 超限）"""
+    rng = random.Random(1)
+    for _ in range(500):
+        pre = [rng.choice([0, rng.randint(1, 30)]) for _ in range(rng.randint(0, 3))]
+        middle = [rng.choice([0, rng.randint(1, 30)]) for _ in range(rng.randint(0, 30))]
+        end = [rng.randint(0, 30) for _ in range(rng.randint(0, 2))]
+        limit = rng.randint(0, 400)
+        assert current_select(pre, middle, end, limit) == legacy_select(pre, middle, end, limit)
+
+class FakeSummaryRedis:
+    """保存待摘要消息和摘要的内存实现"""
+    def __init__(self, pending):
+        self.pending = pending
+        self.summary = "旧摘要"
+        self.leases = {}
+
+    async def get_context_pending(self, key, count=-1):
+        return 0, self.pending[:count] if count > 0 else list(self.pending)
+
+    async def get_context_summary(self, key):
+        return self.summary
+
+    async def set_context_summary(self, key, summary, offset, folded):
+        self.summary = summary
+        self.pending = self.pending[folded:]
+
+    async def acquire_lease(self, key, token, ttl):
+        return self.leases.setdefault(key, token) == token
+
+    async def release_lease(self, key, token):
+        self.leases.pop(key, None)
+
+def test_summary_folds_pending_messages():
+    """待摘要的消息与之前的摘要合并为新的摘要，合并后从待摘要列表删除"""
+    pending = [{"type": "human", "content": "我叫小明"}, {"type": "ai", "content": "你好小明"}]
+    redis_manager = FakeSummaryRedis(pending)
+    model = FakeListChatModel(responses=["用户叫小明"])
+    summarizer = ContextSummarizer(max_tokens=100)
+    asyncio.run(summarizer.fold(redis_manager, "k", model, "openai", "gpt-4"))
+    assert redis_manager.summary == "用户叫小明"
+    assert redis_manager.pending == []
+    assert summarizer.stats() == {"folded": 2, "failed": 0}
+    assert "用户叫小明" in summarizer.summary_message(redis_manager.summary).content
+
+def test_tokenizer_service_offloads_large_batches():
+    """较长的文本在线程池中批量编码，结果与同步计算一致并写入缓存；异步上下文处理结果与同步版本一致"""
+    service = TokenizerService(workers=2, offload_chars=1000)
+    texts = ["长文本" * 1000, "", "短文本 batch"]
+    counts = asyncio.run(service.count_many(texts, "openai", "gpt-4"))
+    assert counts == [count_tokens(text, "openai", "gpt-4") for text in texts]
+    assert service.stats() == {"inline": 0, "offloaded": 1}
+    asyncio.run(service.count_many(texts, "openai", "gpt-4"))
+    assert service.stats() == {"inline": 0, "offloaded": 1}
+    service.close()
+
+    pre = [SystemMessage(content="s" * 30)]
+    middle = [HumanMessage(content="m" * (i * 7)) for i in range(20)]
+    end = [HumanMessage(content="e" * 30)]
+    expected = handle_context_limits(pre, middle, end, "openai", "gpt-4", custom_limit=300)
+    assert asyncio.run(ahandle_context_limits(pre, middle, end, "openai", "gpt-4", custom_limit=300)) == expected
+
+def test_concurrent_appends_and_legacy_migration(redis_manager):
+    """并发追加的消息都被保存，旧版本的 JSON 上下文在追加时迁移到列表"""
+    async def run():
+        await asyncio.gather(*(redis_manager.append_context("c", "human", f"m{i}") for i in range(20)))
+        context = await redis_manager.get_context("c")
+        assert sorted(message["content"] for message in context) == sorted(f"m{i}" for i in range(20))
+        assert await redis_manager.client.llen(redis_manager._context_keys("c")[2]) == 20
+
+        legacy = [{"type": "human", "content": "你好"}, {"type": "ai", "content": "你好！"}]
+        await redis_manager.client.set(redis_manager._context_keys("l")[1], json.dumps(legacy, ensure_ascii=False))
+        await redis_manager.append_context("l", "human", "再见")
+        assert [message["content"] for message in await redis_manager.get_context("l")] == ["你好", "你好！", "再见"]
+        assert not await redis_manager.client.exists(redis_manager._context_keys("l")[1])
+
+    asyncio.run(run())
+
+def test_append_trims_to_token_budget(redis_manager):
+    """追加时从最早的消息开始删除，保留的token总数不超过预算；启用摘要时删除的消息放入待摘要列表"""
+    async def run(key):
+        messages = [{"type": "human", "content": f"{i} " + "内容" * 20} for i in range(30)]
+        for message in messages:
+            await redis_manager.extend_contexts(key, [message], "openai", "gpt-4", 100)
+        list_key, _, tokens_key, total_key, pending_key = redis_manager._context_keys(key)[:5]
+        tokens = [int(token) for token in await redis_manager.client.lrange(tokens_key, 0, -1)]
+        total = int(await redis_manager.client.get(total_key))
+        assert sum(tokens) == total <= context_token_budget("openai", "gpt-4", 100)
+        contents = [message["content"] for message in await redis_manager.get_context(key)]
+        assert 0 < len(contents) == len(tokens) < len(messages)
+        assert contents == [message["content"] for message in messages[-len(contents):]]
+        _, pending = await redis_manager.get_context_pending(key)
+        pending = [message["content"] for message in pending]
+        return pending + contents == [message["content"] for message in messages], pending
+
+    with patch("helper.redis.CONTEXT_SUMMARY_ENABLED", False):
+        _, pending = asyncio.run(run("plain"))
+        assert pending == []
+    with patch("helper.redis.CONTEXT_SUMMARY_ENABLED", True):
+        complete, pending = asyncio.run(run("summary"))
+        assert complete and pending
+
+def test_summary_keeps_messages_appended_while_folding(redis_manager):
+    """合并摘要期间追加导致最早的待摘要消息被丢弃时，只删除已合并的消息"""
+    async def run():
+        messages = [{"type": "human", "content": f"m{i}"} for i in range(6)]
+        with patch("helper.redis.CONTEXT_SUMMARY_ENABLED", True), patch("helper.redis.CONTEXT_MAX_MESSAGES", 2):
+            await redis_manager.extend_contexts("s", messages[:4])
+            offset, pending = await redis_manager.get_context_pending("s")
+            assert [message["content"] for message in pending] == ["m0", "m1"]
+            # 合并期间又追加了消息，待摘要列表超过上限，丢弃了最早的 m0
+            await redis_manager.extend_contexts("s", messages[4:5])
+            await redis_manager.set_context_summary("s", "摘要", offset, len(pending))
+        _, pending = await redis_manager.get_context_pending("s")
+        assert [message["content"] for message in pending] == ["m2"]
+        assert await redis_manager.get_context_summary("s") == "摘要"
+
+    asyncio.run(run())
+
+def test_context_tail_counts_legacy_messages_in_batches(redis_manager):
+    """没有记录token数量的旧消息按页批量计算，计算结果记录到消息中"""
+    async def run():
+        service = TokenizerService(workers=2, offload_chars=0)
+        encoding_name = get_encoding("openai", "gpt-4").name
+        await redis_manager.set_context("t", [{"type": "human", "content": f"消息{i} " * 20} for i in range(10)])
+        assert all("tokens" not in message for message in await redis_manager.get_context("t"))
+
+        count_page = partial(service.message_token_counts, model_type="openai", model_name="gpt-4")
+        per_message = count_tokens("消息0 " * 20, "openai", "gpt-4")
+        tail = await redis_manager.get_context_tail("t", per_message * 3, count_page, page_size=2)
+        assert [message["content"] for message in tail] == [f"消息{i} " * 20 for i in range(6, 10)]
+        assert all(encoding_name in message["tokens"] for message in tail)
+        assert service.stats()["offloaded"] == 2
+
+        # 已记录的数量直接使用
+        assert await count_page([{"content": "你好", "tokens": {encoding_name: 7}}]) == [7]
+        service.close()
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import json
+import httpx
+import pytest
+from langchain_core.messages import AIMessageChunk
+import main
+from helper.stream import ProducerLease
+from tests.test_stream import parse_events
+
+
+class FakeAgent:
+    """按顺序输出分块的模型，gate 打开前停在最后一个分块之前"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.gate = asyncio.Event()
+        self.started = asyncio.Event()
+        self.calls = 0
+
+    async def astream(self, inputs, stream_mode=None):
+        self.calls += 1
+        for index, chunk in enumerate(self.chunks):
+            if index == len(self.chunks) - 1:
+                self.started.set()
+                await self.gate.wait()
+            yield AIMessageChunk(content=chunk), {}
+
+
+@pytest.fixture
+def fake_model(redis_manager, monkeypatch):
+    """替换模型、MCP 和回调发件箱，返回模型和入队的回调"""
+    agent = FakeAgent(["你好", "世界"])
+    callbacks = []
+    async def enqueue(request_client, data, action=None):
+        callbacks.append((action, data))
+    monkeypatch.setattr(main, "get_model_instance", lambda **kwargs: object())
+    monkeypatch.setattr(main.agent_cache, "get_agent", lambda model, tools: agent)
+    monkeypatch.setattr(main.callback_outbox, "enqueue", enqueue)
+    monkeypatch.setattr(main.app.state, "mcp", False, raising=False)
+    monkeypatch.setattr(main.app.state, "redis_manager", redis_manager, raising=False)
+    return agent, callbacks
+
+def input_data(**kwargs):
+    data = {
+        "text": "你好", "token": "token", "dialog_id": 1, "version": "1.0", "msg_user_token": None,
+        "before_text": [], "model_type": "openai", "model_name": "gpt-5-nano", "system_message": None,
+        "server_url": "http://dootask.test", "api_key": "key", "base_url": None, "agency": None,
+        "temperature": 0.7, "max_tokens": 0, "thinking": 0, "context_limit": 0,
+        "context_key": "ctx", "stream_key": "key", "status": "prepare", "response": "",
+    }
+    data.update(kwargs)
+    return data
+
+def test_interrupted_on_shutdown_propagates_cancel(redis_manager, fake_model, monkeypatch):
+    """服务关闭时被中断的生成不写入结果，取消继续向上传递并释放租约"""
+    agent, callbacks = fake_model
+
+    async def run():
+        data = input_data()
+        await redis_manager.set_input("m1", data)
+        lease = ProducerLease(redis_manager, "stream_msg_m1")
+        assert await lease.acquire()
+        task = asyncio.create_task(lease.run(main.stream_generate("m1", "stream_msg_m1", data, redis_manager, lease, "")))
+        await asyncio.wait_for(agent.started.wait(), 5)
+        monkeypatch.setattr(main.task_supervisor, "closing", True)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert task.cancelled()
+        assert (await redis_manager.get_input("m1"))["status"] == "processing"
+        assert not await redis_manager.lease_exists("stream_msg_m1")
+        assert callbacks == []
+
+    asyncio.run(run())
+
+def test_eager_generation_attaches_viewer(redis_manager, fake_model, monkeypatch):
+    """预先生成：/chat 获取租约并开始生成，之后连接的查看者从头读取，不会启动第二个生产者"""
+    agent, callbacks = fake_model
+    async def call(self, data, **kwargs):
+        return 101
+    monkeypatch.setattr(main, "STREAM_EAGER", True)
+    monkeypatch.setattr(main.RequestClient, "call", call)
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://ai.test") as client:
+            response = await client.post("/chat", data={
+                "text": "你好", "token": "token", "version": "1.0", "dialog_id": 1, "msg_id": 1, "msg_uid": 2, "bot_uid": 3,
+                "extras": '{"server_url": "http://dootask.test", "api_key": "key"}',
+            })
+        result = response.json()["data"]
+        assert result["id"] == 101
+        assert [action for action, _ in callbacks] == ["stream"]
+
+        # 没有查看者时已经开始生成
+        producers = [task for task in main.task_supervisor.tasks if task.get_name() == "stream_generate:101"]
+        assert len(producers) == 1
+        await asyncio.wait_for(agent.started.wait(), 5)
+        assert await redis_manager.lease_exists("stream_msg_101")
+
+        response = await main.stream("101", result["key"], host="ai.test", scheme="http", last_event_id="")
+        events = []
+        async def consume():
+            async for event in response.body_iterator:
+                events.append(event)
+                agent.gate.set()
+        await asyncio.wait_for(consume(), 10)
+        await asyncio.wait_for(producers[0], 5)
+        return events
+
+    events = parse_events(asyncio.run(run()))
+    assert agent.calls == 1
+    # 从头补齐已生成的内容，之后按偏移量追加
+    assert events[0] == ("0-6", "replace", '{"content": "你好"}')
+    assert events[-1][1] == "done"
+    assert "".join(json.loads(data)["content"] for _, event, data in events if event != "done") == "你好世界"
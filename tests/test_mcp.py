@@ -0,0 +1,186 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from contextlib import asynccontextmanager
+from langchain_mcp_adapters.interceptors import MCPToolCallRequest
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, INVALID_PARAMS, CallToolResult, ErrorData, TextContent
+from helper import mcp
+from helper.mcp import McpSessionPool, ToolCatalogCache, ToolResultCache
+
+def make_loader(calls, delay=0.01):
+    async def loader(url, token):
+        calls.append((url, token))
+        await asyncio.sleep(delay)
+        return [f"{url}:{token}:{len(calls)}"]
+    return loader
+
+def test_concurrent_misses_share_one_load():
+    """同一个键并发未命中时只请求一次 MCP 服务"""
+    async def run():
+        calls = []
+        cache = ToolCatalogCache(make_loader(calls), maxsize=8, ttl=60)
+        results = await asyncio.gather(*(cache.get_tools("u", "t") for _ in range(10)))
+        assert len(calls) == 1
+        assert all(result == results[0] for result in results)
+        assert await cache.get_tools("u", "t") == results[0]
+        assert cache.stats()["hits"] == 1
+    asyncio.run(run())
+
+def test_stale_entry_refreshes_in_background():
+    """超过有效期一半时返回旧结果并在后台刷新"""
+    async def run():
+        calls = []
+        cache = ToolCatalogCache(make_loader(calls), maxsize=8, ttl=0.2)
+        first = await cache.get_tools("u", "t")
+        await asyncio.sleep(0.12)
+        assert await cache.get_tools("u", "t") == first
+        await asyncio.sleep(0.05)
+        assert len(calls) == 2
+        assert await cache.get_tools("u", "t") != first
+    asyncio.run(run())
+
+def test_lru_eviction_and_failures_not_cached():
+    """超过容量淘汰最久未使用的条目，获取失败不缓存"""
+    async def run():
+        calls = []
+        cache = ToolCatalogCache(make_loader(calls, delay=0), maxsize=2, ttl=60)
+        await cache.get_tools("u", "a")
+        await cache.get_tools("u", "b")
+        await cache.get_tools("u", "a")
+        await cache.get_tools("u", "c")
+        assert set(cache.entries) == {("u", "a"), ("u", "c")}
+
+        async def failing(url, token):
+            raise RuntimeError("down")
+        cache.loader = failing
+        for _ in range(2):
+            try:
+                await cache.get_tools("u", "d")
+                assert False
+            except RuntimeError:
+                pass
+        assert ("u", "d") not in cache.entries
+    asyncio.run(run())
+
+class FakeSession:
+    def __init__(self, token, opened):
+        self.token = token
+        self.opened = opened
+
+    async def initialize(self):
+        pass
+
+    async def call_tool(self, name, arguments):
+        await asyncio.sleep(0.01)
+        if "error" in arguments:
+            raise McpError(ErrorData(code=arguments["error"], message="error"))
+        return f"{self.token}:{name}:{arguments['x']}"
+
+def make_connect(opened):
+    @asynccontextmanager
+    async def connect(connection):
+        session = FakeSession(connection["headers"]["token"], opened)
+        opened.append(session)
+        try:
+            yield session
+        finally:
+            opened.remove(session)
+    return connect
+
+def test_session_pool_reuses_and_caps_sessions():
+    """同一个 token 复用会话，会话数不超过上限，空闲会话超时关闭"""
+    async def run():
+        opened = []
+        pool = McpSessionPool(max_sessions=2, idle_timeout=0.2, connect=make_connect(opened))
+        results = await asyncio.gather(*(pool.call_tool("u", "a", "echo", {"x": i}) for i in range(5)))
+        assert results == [f"a:echo:{i}" for i in range(5)]
+        assert pool.stats()["created"] == 1
+
+        # 超过上限时淘汰最久未使用的空闲会话
+        await pool.call_tool("u", "b", "echo", {"x": 0})
+        await pool.call_tool("u", "c", "echo", {"x": 0})
+        await asyncio.sleep(0.01)
+        assert set(pool.sessions) == {("u", "b"), ("u", "c")}
+        assert len(opened) == 2
+
+        # 全部会话使用中时等待释放
+        calls = [pool.call_tool("u", token, "echo", {"x": 1}) for token in "defg"]
+        assert await asyncio.gather(*calls) == [f"{token}:echo:1" for token in "defg"]
+        assert len(pool.sessions) <= 2
+
+        await asyncio.sleep(1.2)
+        assert not pool.sessions and not opened
+        await pool.close()
+    asyncio.run(run())
+
+def test_session_pool_discards_only_broken_sessions():
+    """工具返回的普通错误保留会话，连接关闭时丢弃会话"""
+    async def run():
+        opened = []
+        pool = McpSessionPool(max_sessions=2, idle_timeout=60, connect=make_connect(opened))
+        for code in (INVALID_PARAMS, CONNECTION_CLOSED):
+            try:
+                await pool.call_tool("u", "a", "echo", {"x": 0, "error": code})
+                assert False
+            except McpError as e:
+                assert e.error.code == code
+            await asyncio.sleep(0.01)
+            assert (("u", "a") in pool.sessions) == (code == INVALID_PARAMS)
+        assert pool.stats()["created"] == 1
+        await pool.close()
+    asyncio.run(run())
+
+def test_tool_timeout_and_read_result_cache():
+    """工具超时返回错误结果；只读工具结果按参数缓存，调用写工具后清除"""
+    async def run():
+        calls = []
+        async def handler(request):
+            calls.append(request.name)
+            await asyncio.sleep(request.args.get("sleep", 0))
+            return CallToolResult(content=[TextContent(type="text", text=str(len(calls)))])
+
+        def request(name, **args):
+            return MCPToolCallRequest(name=name, args=args, server_name="test")
+
+        mcp.MCP_TOOL_TIMEOUTS["slow"] = 0.05
+        result = await mcp.tool_timeout_interceptor(request("slow", sleep=1), handler)
+        assert result.isError
+
+        cache = ToolResultCache(ttl=60)
+        intercept = cache.interceptor("u", "t", {"get_task"})
+        first = await intercept(request("get_task", id=1), handler)
+        assert await intercept(request("get_task", id=1), handler) is first
+        assert await intercept(request("get_task", id=2), handler) is not first
+        await intercept(request("update_task", id=1), handler)
+        assert await intercept(request("get_task", id=1), handler) is not first
+        assert calls.count("get_task") == 3
+    asyncio.run(run())
+
+def test_read_result_not_cached_across_write():
+    """写工具执行前已开始的只读调用，结果不写入缓存"""
+    async def run():
+        calls = []
+        async def handler(request):
+            calls.append(request.name)
+            await asyncio.sleep(request.args.get("sleep", 0))
+            return CallToolResult(content=[TextContent(type="text", text=str(len(calls)))])
+
+        def request(name, **args):
+            return MCPToolCallRequest(name=name, args=args, server_name="test")
+
+        cache = ToolResultCache(ttl=60)
+        intercept = cache.interceptor("u", "t", {"get_task"})
+        read = asyncio.create_task(intercept(request("get_task", sleep=0.05), handler))
+        await asyncio.sleep(0.01)
+        write = asyncio.create_task(intercept(request("update_task", sleep=0.1), handler))
+        await read
+        # 写工具执行期间开始的只读调用同样不缓存
+        await intercept(request("get_task", sleep=0.01), handler)
+        await write
+        assert not cache.entries
+        await intercept(request("get_task", sleep=0), handler)
+        assert len(cache.entries) == 1
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+import pytest
+from helper.utils import ModelInstanceCache, get_model_instance, model_cache
+
+def test_same_config_reuses_instance():
+    """相同配置复用实例，配置不同时创建新实例"""
+    model_cache.clear()
+    first = get_model_instance("openai", "gpt-4o", "sk-test", temperature=0.5, streaming=True)
+    assert get_model_instance("openai", "gpt-4o", "sk-test", temperature=0.5, streaming=True) is first
+    assert get_model_instance("openai", "gpt-4o", "sk-test", temperature=0.5, streaming=False) is not first
+    assert get_model_instance("openai", "gpt-4o", "sk-other", temperature=0.5, streaming=True) is not first
+
+def test_lru_and_idle_eviction():
+    """超过容量淘汰最久未使用的实例，空闲超时的实例被淘汰"""
+    cache = ModelInstanceCache(maxsize=2, idle_timeout=0.1)
+    cache.get("a", object)
+    cache.get("b", object)
+    cache.get("a", object)
+    cache.get("c", object)
+    assert list(cache.entries) == ["a", "c"]
+    time.sleep(0.15)
+    cache.get("d", object)
+    assert list(cache.entries) == ["d"]
+
+def test_concurrent_gets_share_instance():
+    """多线程并发获取同一配置时得到同一个实例"""
+    cache = ModelInstanceCache(maxsize=8, idle_timeout=60)
+    results = []
+
+    def factory():
+        time.sleep(0.01)
+        return object()
+
+    threads = [threading.Thread(target=lambda: results.append(cache.get("k", factory))) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, results))) == 1
+
+def test_models_share_transport_per_proxy():
+    """相同代理的模型共用 HTTP 客户端，代理不同时使用不同的客户端，且不修改环境变量"""
+    model_cache.clear()
+    direct = get_model_instance("openai", "gpt-4o", "sk-a")
+    proxied = get_model_instance("openai", "gpt-4o", "sk-b", agency="http://127.0.0.1:1080")
+    other = get_model_instance("deepseek", "deepseek-chat", "sk-c", agency="http://127.0.0.1:1080")
+    assert proxied.http_async_client is other.http_async_client
+    assert proxied.http_async_client is not direct.http_async_client
+    assert "https_proxy" not in os.environ
+
+def test_unsupported_proxy_is_rejected():
+    """不支持按实例指定代理的模型配置了代理时报错，而不是直连"""
+    model_cache.clear()
+    with pytest.raises(RuntimeError, match="Proxy"):
+        get_model_instance("qwen", "qwen-max", "sk-d", agency="http://127.0.0.1:1080")
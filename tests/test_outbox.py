@@ -0,0 +1,160 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+
+def test_outbox_claim_and_retry(redis_manager):
+    """到期任务被领取后在租约期内不会重复领取，重试按退避时间重新到期，完成后删除"""
+    async def run():
+        await redis_manager.enqueue_callback("a", "pa", 100)
+        await redis_manager.enqueue_callback("b", "pb", 200)
+        assert await redis_manager.claim_callbacks(150, 10, 1000) == [("a", "pa", 0)]
+        assert await redis_manager.claim_callbacks(150, 10, 1000) == []
+
+        assert await redis_manager.finish_callback("a", "pa", 160, retry_at=300, attempts=1)
+        assert await redis_manager.claim_callbacks(250, 10, 1000) == [("b", "pb", 0)]
+        assert await redis_manager.claim_callbacks(300, 10, 1000) == [("a", "pa", 1)]
+
+        assert await redis_manager.finish_callback("a", "pa", 310)
+        assert not await redis_manager.client.hexists(redis_manager._outbox_keys()[0], "a")
+        # 发送方崩溃未结束的任务在租约到期后重新领取
+        assert await redis_manager.claim_callbacks(1000, 10, 2000) == [("b", "pb", 0)]
+
+    asyncio.run(run())
+
+def test_outbox_update_while_sending(redis_manager):
+    """发送期间入队的新内容替代旧内容，旧内容发送结束后立即重新到期"""
+    async def run():
+        await redis_manager.enqueue_callback("a", "v1", 100)
+        assert await redis_manager.claim_callbacks(100, 10, 1000) == [("a", "v1", 0)]
+        await redis_manager.enqueue_callback("a", "v2", 110)
+        # 发送中的任务不会因为入队被提前领取
+        assert await redis_manager.claim_callbacks(120, 10, 1000) == []
+
+        assert not await redis_manager.finish_callback("a", "v1", 130)
+        assert await redis_manager.claim_callbacks(130, 10, 1000) == [("a", "v2", 0)]
+        assert await redis_manager.finish_callback("a", "v2", 140)
+        assert await redis_manager.claim_callbacks(2000, 10, 3000) == []
+
+    asyncio.run(run())
+
+def _run_dispatcher(outbox, done, timeout=5):
+    """运行分发器直到 done() 为真，超时则失败"""
+    async def run():
+        dispatcher = asyncio.create_task(outbox.run())
+        try:
+            deadline = asyncio.get_running_loop().time() + timeout
+            while not done():
+                assert asyncio.get_running_loop().time() < deadline, "dispatcher timed out"
+                await asyncio.sleep(0.01)
+            await outbox.close()
+        finally:
+            dispatcher.cancel()
+    return run()
+
+async def _enqueue(outbox, count=1, server_url="http://dootask.test"):
+    from helper.request import RequestClient
+    request_client = RequestClient(server_url, "1.0", "token", 1)
+    for i in range(count):
+        await outbox.enqueue(request_client, {"text": f"msg {i}"})
+
+async def _pending(redis_manager):
+    return await redis_manager.client.hlen(redis_manager._outbox_keys()[0])
+
+def _stub_send(monkeypatch, handler):
+    """替换 RequestClient.send，记录每次发送的时间"""
+    from helper.request import RequestClient
+    calls = []
+    async def send(self, data, **kwargs):
+        calls.append(time.monotonic())
+        return await handler(len(calls), data)
+    monkeypatch.setattr(RequestClient, "send", send)
+    return calls
+
+def test_dispatcher_retries_with_backoff(redis_manager, monkeypatch):
+    """服务端 5xx 按退避时间重试，成功后删除任务"""
+    from helper import outbox as outbox_module
+    from helper.request import CallbackError
+    monkeypatch.setattr(outbox_module, "CALLBACK_RETRY_BASE", 0.2)
+    async def handler(attempt, data):
+        if attempt == 1:
+            raise CallbackError("HTTP 503", retryable=True)
+        return {"ret": 1}
+    calls = _stub_send(monkeypatch, handler)
+    outbox = outbox_module.CallbackOutbox(poll_interval=0.01)
+
+    async def run():
+        await _enqueue(outbox)
+        await _run_dispatcher(outbox, lambda: outbox.sent == 1)
+        assert len(calls) == 2
+        # 抖动范围 0.8 ~ 1.2 倍
+        assert calls[1] - calls[0] >= 0.2 * 0.8
+        assert outbox.stats()["retried"] == 1
+        assert await _pending(redis_manager) == 0
+
+    asyncio.run(run())
+
+def test_dispatcher_drops_client_errors(redis_manager, monkeypatch):
+    """4xx 等不可重试的错误直接放弃"""
+    from helper.outbox import CallbackOutbox
+    from helper.request import CallbackError
+    async def handler(attempt, data):
+        raise CallbackError("HTTP 400", retryable=False)
+    calls = _stub_send(monkeypatch, handler)
+    outbox = CallbackOutbox(poll_interval=0.01)
+
+    async def run():
+        await _enqueue(outbox)
+        await _run_dispatcher(outbox, lambda: outbox.dropped == 1)
+        assert len(calls) == 1
+        assert outbox.stats()["retried"] == 0
+        assert await _pending(redis_manager) == 0
+
+    asyncio.run(run())
+
+def test_dispatcher_stops_at_max_attempts(redis_manager, monkeypatch):
+    """一直失败的回调达到最多尝试次数后放弃"""
+    from helper import outbox as outbox_module
+    from helper.config import CALLBACK_MAX_ATTEMPTS
+    from helper.request import CallbackError
+    monkeypatch.setattr(outbox_module, "CALLBACK_RETRY_BASE", 0.001)
+    async def handler(attempt, data):
+        raise CallbackError("HTTP 503", retryable=True)
+    calls = _stub_send(monkeypatch, handler)
+    outbox = outbox_module.CallbackOutbox(poll_interval=0.01)
+
+    async def run():
+        await _enqueue(outbox)
+        await _run_dispatcher(outbox, lambda: outbox.dropped == 1)
+        assert len(calls) == CALLBACK_MAX_ATTEMPTS
+        assert outbox.stats()["retried"] == CALLBACK_MAX_ATTEMPTS - 1
+        assert await _pending(redis_manager) == 0
+
+    asyncio.run(run())
+
+def test_dispatcher_limits_server_concurrency(redis_manager, monkeypatch):
+    """同一 server_url 同时发送的数量不超过 CALLBACK_SERVER_CONCURRENCY"""
+    from helper.outbox import CallbackOutbox
+    from helper.config import CALLBACK_SERVER_CONCURRENCY
+    count = CALLBACK_SERVER_CONCURRENCY * 3
+    sending = {"now": 0, "max": 0}
+    async def handler(attempt, data):
+        sending["now"] += 1
+        sending["max"] = max(sending["max"], sending["now"])
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            sending["now"] -= 1
+    calls = _stub_send(monkeypatch, handler)
+    outbox = CallbackOutbox(poll_interval=0.01)
+
+    async def run():
+        await _enqueue(outbox, count)
+        await _run_dispatcher(outbox, lambda: outbox.sent == count)
+        assert len(calls) == count
+        assert sending["max"] == CALLBACK_SERVER_CONCURRENCY
+        assert await _pending(redis_manager) == 0
+
+    asyncio.run(run())
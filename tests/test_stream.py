@@ -0,0 +1,153 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from helper.stream import ProducerLease, StreamPublisher, finished_events, parse_event_id, stream_consumer
+
+def parse_events(events):
+    """解析 SSE 事件为 (id, 事件类型, 数据)"""
+    result = []
+    for event in events:
+        lines = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+        result.append((lines["id"], lines["event"], lines["data"]))
+    return result
+
+async def collect(redis_manager, input_key, msg_key, resume=None, **kwargs):
+    return [event async for event in stream_consumer(redis_manager, input_key, msg_key, resume, **kwargs)]
+
+def test_first_live_delta_replaces_placeholder(redis_manager):
+    """订阅时还没有内容，第一段实时内容以 replace 发送（替换占位符），之后为 append"""
+    async def run():
+        await redis_manager.set_input("in1", {"status": "processing"})
+        task = asyncio.create_task(collect(redis_manager, "in1", "msg1"))
+        await asyncio.sleep(0.2)
+        publisher = StreamPublisher(redis_manager, "msg1")
+        await publisher.append("你好")
+        await publisher.append(" world")
+        await redis_manager.set_input("in1", {"status": "finished", "response": "你好 world"})
+        await publisher.finish("你好 world")
+        return await asyncio.wait_for(task, 5)
+
+    events = parse_events(asyncio.run(run()))
+    assert [(event_id, event) for event_id, event, _ in events] == [("0-6", "replace"), ("0-12", "append"), ("0-12", "done")]
+
+def test_resume_from_offset(redis_manager):
+    """携带有效偏移量时只补发剩余部分，无效偏移量（不在字符边界或超出日志）时整体替换"""
+    async def run():
+        publisher = StreamPublisher(redis_manager, "msg2")
+        await publisher.append("你好")
+        await publisher.append(" world")
+        await redis_manager.set_input("in2", {"status": "finished", "response": "你好 world"})
+        await publisher.finish("你好 world")
+        return [
+            parse_events(await collect(redis_manager, "in2", "msg2", parse_event_id(last_event_id)))
+            for last_event_id in ("0-6", "0-12", "0-2", "0-100")
+        ]
+
+    resumed, complete, split_char, too_long = asyncio.run(run())
+    assert resumed == [("0-12", "append", '{"content": " world"}'), ("0-12", "done", "{}")]
+    assert complete == [("0-12", "done", "{}")]
+    for events in (split_char, too_long):
+        assert [(event_id, event) for event_id, event, _ in events] == [("0-12", "replace"), ("0-12", "done")]
+
+def test_resume_in_flight(redis_manager):
+    """生成中重连：已收到的部分不重复发送，之后的增量按偏移量追加"""
+    async def run():
+        await redis_manager.set_input("in3", {"status": "processing"})
+        publisher = StreamPublisher(redis_manager, "msg3")
+        await publisher.append("你好")
+        task = asyncio.create_task(collect(redis_manager, "in3", "msg3", (0, 6)))
+        await asyncio.sleep(0.2)
+        await publisher.append(" world")
+        await redis_manager.set_input("in3", {"status": "finished", "response": "你好 world"})
+        await publisher.finish("你好 world")
+        return await asyncio.wait_for(task, 5)
+
+    events = parse_events(asyncio.run(run()))
+    assert events == [("0-12", "append", '{"content": " world"}'), ("0-12", "done", "{}")]
+
+def test_resume_across_takeover(redis_manager):
+    """接管后日志被重写，携带旧日志版本 id 重连时整体替换，不会拼接旧的前缀"""
+    async def run():
+        await redis_manager.set_input("in5", {"status": "processing"})
+        publisher = StreamPublisher(redis_manager, "msg5")
+        await publisher.append("旧的回答")
+        first = parse_events(await collect_until(redis_manager, "in5", "msg5", 1))
+        watcher = asyncio.create_task(collect_until(redis_manager, "in5", "msg5", 3))
+        await asyncio.sleep(0.2)
+        # 接管后重新生成，新内容比旧内容更长
+        publisher = StreamPublisher(redis_manager, "msg5")
+        await publisher.reset()
+        await publisher.append("重新生成的回答")
+        watched = parse_events(await asyncio.wait_for(watcher, 5))
+        resumed = parse_events(await collect_until(redis_manager, "in5", "msg5", 1, parse_event_id(first[-1][0])))
+
+        await redis_manager.set_input("in5", {"status": "finished", "response": "重新生成的回答"})
+        await publisher.finish("重新生成的回答")
+        epoch = await redis_manager.stream_epoch("msg5")
+        finished = parse_events(finished_events("重新生成的回答", parse_event_id(first[-1][0]), epoch=epoch))
+        return first, watched, resumed, finished
+
+    first, watched, resumed, finished = asyncio.run(run())
+    assert first[0][:2] == ("0-12", "replace")
+    # 在线的查看者收到携带新版本的替换事件
+    assert [(event_id, event) for event_id, event, _ in watched] == [("0-12", "replace"), ("1-0", "replace"), ("1-21", "replace")]
+    assert resumed[0][:2] == ("1-21", "replace")
+    assert finished[0][:2] == ("1-21", "replace")
+
+async def collect_until(redis_manager, input_key, msg_key, count, resume=None):
+    """收集前 count 个事件后断开"""
+    events = []
+    consumer = stream_consumer(redis_manager, input_key, msg_key, resume)
+    async for event in consumer:
+        events.append(event)
+        if len(events) >= count:
+            break
+    await consumer.aclose()
+    return events
+
+def test_producer_lease_takeover(redis_manager):
+    """租约过期后被其他生产者接管，原生产者续约失败时被取消且不会释放新租约"""
+    async def run():
+        first = ProducerLease(redis_manager, "msg4", ttl=0.3)
+        second = ProducerLease(redis_manager, "msg4", ttl=0.3)
+        assert await first.acquire()
+        assert not await second.acquire()
+
+        task = asyncio.create_task(first.run(asyncio.sleep(10)))
+        await asyncio.sleep(0.05)
+        # 模拟原生产者停顿导致租约过期
+        await redis_manager.client.delete(redis_manager._make_key("lease", "msg4"))
+        assert await second.acquire()
+        try:
+            await asyncio.wait_for(task, 2)
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+        assert first.lost
+        assert await redis_manager.renew_lease("msg4", second.token, 300)
+        await second.release()
+        assert not await redis_manager.lease_exists("msg4")
+
+    asyncio.run(run())
+
+def test_subscribe_cancelled_before_ready():
+    """等待上游就绪时被取消的订阅不会留在流中心"""
+    from helper.stream import StreamHub
+    class PendingRedis:
+        async def subscribe_stream(self, msg_key):
+            await asyncio.Event().wait()
+        async def stream_length(self, msg_key):
+            await asyncio.Event().wait()
+
+    async def run():
+        hub = StreamHub()
+        task = asyncio.create_task(hub.subscribe(PendingRedis(), "in9", "msg9"))
+        await asyncio.sleep(0.05)
+        assert hub.stats() == {"streams": 1, "subscribers": 1}
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert hub.stats() == {"streams": 0, "subscribers": 0}
+
+    asyncio.run(run())
@@ -0,0 +1,42 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import random
+from helper.utils import (
+    reasoning_remover,
+    remove_reasoning_content,
+    replace_think_content,
+    think_transformer,
+)
+
+def split_random(text, rng):
+    """把文本随机切成若干分块"""
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 6))))
+    pieces, prev = [], 0
+    for cut in cuts:
+        pieces.append(text[prev:cut])
+        prev = cut
+    pieces.append(text[prev:])
+    return pieces
+
+def run_stream(transformer, pieces):
+    return "".join(transformer.feed(piece) for piece in pieces) + transformer.flush()
+
+def test_think_transformer_matches_regex():
+    """流式 think 标签替换与整段替换结果一致"""
+    rng = random.Random(1)
+    tokens = ["<think>", "</think>", " ", "\n", "a", "好", "<", "/", "th", "k>", "::: reasoning\n", ":::"]
+    for _ in range(5000):
+        text = "".join(rng.choice(tokens) for _ in range(rng.randint(0, 12)))
+        expected = replace_think_content(text)
+        assert run_stream(think_transformer(), split_random(text, rng)) == expected
+
+def test_reasoning_remover_matches_regex():
+    """流式去除推理内容与整段去除结果一致"""
+    rng = random.Random(2)
+    tokens = ["::: reasoning\n", ":::", ":", "::", " ", "\n", "a", "好", "reasoning"]
+    for _ in range(5000):
+        text = "".join(rng.choice(tokens) for _ in range(rng.randint(0, 12)))
+        expected = remove_reasoning_content(text)
+        assert run_stream(reasoning_remover(), split_random(text, rng)) == expected
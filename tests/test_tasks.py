@@ -0,0 +1,82 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from helper.tasks import TaskSupervisor
+
+def test_bounded_concurrency_and_stats():
+    """超过并发上限的任务排队，统计完成、失败和取消的任务数"""
+    async def run():
+        supervisor = TaskSupervisor(max_concurrency=2)
+        gate = asyncio.Event()
+
+        async def work():
+            await gate.wait()
+
+        async def fail():
+            raise ValueError("boom")
+
+        tasks = [supervisor.spawn(work()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert supervisor.stats()["running"] == 2
+        assert supervisor.stats()["queued"] == 1
+        tasks[2].cancel()
+        gate.set()
+        supervisor.spawn(fail())
+        await supervisor.drain(1)
+        return supervisor
+
+    supervisor = asyncio.run(run())
+    assert supervisor.stats() == {"queued": 0, "running": 0, "completed": 2, "failed": 1, "cancelled": 1}
+    assert not supervisor.tasks
+
+def test_drain_cancels_after_timeout():
+    """关闭时等待超时的任务被取消"""
+    async def run():
+        supervisor = TaskSupervisor(max_concurrency=4)
+        supervisor.spawn(asyncio.sleep(10))
+        await supervisor.drain(0.05)
+        return supervisor
+
+    supervisor = asyncio.run(run())
+    assert supervisor.stats()["cancelled"] == 1
+    assert supervisor.closing
+
+def test_producers_bounded_by_reserved_slots():
+    """生产者先占用名额再启动，名额用完时不排队；开始运行前被取消的任务归还名额"""
+    async def run():
+        supervisor = TaskSupervisor(max_concurrency=2)
+        gate = asyncio.Event()
+        started = []
+
+        async def produce(name):
+            started.append(name)
+            await gate.wait()
+
+        async def start(name):
+            if not await supervisor.try_acquire():
+                return None
+            return supervisor.spawn(produce(name), acquired=True)
+
+        producers = [await start(f"p{i}") for i in range(4)]
+        assert [task is not None for task in producers] == [True, True, False, False]
+        await asyncio.sleep(0)
+        assert started == ["p0", "p1"]
+        assert supervisor.stats()["running"] == 2
+
+        # 普通任务排队等待生产者结束
+        supervisor.spawn(produce("queued"))
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert await start("p4") is not None
+
+        # 占用名额后立即取消，名额被归还
+        assert await supervisor.try_acquire()
+        supervisor.spawn(produce("cancelled"), acquired=True).cancel()
+        await supervisor.drain(1)
+        assert not supervisor.closing
+        assert await supervisor.try_acquire() and await supervisor.try_acquire()
+        return started
+
+    assert asyncio.run(run()) == ["p0", "p1", "queued", "p4"]
@@ -0,0 +1,41 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import httpx
+from helper import request as request_module
+from helper.request import RequestClient
+from helper.transport import TransportRegistry
+
+def test_callback_client_reused_and_closed(monkeypatch):
+    """同一 server_url 的回调共用一个客户端，关闭注册表时关闭客户端"""
+    registry = TransportRegistry(follow_redirects=False)
+    requests = []
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"ret": 1})
+    client_kwargs = registry._client_kwargs
+    monkeypatch.setattr(registry, "_client_kwargs",
+                        lambda proxy: {**client_kwargs(proxy), "transport": httpx.MockTransport(handler)})
+    monkeypatch.setattr(request_module, "callback_transport", registry)
+
+    async def run():
+        request_client = RequestClient("http://dootask.test", "1.0", "token", 1)
+        assert await request_client.send({"text": "a"}) == {"ret": 1}
+        client = registry.get_async_client(base_url="http://dootask.test")
+        assert await request_client.send({"text": "b"}) == {"ret": 1}
+        assert registry.get_async_client(base_url="http://dootask.test") is client
+        assert len(registry.async_clients) == 1
+        assert len(requests) == 2
+        # 其他服务器使用独立的客户端
+        assert registry.get_async_client(base_url="http://other.test") is not client
+
+        await registry.aclose()
+        assert client.is_closed
+        assert not registry.async_clients
+        # 关闭后重新获取时创建新的客户端
+        assert registry.get_async_client(base_url="http://dootask.test") is not client
+        await registry.aclose()
+
+    asyncio.run(run())